@@ -2,7 +2,9 @@
 WatchNexus Compote - Indexer Manager 🍇
 Includes Syrup scrapers and Pulp usenet support
 """
-from .compote import CompoteManager
+from .compote import Compote, IndexerConfig, IndexerError, IndexerUnavailable
+
+CompoteManager = Compote
 
 __version__ = "1.0.0"
-__all__ = ["CompoteManager"]
+__all__ = ["Compote", "CompoteManager", "IndexerConfig", "IndexerError", "IndexerUnavailable"]
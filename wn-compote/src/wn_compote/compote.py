@@ -12,7 +12,8 @@ import httpx
 import asyncio
 import xml.etree.ElementTree as ET
 from dataclasses import dataclass, field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, AsyncIterator
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
 import hashlib
 import logging
@@ -508,6 +509,131 @@ class IndexerConfig:
     download_link_type: str = "auto"  # auto, magnet, torrent, nzb
     search_path: str = ""  # Custom search path (e.g., /api, /search)
     cookie: str = ""  # Manual cookie for auth
+    
+    # Result caching
+    cache_ttl: int = 300  # seconds to reuse search results, 0 = always search
+    
+    # Upper bound per search; the actual timeout adapts to the indexer's latency
+    timeout: float = 30.0
+
+
+class IndexerError(Exception):
+    """A search request to an indexer failed."""
+
+
+class IndexerUnavailable(IndexerError):
+    """An indexer is skipped because its circuit breaker is open."""
+
+
+class IndexerHealth:
+    """
+    Latency and failure tracking of one indexer, with a circuit breaker.
+    
+    After FAILURE_THRESHOLD failures in a row the breaker opens and the
+    indexer is skipped for a cooldown, which doubles every time it opens
+    again. Once the cooldown has passed a single search is let through
+    (half-open); it closes the breaker or reopens it.
+    """
+    
+    FAILURE_THRESHOLD = 3
+    BASE_COOLDOWN = 60.0  # seconds
+    MAX_COOLDOWN = 1800.0
+    MIN_TIMEOUT = 5.0  # seconds
+    TIMEOUT_FACTOR = 3  # timeout = factor x p90 latency
+    LATENCY_WINDOW = 20  # latencies kept
+    FAST_LATENCY = 2.0  # seconds; slower indexers score lower
+    
+    def __init__(self):
+        self.state = "closed"  # closed, open, half_open
+        self.latencies: deque = deque(maxlen=self.LATENCY_WINDOW)  # seconds, successful searches
+        self.success_rate = 1.0  # moving average
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown = self.BASE_COOLDOWN
+        self.open_until = 0.0  # monotonic time
+        self.last_error = ""
+        self._probing = False
+    
+    def allow(self) -> bool:
+        """
+        Whether a search may be sent now; moves an expired open breaker to
+        half-open. Half-open, only one search (the probe) is let through;
+        whoever sent it calls release_probe() once it has finished.
+        """
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() < self.open_until:
+                return False
+            self.state = "half_open"
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+    
+    def release_probe(self) -> None:
+        """Let the next half-open search through; only for the sender of the current probe."""
+        self._probing = False
+    
+    def timeout(self, limit: float) -> float:
+        """Timeout for the next search: a multiple of recent p90 latency, within limit."""
+        if self.state != "closed" or len(self.latencies) < 5:
+            return limit
+        ordered = sorted(self.latencies)
+        p90 = ordered[int(0.9 * (len(ordered) - 1))]
+        return min(limit, max(self.MIN_TIMEOUT, p90 * self.TIMEOUT_FACTOR))
+    
+    def record_success(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.successes += 1
+        self.success_rate = 0.8 * self.success_rate + 0.2
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.cooldown = self.BASE_COOLDOWN
+    
+    def record_failure(self, error: str) -> bool:
+        """Count a failed search. Returns True if this opened the breaker."""
+        self.failures += 1
+        self.success_rate *= 0.8
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == "half_open":
+            self.cooldown = min(self.MAX_COOLDOWN, self.cooldown * 2)
+        elif self.consecutive_failures < self.FAILURE_THRESHOLD or self.state == "open":
+            return False
+        self.state = "open"
+        self.open_until = time.monotonic() + self.cooldown
+        return True
+    
+    def median_latency(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[len(ordered) // 2]
+    
+    def score(self) -> int:
+        """0-100: recent success rate, less up to half for slow responses; 0 while open."""
+        if self.state == "open":
+            return 0
+        median = self.median_latency()
+        speed = 1.0 if median is None else min(1.0, self.FAST_LATENCY / max(median, 1e-3))
+        return round(100 * self.success_rate * (0.5 + 0.5 * speed))
+    
+    def to_dict(self, limit: float = 30.0) -> Dict[str, Any]:
+        median = self.median_latency()
+        return {
+            "score": self.score(),
+            "state": self.state,
+            "success_rate": round(self.success_rate, 3),
+            "median_latency_ms": None if median is None else round(median * 1000),
+            "timeout": round(self.timeout(limit), 1),
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_in": max(0, round(self.open_until - time.monotonic())) if self.state == "open" else 0,
+            "last_error": self.last_error,
+        }
 
 
 class Compote:
@@ -551,9 +677,17 @@ class Compote:
         (r'\bdivx\b', 'DivX'),
     ]
     
+    # Search result cache
+    SEARCH_CACHE_SIZE = 500  # cached (indexer, query) result lists
+    EMPTY_RESULT_TTL = 60  # seconds; recheck sooner for releases that are not out yet
+    
     def __init__(self):
         self.indexers: Dict[str, IndexerConfig] = {}
         self._http_client: Optional[httpx.AsyncClient] = None
+        self._search_cache: "OrderedDict[tuple, Tuple[float, List[SearchResult]]]" = OrderedDict()  # key -> (expiry, results)
+        self._inflight: Dict[tuple, asyncio.Future] = {}  # key -> running search
+        self._cache_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+        self._health: Dict[str, IndexerHealth] = {}  # indexer id -> health
     
     async def _get_client(self) -> httpx.AsyncClient:
         """Get or create HTTP client."""
@@ -569,12 +703,16 @@ class Compote:
     def add_indexer(self, config: IndexerConfig) -> None:
         """Add an indexer to the manager."""
         self.indexers[config.id] = config
+        self.clear_search_cache(config.id)
+        self._health.pop(config.id, None)
         logger.info(f"Added indexer: {config.name} ({config.type})")
     
     def remove_indexer(self, indexer_id: str) -> bool:
         """Remove an indexer."""
         if indexer_id in self.indexers:
             del self.indexers[indexer_id]
+            self.clear_search_cache(indexer_id)
+            self._health.pop(indexer_id, None)
             return True
         return False
     
@@ -583,7 +721,7 @@ class Compote:
         return self.indexers.get(indexer_id)
     
     def list_indexers(self) -> List[Dict[str, Any]]:
-        """List all configured indexers."""
+        """List all configured indexers, with their health."""
         return [
             {
                 "id": idx.id,
@@ -592,10 +730,18 @@ class Compote:
                 "url": idx.url,
                 "enabled": idx.enabled,
                 "priority": idx.priority,
+                "health": self.get_health(idx.id).to_dict(idx.timeout),
             }
             for idx in self.indexers.values()
         ]
     
+    def get_health(self, indexer_id: str) -> IndexerHealth:
+        """Health tracking of an indexer (created on first use)."""
+        health = self._health.get(indexer_id)
+        if health is None:
+            health = self._health[indexer_id] = IndexerHealth()
+        return health
+    
     def _parse_quality(self, title: str) -> Dict[str, str]:
         """Extract quality, codec, and source from title."""
         title_lower = title.lower()
@@ -759,11 +905,13 @@ class Compote:
             logger.info(f"Found {len(results)} results from {indexer.name}")
             
         except httpx.HTTPError as e:
-            logger.error(f"HTTP error searching {indexer.name}: {e}")
+            raise IndexerError(f"HTTP error: {e}") from e
         except ET.ParseError as e:
-            logger.error(f"XML parse error from {indexer.name}: {e}")
+            raise IndexerError(f"XML parse error: {e}") from e
+        except IndexerError:
+            raise
         except Exception as e:
-            logger.error(f"Error searching {indexer.name}: {e}")
+            raise IndexerError(f"Search failed: {e}") from e
         
         return results
     
@@ -793,8 +941,7 @@ class Compote:
                 response = await client.get(indexer.url, headers=headers)
             
             if not response or response.status_code != 200:
-                logger.warning(f"Failed to fetch RSS from {indexer.name}")
-                return results
+                raise IndexerError(f"Failed to fetch RSS: HTTP {response.status_code if response else 'None'}")
             
             # Parse RSS/XML
             root = ET.fromstring(response.text)
@@ -889,10 +1036,14 @@ class Compote:
             
             logger.info(f"Found {len(results)} RSS results from {indexer.name} matching '{query}'")
             
+        except httpx.HTTPError as e:
+            raise IndexerError(f"HTTP error: {e}") from e
         except ET.ParseError as e:
-            logger.error(f"RSS parse error from {indexer.name}: {e}")
+            raise IndexerError(f"RSS parse error: {e}") from e
+        except IndexerError:
+            raise
         except Exception as e:
-            logger.error(f"Error fetching RSS from {indexer.name}: {e}")
+            raise IndexerError(f"Search failed: {e}") from e
         
         return results
 
@@ -935,8 +1086,7 @@ class Compote:
                 response = await client.get(full_url, headers=headers)
             
             if not response or response.status_code != 200:
-                logger.warning(f"Failed to search {indexer.name}: HTTP {response.status_code if response else 'None'}")
-                return results
+                raise IndexerError(f"HTTP {response.status_code if response else 'None'}")
             
             # Parse XML response (same as regular torznab)
             root = ET.fromstring(response.text)
@@ -1001,11 +1151,153 @@ class Compote:
             
             logger.info(f"Found {len(results)} results from {indexer.name}")
             
+        except httpx.HTTPError as e:
+            raise IndexerError(f"HTTP error: {e}") from e
+        except ET.ParseError as e:
+            raise IndexerError(f"XML parse error: {e}") from e
+        except IndexerError:
+            raise
         except Exception as e:
-            logger.error(f"Error searching {indexer.name}: {e}")
+            raise IndexerError(f"Search failed: {e}") from e
         
         return results
 
+    def _search_cache_key(
+        self,
+        indexer: IndexerConfig,
+        query: str,
+        categories: List[int],
+        limit: int
+    ) -> tuple:
+        """Cache key of one indexer's results. RSS feeds ignore categories."""
+        cats = () if indexer.type == "rss" else tuple(sorted(set(categories)))
+        return (indexer.id, query.casefold(), cats, limit)
+    
+    async def _search_indexer(
+        self,
+        indexer: IndexerConfig,
+        query: str,
+        categories: List[int],
+        limit: int,
+        refresh: bool = False
+    ) -> List[SearchResult]:
+        """
+        One indexer's results for a query, from the cache while they are fresh.
+        Identical searches running at the same time share a single request.
+        Raises IndexerUnavailable while the indexer's circuit breaker is open.
+        """
+        key = self._search_cache_key(indexer, query, categories, limit)
+        cached = self._search_cache.get(key)
+        if cached and not refresh and cached[0] > time.monotonic():
+            self._search_cache.move_to_end(key)
+            self._cache_stats["hits"] += 1
+            return cached[1]
+        
+        task = self._inflight.get(key)
+        if task is None:
+            health = self.get_health(indexer.id)
+            if not health.allow():
+                raise IndexerUnavailable(f"{indexer.name} is skipped after repeated failures")
+            probe = health.state == "half_open"  # allow() gave us the one probe slot
+            self._cache_stats["misses"] += 1
+            task = asyncio.ensure_future(
+                self._fetch_indexer(key, indexer, query, categories, limit, health.timeout(indexer.timeout))
+            )
+            # Callers log failures; the task may outlive all of them
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            if probe:
+                # Also runs if the request is cancelled before it starts
+                task.add_done_callback(lambda t: health.release_probe())
+            self._inflight[key] = task
+        else:
+            self._cache_stats["coalesced"] += 1
+        # Shielded so that one caller giving up does not cancel it for the others
+        return await asyncio.shield(task)
+    
+    async def _fetch_indexer(
+        self,
+        key: tuple,
+        indexer: IndexerConfig,
+        query: str,
+        categories: List[int],
+        limit: int,
+        timeout: float
+    ) -> List[SearchResult]:
+        """
+        Search one indexer within timeout (covering retries and backoff),
+        record the outcome in its health and cache the results for its
+        cache_ttl. Failures raise IndexerError and are not cached.
+        """
+        health = self.get_health(indexer.id)
+        started = time.monotonic()
+        try:
+            if indexer.type == "rss":
+                request = self._search_rss(indexer, query, limit)
+            elif indexer.cloudflare_protected:
+                request = self._search_torznab_with_cf(indexer, query, categories, limit)
+            else:
+                request = self._search_torznab(indexer, query, categories, limit)
+            results = await asyncio.wait_for(request, timeout)
+        except Exception as e:
+            error = f"Timed out after {timeout:.1f}s" if isinstance(e, asyncio.TimeoutError) else str(e)
+            logger.error(f"Error searching {indexer.name}: {error}")
+            if health.record_failure(error):
+                logger.warning(
+                    f"{indexer.name} failed {health.consecutive_failures} times in a row, "
+                    f"skipping it for {health.cooldown:.0f}s"
+                )
+            if isinstance(e, IndexerError):
+                raise
+            raise IndexerError(error) from e
+        finally:
+            self._inflight.pop(key, None)
+        health.record_success(time.monotonic() - started)
+        
+        ttl = indexer.cache_ttl if results else min(indexer.cache_ttl, self.EMPTY_RESULT_TTL)
+        # Skip indexers removed or replaced while the request was running
+        if ttl > 0 and self.indexers.get(indexer.id) is indexer:
+            self._search_cache[key] = (time.monotonic() + ttl, results)
+            self._search_cache.move_to_end(key)
+            while len(self._search_cache) > self.SEARCH_CACHE_SIZE:
+                self._search_cache.popitem(last=False)
+        return results
+    
+    def clear_search_cache(self, indexer_id: Optional[str] = None) -> int:
+        """Drop cached results (of one indexer, or all). Returns the number dropped."""
+        if indexer_id is None:
+            count = len(self._search_cache)
+            self._search_cache.clear()
+            return count
+        keys = [key for key in self._search_cache if key[0] == indexer_id]
+        for key in keys:
+            del self._search_cache[key]
+        return len(keys)
+    
+    def search_cache_stats(self) -> Dict[str, int]:
+        """Cache hits, misses (requests made), coalesced searches and cache size."""
+        return {**self._cache_stats, "entries": len(self._search_cache), "in_flight": len(self._inflight)}
+    
+    def _active_indexers(self, indexer_ids: Optional[List[str]] = None) -> List[IndexerConfig]:
+        """Enabled indexers to search - only those with valid URLs (not test URLs)."""
+        return [
+            idx for idx in self.indexers.values()
+            if idx.enabled 
+            and (indexer_ids is None or idx.id in indexer_ids)
+            and idx.url
+            and not idx.url.startswith("http://test")
+            and "example.com" not in idx.url
+        ]
+    
+    @staticmethod
+    def _sort_results(results: List[SearchResult], sort_by: str) -> None:
+        """Sort results in place by seeders, size or date (newest first)."""
+        if sort_by == "seeders":
+            results.sort(key=lambda x: x.seeders, reverse=True)
+        elif sort_by == "size":
+            results.sort(key=lambda x: x.size, reverse=True)
+        elif sort_by == "date":
+            results.sort(key=lambda x: x.pub_date, reverse=True)
+    
     async def search(
         self,
         query: str,
@@ -1013,11 +1305,16 @@ class Compote:
         categories: Optional[List[int]] = None,
         indexer_ids: Optional[List[str]] = None,
         limit_per_indexer: int = 50,
-        sort_by: str = "seeders"
+        sort_by: str = "seeders",
+        refresh: bool = False
     ) -> List[Dict[str, Any]]:
         """
         Search across all enabled indexers.
         
+        Each indexer's results are cached for its cache_ttl, keyed by the
+        normalised query, categories and limit, so repeated searches only
+        query indexers whose results have expired.
+        
         Args:
             query: Search query string
             media_type: Type of media (movies, tv, audio, etc.)
@@ -1025,23 +1322,18 @@ class Compote:
             indexer_ids: Specific indexer IDs to search (None = all enabled)
             limit_per_indexer: Max results per indexer
             sort_by: Sort results by (seeders, size, date)
+            refresh: Ignore cached results and query every indexer again
         
         Returns:
             List of search results sorted by specified criteria
         """
+        query = " ".join(query.split())
+        
         # Determine categories
         if categories is None:
             categories = self.CATEGORIES.get(media_type, [])
         
-        # Filter indexers - only use indexers with valid URLs (not test URLs)
-        active_indexers = [
-            idx for idx in self.indexers.values()
-            if idx.enabled 
-            and (indexer_ids is None or idx.id in indexer_ids)
-            and idx.url
-            and not idx.url.startswith("http://test")
-            and "example.com" not in idx.url
-        ]
+        active_indexers = self._active_indexers(indexer_ids)
         
         all_results = []
         
@@ -1051,42 +1343,117 @@ class Compote:
             all_results = self._generate_demo_results(query, media_type)
         else:
             # Search all indexers concurrently
-            tasks = []
-            for indexer in active_indexers:
-                if indexer.type in ["torznab", "newznab"]:
-                    if indexer.cloudflare_protected:
-                        tasks.append(
-                            self._search_torznab_with_cf(indexer, query, categories, limit_per_indexer)
-                        )
-                    else:
-                        tasks.append(
-                            self._search_torznab(indexer, query, categories, limit_per_indexer)
-                        )
-                elif indexer.type == "rss":
-                    tasks.append(
-                        self._search_rss(indexer, query, limit_per_indexer)
-                    )
+            tasks = [
+                self._search_indexer(indexer, query, categories, limit_per_indexer, refresh)
+                for indexer in active_indexers
+                if indexer.type in ["torznab", "newznab", "rss"]
+            ]
             
             # Gather results
             results_list = await asyncio.gather(*tasks, return_exceptions=True)
             
             for results in results_list:
+                if isinstance(results, IndexerError):
+                    continue  # logged where it happened
                 if isinstance(results, Exception):
                     logger.error(f"Search task failed: {results}")
                 else:
                     all_results.extend(results)
         
-        # Sort results
-        if sort_by == "seeders":
-            all_results.sort(key=lambda x: x.seeders, reverse=True)
-        elif sort_by == "size":
-            all_results.sort(key=lambda x: x.size, reverse=True)
-        elif sort_by == "date":
-            all_results.sort(key=lambda x: x.pub_date, reverse=True)
+        self._sort_results(all_results, sort_by)
         
         # Convert to dicts
         return [r.to_dict() for r in all_results]
     
+    async def search_stream(
+        self,
+        query: str,
+        media_type: str = "movies",
+        categories: Optional[List[int]] = None,
+        indexer_ids: Optional[List[str]] = None,
+        limit_per_indexer: int = 50,
+        sort_by: str = "seeders",
+        deadline: float = 10.0,
+        refresh: bool = False
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Search like search(), yielding each indexer's results as they arrive.
+        
+        Yields a "results" event per indexer that answered:
+            {"event": "results", "indexer": id, "name": name, "results": [...]}
+        then one "done" event once all have answered or the deadline passed:
+            {"event": "done", "total": n, "completed": [ids], "failed": [ids],
+             "skipped": [ids], "timed_out": [ids], "elapsed": seconds}
+        
+        Skipped indexers are those whose circuit breaker is open.
+        
+        Indexers still running at the deadline are left out of this search,
+        but their requests finish in the background and are cached, so the
+        next search for the same query includes them.
+        """
+        started = time.monotonic()
+        query = " ".join(query.split())
+        if categories is None:
+            categories = self.CATEGORIES.get(media_type, [])
+        
+        active_indexers = self._active_indexers(indexer_ids)
+        done = {"event": "done", "total": 0, "completed": [], "failed": [], "skipped": [], "timed_out": []}
+        
+        if not active_indexers:
+            logger.info("No valid indexers configured, using demo results")
+            results = self._generate_demo_results(query, media_type)
+            self._sort_results(results, sort_by)
+            yield {"event": "results", "indexer": "demo", "name": "Demo", "results": [r.to_dict() for r in results]}
+            done["total"] = len(results)
+            done["elapsed"] = round(time.monotonic() - started, 3)
+            yield done
+            return
+        
+        pending = {
+            asyncio.ensure_future(
+                self._search_indexer(indexer, query, categories, limit_per_indexer, refresh)
+            ): indexer
+            for indexer in active_indexers
+            if indexer.type in ["torznab", "newznab", "rss"]
+        }
+        try:
+            while pending:
+                remaining = deadline - (time.monotonic() - started)
+                if remaining <= 0:
+                    break
+                finished, _ = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    indexer = pending.pop(task)
+                    try:
+                        results = list(task.result())
+                    except IndexerUnavailable:
+                        done["skipped"].append(indexer.id)
+                        continue
+                    except Exception as e:
+                        if not isinstance(e, IndexerError):
+                            logger.error(f"Search task failed: {e}")
+                        done["failed"].append(indexer.id)
+                        continue
+                    self._sort_results(results, sort_by)
+                    done["completed"].append(indexer.id)
+                    done["total"] += len(results)
+                    yield {
+                        "event": "results",
+                        "indexer": indexer.id,
+                        "name": indexer.name,
+                        "results": [r.to_dict() for r in results],
+                    }
+        finally:
+            # Only our waits are cancelled; the shared requests carry on
+            for task in pending:
+                task.cancel()
+        
+        done["timed_out"] = [indexer.id for indexer in pending.values()]
+        if done["timed_out"]:
+            logger.info(f"Search deadline reached, still waiting on: {', '.join(done['timed_out'])}")
+        done["elapsed"] = round(time.monotonic() - started, 3)
+        yield done
+    
     async def test_indexer(self, indexer_id: str) -> Dict[str, Any]:
         """Test connectivity to an indexer."""
         indexer = self.indexers.get(indexer_id)
@@ -1358,6 +1725,12 @@ INDEXER_SETUP_GUIDE = {
 }
 
 
+def to_sse(event: Dict[str, Any]) -> str:
+    """Format a search_stream event as a server-sent event."""
+    data = {k: v for k, v in event.items() if k != "event"}
+    return f"event: {event['event']}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
 # Singleton instance
 compote_manager = Compote()
 
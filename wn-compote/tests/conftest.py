@@ -0,0 +1,92 @@
+"""Fixtures for the Compote tests: stub Torznab indexers served over local HTTP."""
+
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from wn_compote.compote import Compote, IndexerConfig
+
+FEED = """<?xml version="1.0"?>
+<rss xmlns:torznab="http://torznab.com/schemas/2015/feed"><channel>
+<item><title>Heat.1995.1080p.BluRay.x264</title><enclosure url="http://x/1.torrent" length="{length}"/>
+<torznab:attr name="seeders" value="12"/></item>
+</channel></rss>"""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        name = url.path.split("/")[1]
+        query = parse_qs(url.query).get("q", [""])[0]
+        self.server.requests.append(name)
+        behaviour = self.server.behaviour.get(query) or self.server.behaviour.get(name, {})
+        time.sleep(behaviour.get("delay", 0))
+        data = FEED.format(length=behaviour.get("length", "1000")).encode()
+        self.send_response(behaviour.get("status", 200))
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubIndexers(ThreadingHTTPServer):
+    """
+    Serves FEED at /<indexer>/api. behaviour[query], or else
+    behaviour[indexer], sets the delay, status and enclosure length of a reply.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.requests = []  # indexer names, in order
+        self.behaviour = {}
+
+    def compote(self, *names) -> Compote:
+        """A Compote with one Torznab indexer per name, all served here."""
+        compote = Compote()
+        for name in names:
+            compote.add_indexer(IndexerConfig(
+                id=name, name=name.title(), type="torznab",
+                url=f"http://127.0.0.1:{self.server_address[1]}/{name}",
+            ))
+        return compote
+
+
+@pytest.fixture
+def indexers():
+    httpd = StubIndexers()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine on a new loop and close the Compote's client before the loop goes."""
+    def run(compote: Compote, coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await compote.close()
+
+        return asyncio.run(main())
+
+    return run
+
+
+@pytest.fixture
+def stream():
+    """Collect the events of a streamed search."""
+    async def stream(compote: Compote, query: str, **kwargs):
+        return [event async for event in compote.search_stream(query, **kwargs)]
+
+    return stream
@@ -0,0 +1,45 @@
+"""Compote per-indexer result cache and coalescing of identical searches."""
+
+import asyncio
+
+
+def test_repeated_searches_are_served_from_the_cache(indexers, run):
+    compote = indexers.compote("one")
+
+    async def searches():
+        first = await compote.search("Heat 1995")
+        again = await compote.search("  heat   1995 ")
+        refreshed = await compote.search("Heat 1995", refresh=True)
+        return first, again, refreshed
+
+    first, again, refreshed = run(compote, searches())
+    assert [r["title"] for r in first] == ["Heat.1995.1080p.BluRay.x264"]
+    assert again == first and refreshed == first
+    assert indexers.requests == ["one", "one"]
+    assert compote.search_cache_stats()["hits"] == 1
+
+
+def test_changing_an_indexer_drops_its_cached_results(indexers, run):
+    compote = indexers.compote("one")
+
+    async def searches():
+        await compote.search("Heat")
+        compote.add_indexer(compote.get_indexer("one"))
+        await compote.search("Heat")
+
+    run(compote, searches())
+    assert indexers.requests == ["one", "one"]
+
+
+def test_concurrent_identical_searches_share_one_request(indexers, run):
+    indexers.behaviour["one"] = {"delay": 0.2}
+    compote = indexers.compote("one")
+
+    async def searches():
+        return await asyncio.gather(*(compote.search("Heat") for _ in range(3)))
+
+    results = run(compote, searches())
+    assert all(len(r) == 1 for r in results)
+    assert indexers.requests == ["one"]
+    stats = compote.search_cache_stats()
+    assert (stats["misses"], stats["coalesced"], stats["in_flight"]) == (1, 2, 0)
@@ -0,0 +1,100 @@
+"""Compote indexer health and circuit breaker."""
+
+import asyncio
+
+import pytest
+
+from wn_compote.compote import IndexerError, IndexerHealth, IndexerUnavailable
+
+
+def test_breaker_opens_after_repeated_failures_and_closes_on_success(indexers, run, stream):
+    indexers.behaviour["down"] = {"status": 500}
+    compote = indexers.compote("down")
+    health = compote.get_health("down")
+
+    async def searches():
+        events = []
+        for i in range(IndexerHealth.FAILURE_THRESHOLD + 1):
+            events.append(await stream(compote, f"Heat {i}"))
+        return events
+
+    events = run(compote, searches())
+    assert [e[-1]["failed"] for e in events[:-1]] == [["down"]] * IndexerHealth.FAILURE_THRESHOLD
+    assert events[-1][-1]["skipped"] == ["down"]
+    assert len(indexers.requests) == IndexerHealth.FAILURE_THRESHOLD
+    assert health.state == "open" and health.score() == 0
+
+    # Cooldown over: one probe goes through and closes the breaker
+    indexers.behaviour["down"] = {}
+    health.open_until = 0
+    events = run(compote, stream(compote, "Heat"))
+    assert events[-1]["completed"] == ["down"]
+    assert health.state == "closed" and health.cooldown == IndexerHealth.BASE_COOLDOWN
+
+
+def test_unexpected_errors_are_reported_as_indexer_failures(indexers, run, stream):
+    indexers.behaviour["bad"] = {"length": "unknown"}
+    compote = indexers.compote("bad")
+
+    async def search():
+        with pytest.raises(IndexerError):
+            await compote._search_torznab(compote.get_indexer("bad"), "Heat", [], 50)
+        return await stream(compote, "Heat")
+
+    events = run(compote, search())
+    assert events[-1]["failed"] == ["bad"]
+    assert compote.get_health("bad").failures == 1
+
+
+def test_failed_probe_reopens_with_a_longer_cooldown():
+    health = IndexerHealth()
+    for _ in range(IndexerHealth.FAILURE_THRESHOLD):
+        health.record_failure("boom")
+    health.open_until = 0
+    assert health.allow() and health.state == "half_open"
+    assert not health.allow()  # one probe at a time
+    assert health.record_failure("boom")
+    assert health.state == "open" and health.cooldown == 2 * IndexerHealth.BASE_COOLDOWN
+
+
+def test_cancelled_probe_lets_the_next_one_through(indexers, run):
+    indexers.behaviour["one"] = {"delay": 0.5}
+    compote = indexers.compote("one")
+    health = compote.get_health("one")
+    health.state, health.open_until = "open", 0
+
+    async def probe():
+        search = asyncio.ensure_future(compote._search_indexer(compote.get_indexer("one"), "Heat", [], 50))
+        await asyncio.sleep(0.1)
+        for task in list(compote._inflight.values()):
+            task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await search
+        return health.allow()
+
+    assert run(compote, probe())
+    assert health.state == "half_open"
+
+
+def test_only_the_probe_releases_the_probe_slot(indexers, run):
+    indexers.behaviour["earlier"] = {"delay": 0.2, "status": 500}
+    indexers.behaviour["probe"] = {"delay": 0.6}
+    compote = indexers.compote("one")
+    indexer = compote.get_indexer("one")
+    health = compote.get_health("one")
+
+    async def searches():
+        earlier = asyncio.ensure_future(compote._search_indexer(indexer, "earlier", [], 50))
+        await asyncio.sleep(0.05)
+        health.state, health.open_until = "open", 0
+        probe = asyncio.ensure_future(compote._search_indexer(indexer, "probe", [], 50))
+        with pytest.raises(IndexerError):
+            await earlier
+        health.open_until = 0  # cooldown over again while the probe is still out
+        with pytest.raises(IndexerUnavailable):
+            await compote._search_indexer(indexer, "another", [], 50)
+        await probe
+        return health.allow()
+
+    assert run(compote, searches())
+    assert health.state == "closed"
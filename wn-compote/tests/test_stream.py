@@ -0,0 +1,22 @@
+"""Compote streamed search with a deadline."""
+
+import asyncio
+
+
+def test_stream_deadline_leaves_slow_indexers_to_finish_in_the_background(indexers, run, stream):
+    indexers.behaviour["slow"] = {"delay": 0.5}
+    compote = indexers.compote("fast", "slow")
+
+    async def searches():
+        first = await stream(compote, "Heat", deadline=0.2)
+        await asyncio.sleep(0.6)
+        second = await stream(compote, "Heat", deadline=0.2)
+        return first, second
+
+    first, second = run(compote, searches())
+    assert [e["indexer"] for e in first[:-1]] == ["fast"]
+    assert first[-1]["timed_out"] == ["slow"] and first[-1]["total"] == 1
+    assert sorted(e["indexer"] for e in second[:-1]) == ["fast", "slow"]
+    assert second[-1]["timed_out"] == [] and second[-1]["total"] == 2
+    assert sorted(indexers.requests) == ["fast", "slow"]
+
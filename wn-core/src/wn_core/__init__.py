@@ -6,11 +6,13 @@ from .config import Config, load_config
 from .database import get_database, DatabaseManager
 from .auth import create_token, verify_token, require_auth
 from .utils import format_size, format_duration, sanitize_filename
+from .probe import ProbeCache, probe_file, probe_file_async, get_probe_cache
 
 __version__ = "1.0.0"
 __all__ = [
     "Config", "load_config",
     "get_database", "DatabaseManager", 
     "create_token", "verify_token", "require_auth",
-    "format_size", "format_duration", "sanitize_filename"
+    "format_size", "format_duration", "sanitize_filename",
+    "ProbeCache", "probe_file", "probe_file_async", "get_probe_cache"
 ]
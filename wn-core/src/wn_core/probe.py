@@ -0,0 +1,227 @@
+"""Shared, persistent ffprobe result cache"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+import subprocess
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Every module probes with the same arguments so cached output is interchangeable
+PROBE_ARGS = [
+    '-v', 'quiet',
+    '-print_format', 'json',
+    '-show_format',
+    '-show_streams',
+    '-show_chapters',
+    '-show_error',
+]
+
+# Bump whenever PROBE_ARGS change, so entries probed with other arguments are dropped
+PROBE_VERSION = 2
+
+FileKey = Tuple[int, int, int, int]
+
+
+def file_key(path: str) -> Optional[FileKey]:
+    """Identity of a file's current contents: (device, inode, size, mtime_ns)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class ProbeCache:
+    """
+    Raw ffprobe JSON keyed by file identity, stored in SQLite.
+    A renamed file keeps its entry; a rewritten one gets a new key.
+    Least recently used entries are evicted beyond max_entries. Hits are
+    noted in memory and their last-used times written in batches, so a
+    lookup is a single read.
+    """
+
+    USED_BATCH = 1000  # hits noted before their last-used times are written
+
+    def __init__(self, db_path: str, max_entries: int = 500_000):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._used: Dict[FileKey, float] = {}  # hits whose last_used is not written yet
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "data TEXT NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_probes_last_used ON probes (last_used)")
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != PROBE_VERSION:
+            if version:
+                logger.info(f"Probe arguments changed, clearing {self.db_path}")
+            self._conn.execute("DELETE FROM probes")
+            self._conn.execute(f"PRAGMA user_version = {PROBE_VERSION}")
+        self._conn.commit()
+
+    def get(self, path: str, key: Optional[FileKey] = None) -> Optional[Dict[str, Any]]:
+        key = key or file_key(path)
+        if key is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM probes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?", key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._used[key] = time.time()
+            if len(self._used) >= self.USED_BATCH:
+                self._write_used()
+                self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, path: str, data: Dict[str, Any], key: Optional[FileKey] = None):
+        key = key or file_key(path)
+        if key is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO probes (dev, ino, size, mtime_ns, data, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, json.dumps(data, separators=(',', ':')), time.time())
+            )
+            self._puts += 1
+            if self._puts % 1000 == 0:
+                self._write_used()
+                self._evict()
+            self._conn.commit()
+
+    def _write_used(self):
+        if self._used:
+            self._conn.executemany(
+                "UPDATE probes SET last_used = ? WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                [(used, *key) for key, used in self._used.items()]
+            )
+            self._used.clear()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM probes WHERE rowid IN "
+                "(SELECT rowid FROM probes ORDER BY last_used LIMIT ?)", (excess,)
+            )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._write_used()
+            self._conn.commit()
+            self._conn.close()
+
+
+def probe_file(
+    path: str,
+    ffprobe_path: str = "ffprobe",
+    cache: Optional[ProbeCache] = None,
+    timeout: float = 60,
+) -> Optional[Dict[str, Any]]:
+    """Run ffprobe on a file, using the cache when given. None if probing fails."""
+    key = file_key(path)
+    if cache and key:
+        data = cache.get(path, key)
+        if data is not None:
+            return data
+
+    try:
+        result = subprocess.run(
+            [ffprobe_path, *PROBE_ARGS, path],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+        if result.returncode != 0:
+            logger.error(f"FFprobe error: {result.stderr or result.stdout}")
+            return None
+        data = json.loads(result.stdout)
+    except Exception as e:
+        logger.error(f"FFprobe failed for {path}: {e}")
+        return None
+
+    if cache and key:
+        cache.put(path, data, key)
+    return data
+
+
+async def probe_file_async(
+    path: str,
+    ffprobe_path: str = "ffprobe",
+    cache: Optional[ProbeCache] = None,
+    timeout: float = 30,
+    executor: Optional[Executor] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Async variant of probe_file that does not block the event loop.
+    The stat and cache reads and writes run on executor (the loop's default when None).
+    """
+    loop = asyncio.get_running_loop()
+    key = await loop.run_in_executor(executor, file_key, path)
+    if cache and key:
+        data = await loop.run_in_executor(executor, cache.get, path, key)
+        if data is not None:
+            return data
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            ffprobe_path, *PROBE_ARGS, path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            logger.warning(f"FFprobe timed out: {path}")
+            return None
+        if proc.returncode != 0:
+            return None
+        data = json.loads(stdout)
+    except Exception as e:
+        logger.error(f"FFprobe failed for {path}: {e}")
+        return None
+
+    if cache and key:
+        await loop.run_in_executor(executor, cache.put, path, data, key)
+    return data
+
+
+_probe_cache: Optional[ProbeCache] = None
+
+
+def get_probe_cache() -> ProbeCache:
+    """Get the process-wide probe cache (location from WN_PROBE_CACHE)"""
+    global _probe_cache
+    if _probe_cache is None:
+        default = os.path.join(os.path.expanduser("~"), ".cache", "watchnexus", "probe_cache.db")
+        _probe_cache = ProbeCache(os.environ.get("WN_PROBE_CACHE", default))
+    return _probe_cache
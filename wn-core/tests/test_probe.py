@@ -0,0 +1,112 @@
+"""ProbeCache keys, hits and misses, and probe_file's use of it."""
+
+import os
+import json
+import sqlite3
+
+import pytest
+
+from wn_core.probe import PROBE_VERSION, ProbeCache, file_key, probe_file
+
+PROBE = {"format": {"duration": "60"}, "streams": []}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def media(tmp_path):
+    path = tmp_path / "a.mkv"
+    path.write_bytes(b"\0" * 100)
+    os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+    return path
+
+
+@pytest.fixture
+def ffprobe(tmp_path):
+    """A stand-in ffprobe that prints PROBE and counts its runs."""
+    script = tmp_path / "ffprobe"
+    script.write_text(f"#!/bin/sh\necho run >> {tmp_path / 'runs'}\necho '{json.dumps(PROBE)}'\n")
+    script.chmod(0o755)
+    return script
+
+
+def runs(tmp_path) -> int:
+    path = tmp_path / "runs"
+    return len(path.read_text().splitlines()) if path.exists() else 0
+
+
+def test_hit(cache, media):
+    assert cache.get(str(media)) is None
+    cache.put(str(media), PROBE)
+    assert cache.get(str(media)) == PROBE
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.stats()["entries"] == 1
+
+
+def test_renamed_file_keeps_its_entry(cache, media):
+    cache.put(str(media), PROBE)
+    renamed = media.with_name("b.mkv")
+    media.rename(renamed)
+    assert cache.get(str(renamed)) == PROBE
+
+
+def test_size_change_misses(cache, media):
+    cache.put(str(media), PROBE)
+    with open(media, "ab") as f:
+        f.write(b"\0")
+    os.utime(media, ns=(1_000_000_000, 1_000_000_000))
+    assert cache.get(str(media)) is None
+
+
+def test_mtime_change_misses(cache, media):
+    cache.put(str(media), PROBE)
+    os.utime(media, ns=(1_000_000_000, 1_000_000_001))
+    assert cache.get(str(media)) is None
+
+
+def test_replaced_file_is_probed_again(cache, media, ffprobe, tmp_path):
+    assert probe_file(str(media), str(ffprobe), cache) == PROBE
+    assert probe_file(str(media), str(ffprobe), cache) == PROBE
+    assert runs(tmp_path) == 1
+
+    # Same path, size and mtime, but a different file
+    replacement = tmp_path / "new.mkv"
+    replacement.write_bytes(b"\1" * 100)
+    os.utime(replacement, ns=(1_000_000_000, 1_000_000_000))
+    old_key = file_key(str(media))
+    os.replace(replacement, media)
+    assert file_key(str(media))[2:] == old_key[2:] and file_key(str(media)) != old_key
+
+    assert probe_file(str(media), str(ffprobe), cache) == PROBE
+    assert runs(tmp_path) == 2
+
+
+def test_hits_write_last_used_in_batches(tmp_path, media):
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    cache.put(str(media), PROBE)
+    last_used = lambda: sqlite3.connect(str(tmp_path / "probe.db")).execute(  # noqa: E731
+        "SELECT last_used FROM probes").fetchone()[0]
+    stored = last_used()
+    cache.get(str(media))
+    assert last_used() == stored
+    cache.close()
+    assert last_used() > stored
+
+
+def test_entries_probed_with_other_arguments_are_dropped(tmp_path, media):
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    cache.put(str(media), PROBE)
+    cache.close()
+    conn = sqlite3.connect(str(tmp_path / "probe.db"))
+    conn.execute(f"PRAGMA user_version = {PROBE_VERSION - 1}")
+    conn.commit()
+    conn.close()
+
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    assert cache.get(str(media)) is None
+    cache.close()
@@ -0,0 +1,151 @@
+"""
+Read latency under a running scan.
+
+Builds a catalogue of synthetic entries plus a directory of new files,
+then issues a steady stream of reads (search, listing, stream URL, watch
+progress) from the event loop while a scan of the new files runs. Reports
+latency percentiles with the scan idle and running, once calling
+MarmaladeServer directly on the loop and once through
+AsyncMarmaladeServer.
+
+    python benchmarks/bench_async.py [catalogue size] [files to scan]
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from wn_core import ProbeCache  # noqa: E402
+from wn_marmalade.server import MarmaladeServer, MediaFile, MediaType  # noqa: E402
+from wn_marmalade.aio import AsyncMarmaladeServer  # noqa: E402
+
+FAKE_FFPROBE = """#!/bin/sh
+echo '{"format":{"duration":"1500","bit_rate":"8000000"},"streams":[{"codec_type":"video","codec_name":"h264","width":1920,"height":1080},{"codec_type":"audio","codec_name":"aac"}]}'
+"""
+
+WORDS = ["the", "night", "river", "empire", "last", "house", "star", "city", "dark", "blue"]
+READ_INTERVAL = 0.002  # seconds between reads
+
+
+def build(root: Path, catalogue: int, new_files: int) -> Path:
+    probe = root / "ffprobe"
+    probe.write_text(FAKE_FFPROBE)
+    probe.chmod(0o755)
+
+    media_dir = root / "media"
+    for i in range(new_files):
+        folder = media_dir / f"Show {i // 200}" / f"Season {i // 20 % 10 + 1}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"Show.{i // 200}.S{i // 20 % 10 + 1:02d}E{i % 20 + 1:02d}.mkv").write_bytes(b"\0")
+
+    server = MarmaladeServer(data_dir=str(root / "data"), probe_cache=ProbeCache(str(root / "probe.db")))
+    rng = random.Random(3)
+    entries = []
+    for i in range(catalogue):
+        title = " ".join(rng.choice(WORDS) for _ in range(3)).title()
+        path = str(root / "old" / f"{title}.{i}.mkv")
+        entries.append(MediaFile(
+            id=f"m{i}", path=path, filename=os.path.basename(path), media_type=MediaType.MOVIE,
+            title=title, size=1, duration=6000, added_date=f"2024-01-01T00:00:{i % 60:02d}", library_id="old",
+        ))
+    server._media_files = {}
+    for media in entries:
+        server._put_media_entry(media)
+    server._save_media(entries)
+    server.close()
+    return media_dir
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000  # noqa: E731
+    return f"p50 {pick(0.5):7.2f} ms   p99 {pick(0.99):7.2f} ms   max {samples[-1] * 1000:7.2f} ms   n={len(samples)}"
+
+
+async def reads(api, ids, until: asyncio.Event, samples):
+    """Issue a mixed read every READ_INTERVAL and record how long each takes."""
+    rng = random.Random(5)
+    while not until.is_set():
+        kind = rng.randrange(4)
+        start = time.perf_counter()
+        if kind == 0:
+            result = api.search_media(rng.choice(WORDS), 20)
+        elif kind == 1:
+            result = api.get_all_media(offset=rng.randrange(1000), limit=50)
+        elif kind == 2:
+            result = api.get_stream_url(rng.choice(ids))
+        else:
+            result = api.update_watch_progress(rng.choice(ids), rng.random() * 3000)
+        if asyncio.iscoroutine(result):
+            await result
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(READ_INTERVAL)
+
+
+async def heartbeat(until: asyncio.Event, samples):
+    """Record how late the loop wakes a 1 ms timer: time it spent blocked."""
+    while not until.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        samples.append(max(0.0, time.perf_counter() - start - 0.001))
+
+
+async def sample(api, ids, work=None, seconds: float = 2.0):
+    """Run readers and the heartbeat until work completes (or for seconds)."""
+    read_times, lag = [], []
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(reads(api, ids, stop, read_times)), asyncio.create_task(heartbeat(stop, lag))]
+    result = await work if work is not None else await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    return result, read_times, lag
+
+
+async def measure(name: str, root: Path, media_dir: Path, wrap: bool):
+    server = MarmaladeServer(
+        data_dir=str(root / "data"),
+        ffprobe_path=str(root / "ffprobe"),
+        probe_cache=ProbeCache(str(root / "probe.db")),
+        probe_concurrency=8,
+    )
+    api = AsyncMarmaladeServer(server) if wrap else server
+    if wrap:
+        await api.ready()
+    ids = list(server.media_files)[:5000]
+    library = server.add_library("Bench", str(media_dir), "tv")
+
+    _, idle_reads, idle_lag = await sample(api, ids)
+    started = time.perf_counter()
+    scan = api.scan_library(library.id) if wrap else server.scan_library(library.id)
+    result, busy_reads, busy_lag = await sample(api, ids, scan)
+    elapsed = time.perf_counter() - started
+
+    print(f"{name}: scanned {result.get('new')} files in {elapsed:.1f} s")
+    print(f"  reads, idle     {percentiles(idle_reads)}")
+    print(f"  reads, scanning {percentiles(busy_reads)}")
+    print(f"  loop lag, idle     {percentiles(idle_lag)}")
+    print(f"  loop lag, scanning {percentiles(busy_lag)}")
+    if wrap:
+        await api.close()
+    else:
+        server.close()
+
+
+async def main():
+    catalogue = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    new_files = int(sys.argv[2]) if len(sys.argv) > 2 else 2_000
+    for name, wrap in (("MarmaladeServer", False), ("AsyncMarmaladeServer", True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            media_dir = build(root, catalogue, new_files)
+            await measure(name, root, media_dir, wrap)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+"""
+Memory benchmark for the Marmalade catalogue layout.
+
+Builds the same synthetic catalogue with the original plain-dataclass
+MediaFile layout and with the current slotted/interned one, and reports
+the memory retained by each.
+
+    python benchmarks/bench_memory.py [count]
+"""
+
+import gc
+import sys
+import random
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from wn_marmalade.server import MediaFile, MediaType  # noqa: E402
+
+
+@dataclass
+class LegacyMediaFile:
+    """MediaFile as it was laid out before slots and interning."""
+    id: str
+    path: str
+    filename: str
+    media_type: MediaType
+    title: str
+    size: int
+    duration: float = 0
+    width: int = 0
+    height: int = 0
+    codec_video: str = ""
+    codec_audio: str = ""
+    container: str = ""
+    bitrate: int = 0
+    added_date: str = ""
+    modified_date: str = ""
+    tmdb_id: Optional[int] = None
+    imdb_id: Optional[str] = None
+    overview: str = ""
+    poster_url: str = ""
+    backdrop_url: str = ""
+    year: Optional[int] = None
+    rating: float = 0.0
+    genres: List[str] = field(default_factory=list)
+    series_name: str = ""
+    season_number: Optional[int] = None
+    episode_number: Optional[int] = None
+    watched: bool = False
+    watch_progress: float = 0
+    last_watched: Optional[str] = None
+
+
+def synthetic_rows(count: int):
+    """Episode-like rows, with strings rebuilt per row as JSON decoding would."""
+    rng = random.Random(42)
+    shows = [f"Show Number {i}" for i in range(max(1, count // 200))]
+    codecs = ["h264", "hevc", "av1"]
+    for i in range(count):
+        show = rng.choice(shows)
+        season, episode = rng.randint(1, 10), rng.randint(1, 24)
+        name = f"{show}.S{season:02d}E{episode:02d}.1080p.mkv"
+        yield {
+            "id": f"{i:016x}",
+            "path": f"/media/tv/{show}/Season {season}/{name}",
+            "filename": name,
+            "media_type": "episode",
+            "title": f"{show} S{season:02d}E{episode:02d}",
+            "size": rng.randint(10 ** 8, 10 ** 10),
+            "duration": rng.uniform(1200, 3600),
+            "width": 1920,
+            "height": 1080,
+            "codec_video": "".join(rng.choice(codecs)),
+            "codec_audio": "".join(["a", "a", "c"]),
+            "container": "".join(["m", "k", "v"]),
+            "bitrate": rng.randint(10 ** 6, 10 ** 7),
+            "added_date": f"2024-01-{rng.randint(1, 28):02d}T12:00:00.000000+00:00",
+            "modified_date": f"2023-12-{rng.randint(1, 28):02d}T12:00:00+00:00",
+            "genres": ["".join("Drama"), "".join("Comedy")],
+            "series_name": "".join(show),
+            "season_number": season,
+            "episode_number": episode,
+        }
+
+
+def measure(build, count: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    catalogue = build(count)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(catalogue) == count
+    del catalogue
+    return current
+
+
+def build_legacy(count: int):
+    catalogue = {}
+    for row in synthetic_rows(count):
+        row["media_type"] = MediaType(row["media_type"])
+        catalogue[row["id"]] = LegacyMediaFile(**row)
+    return catalogue
+
+
+def build_current(count: int):
+    catalogue = {}
+    for row in synthetic_rows(count):
+        media = MediaFile.from_dict(row)
+        catalogue[media.id] = media
+    return catalogue
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    legacy = measure(build_legacy, count)
+    current = measure(build_current, count)
+    print(f"{count} entries")
+    print(f"  legacy dataclass : {legacy / 2 ** 20:8.1f} MiB ({legacy / count:6.0f} B/entry)")
+    print(f"  slotted/interned : {current / 2 ** 20:8.1f} MiB ({current / count:6.0f} B/entry)")
+    print(f"  saved            : {(1 - current / legacy) * 100:8.1f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Release-name parser benchmark.
+
+Generates a labelled corpus of TV and movie paths in the layouts found in
+real libraries and runs it through the original MOVIE_PATTERNS/TV_PATTERNS
+loop and through wn_marmalade.naming. Reports names/second and how many
+names each one parsed correctly.
+
+    python benchmarks/bench_parser.py [count]
+"""
+
+import re
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from wn_marmalade.naming import parse_release_names  # noqa: E402
+
+LEGACY_MOVIE_PATTERNS = [
+    re.compile(r'^(.+?)[\.\s](\d{4})[\.\s]', re.IGNORECASE),
+    re.compile(r'^(.+?)\s*\((\d{4})\)', re.IGNORECASE),
+]
+
+LEGACY_TV_PATTERNS = [
+    re.compile(r'^(.+?)[\.\s\-]+S(\d{1,2})E(\d{1,2})', re.IGNORECASE),
+    re.compile(r'^(.+?)[\.\s\-]+(\d{1,2})x(\d{2})', re.IGNORECASE),
+]
+
+
+def legacy_parse(path: str, media_type: str):
+    """The parser as it was before wn_marmalade.naming."""
+    filename = Path(path).name
+    result = {'title': Path(filename).stem}
+    if media_type == 'tv':
+        for pattern in LEGACY_TV_PATTERNS:
+            match = pattern.match(filename)
+            if match:
+                groups = match.groups()
+                result['series_name'] = groups[0].replace('.', ' ').strip()
+                result['season'] = int(groups[1])
+                result['episode'] = int(groups[2])
+                break
+    else:
+        for pattern in LEGACY_MOVIE_PATTERNS:
+            match = pattern.match(filename)
+            if match:
+                groups = match.groups()
+                result['title'] = groups[0].replace('.', ' ').strip()
+                result['year'] = int(groups[1])
+                break
+    return result
+
+
+SHOWS = ["Breaking Bad", "The Office US", "Doctor Who", "Severance", "Slow Horses",
+         "The Expanse", "Better Call Saul", "Fargo", "Dark", "Andor"]
+ANIME = ["One Piece", "Frieren", "Jujutsu Kaisen", "Spy x Family", "Mob Psycho 100"]
+DAILY = ["The Daily Show", "Last Week Tonight", "The Late Show"]
+MOVIES = ["Heat", "Blade Runner 2049", "2001 A Space Odyssey", "The Matrix", "Arrival",
+          "Dune Part Two", "Up", "Oppenheimer", "1917", "Parasite"]
+TAGS = ["1080p.BluRay.x264", "720p.HDTV.x264", "2160p.WEB-DL.HEVC", "1080p.WEBRip.x265"]
+
+
+def tv_case(rng: random.Random):
+    show = rng.choice(SHOWS)
+    dotted = show.replace(' ', '.')
+    season, episode = rng.randint(1, 12), rng.randint(1, 24)
+    tag = rng.choice(TAGS)
+    layout = rng.randrange(7)
+    expect = {'series_name': show, 'season': season, 'episode': episode}
+    if layout == 0:
+        name = f"{show}/Season {season:02d}/{dotted}.S{season:02d}E{episode:02d}.{tag}.mkv"
+    elif layout == 1:
+        name = f"{show}/{show} - {season}x{episode:02d} - Title.avi"
+    elif layout == 2:
+        name = f"{show}/{dotted}.S{season:02d}E{episode:02d}E{episode + 1:02d}.{tag}.mkv"
+        expect['episode_end'] = episode + 1
+    elif layout == 3:
+        name = f"{show}/Season {season}/Episode {episode:02d}.mkv"
+    elif layout == 4:
+        name = f"{show}/Season {season:02d}/{episode:02d} - Title.mkv"
+    elif layout == 5:
+        show = rng.choice(ANIME)
+        episode = rng.randint(1, 1100)
+        name = f"{show}/[SubsPlease] {show} - {episode:02d} (1080p) [{rng.getrandbits(32):08X}].mkv"
+        expect = {'series_name': show, 'episode': episode}
+    else:
+        show = rng.choice(DAILY)
+        date = f"{rng.randint(2015, 2024)}.{rng.randint(1, 12):02d}.{rng.randint(1, 28):02d}"
+        name = f"{show}/{show.replace(' ', '.')}.{date}.Guest.Name.720p.mkv"
+        expect = {'series_name': show, 'air_date': date.replace('.', '-')}
+    return f"/media/tv/{name}", expect
+
+
+def movie_case(rng: random.Random):
+    title = rng.choice(MOVIES)
+    year = rng.randint(1960, 2024)
+    layout = rng.randrange(3)
+    if layout == 0:
+        name = f"{title.replace(' ', '.')}.{year}.{rng.choice(TAGS)}.mkv"
+    elif layout == 1:
+        name = f"{title} ({year}).mkv"
+    else:
+        name = f"{title} ({year})/{title.lower().replace(' ', '.')}.{rng.choice(TAGS)}.mkv"
+    return f"/media/movies/{name}", {'title': title, 'year': year}
+
+
+def corpus(count: int):
+    rng = random.Random(7)
+    tv = [tv_case(rng) for _ in range(count)]
+    movies = [movie_case(rng) for _ in range(count // 4)]
+    return tv, movies
+
+
+def correct(result, expect) -> bool:
+    return all(result.get(key) == value for key, value in expect.items())
+
+
+def run(name: str, parse_batch, tv, movies):
+    tv_paths = [path for path, _ in tv]
+    movie_paths = [path for path, _ in movies]
+    start = time.perf_counter()
+    tv_results = parse_batch(tv_paths, 'tv', '/media/tv')
+    movie_results = parse_batch(movie_paths, 'movies', '/media/movies')
+    elapsed = time.perf_counter() - start
+
+    total = len(tv) + len(movies)
+    ok_tv = sum(correct(r, e) for r, (_, e) in zip(tv_results, tv))
+    ok_movies = sum(correct(r, e) for r, (_, e) in zip(movie_results, movies))
+    print(f"  {name:<8}: {total / elapsed:10,.0f} names/s   "
+          f"tv {ok_tv / len(tv) * 100:5.1f} %   movies {ok_movies / len(movies) * 100:5.1f} % correct")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    tv, movies = corpus(count)
+    print(f"{len(tv)} tv + {len(movies)} movie names")
+    run("legacy", lambda paths, media_type, root: [legacy_parse(p, media_type) for p in paths], tv, movies)
+    run("naming", parse_release_names, tv, movies)
+
+
+if __name__ == "__main__":
+    main()
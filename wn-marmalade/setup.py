@@ -10,7 +10,7 @@ setup(
     packages=find_packages(where="src"),
     package_dir={"": "src"},
     install_requires=[
-        "wn-core>=1.0.0", "aiofiles>=23.0.0", "watchdog>=3.0.0"
+        "wn-core>=1.0.0", "aiofiles>=23.0.0", "watchdog>=3.0.0", "httpx>=0.24.0"
     ],
     python_requires=">=3.9",
     classifiers=[
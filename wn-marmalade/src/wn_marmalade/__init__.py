@@ -1,7 +1,8 @@
 """
 WatchNexus Marmalade - Media Server Module 🍊
 """
-from .server import MarmaladeServer, MediaLibrary
+from .server import MarmaladeServer, Library as MediaLibrary
+from .aio import AsyncMarmaladeServer
 
 __version__ = "1.0.0"
-__all__ = ["MarmaladeServer", "MediaLibrary"]
+__all__ = ["MarmaladeServer", "AsyncMarmaladeServer", "MediaLibrary"]
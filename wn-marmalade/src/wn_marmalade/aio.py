@@ -0,0 +1,252 @@
+"""
+Marmalade Async - event-loop friendly front end of MarmaladeServer.
+
+MarmaladeServer keeps its catalogue and indexes in memory and is meant to
+be driven from one event loop. AsyncMarmaladeServer makes sure nothing on
+that loop waits for the disk:
+
+- the catalogue is loaded on a worker thread before the first request;
+- store writes go to a single writer thread, in order, while the caller
+  carries on (close() waits for them);
+- stats, walks, name parsing, hashing and exports run on a dedicated
+  I/O pool instead of the loop's default executor;
+- in-memory state is only ever changed on the loop, and scans, file
+  change batches and removals of one library are serialised by a
+  per-library lock, so they cannot interleave.
+
+Catalogue imports rebuild the indexes in bulk and stay synchronous; run
+them before serving. Exports copy libraries and watch state on the loop
+and write the rest from the store on the I/O pool.
+"""
+
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any
+
+from .server import MarmaladeServer, MediaFile, Library
+from .backup import snapshot_catalogue
+from .versions import pick_version
+from .watchstate import WatchState, DEFAULT_USER
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMarmaladeServer:
+    """Non-blocking API over a MarmaladeServer, for use from the event loop."""
+
+    def __init__(self, server: MarmaladeServer, io_workers: int = 4):
+        self.server = server
+        self._executor = ThreadPoolExecutor(max_workers=max(1, io_workers), thread_name_prefix="marmalade-io")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="marmalade-writer")
+        server._executor = self._executor
+        server._writer = self._writer
+        self._loading: Optional[asyncio.Future] = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def ready(self):
+        """Load the catalogue off the loop; every call waits for this first."""
+        if self.server._media_files is not None:
+            return
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._run(lambda: self.server.media_files))
+        await asyncio.shield(self._loading)
+
+    async def flush_writes(self):
+        """Wait until every store write queued so far has been made."""
+        await asyncio.wrap_future(self._writer.submit(lambda: None))
+
+    async def start(self):
+        """Load the catalogue and start the background workers."""
+        await self.ready()
+        server = self.server
+        await server.watch_states.start(self._executor)
+        await server.transcoder.start()
+        await server.artwork.start()
+        await server.metadata.start()
+        await server.markers.start()
+        await server.scheduler.start()
+        await server.watcher.start()
+
+    async def close(self):
+        """Stop the background workers, wait for queued writes and close the store."""
+        server = self.server
+        await server.watcher.stop()
+        await server.scheduler.stop()
+        await server.markers.stop()
+        await server.metadata.stop()
+        await server.artwork.stop()
+        await server.transcoder.stop()
+        await server.watch_states.stop()
+        await self._run(server.close)
+        self._executor.shutdown(wait=False)
+
+    # ==================== Libraries ====================
+
+    async def get_libraries(self) -> List[Library]:
+        return self.server.get_libraries()
+
+    async def get_library(self, library_id: str) -> Optional[Library]:
+        return self.server.get_library(library_id)
+
+    async def add_library(self, name: str, path: str, media_type: str = "movies", **kwargs) -> Library:
+        return self.server.add_library(name, path, media_type, **kwargs)
+
+    async def remove_library(self, library_id: str) -> bool:
+        await self.ready()
+        async with self.server._library_lock(library_id):
+            return self.server.remove_library(library_id)
+
+    async def scan_library(self, library_id: str, full: bool = False) -> Dict[str, Any]:
+        await self.ready()
+        return await self.server.scan_library(library_id, full)
+
+    async def apply_file_changes(
+        self,
+        library_id: str,
+        changed_paths: List[str],
+        removed_paths: List[str],
+    ) -> Dict[str, Any]:
+        await self.ready()
+        return await self.server.apply_file_changes(library_id, changed_paths, removed_paths)
+
+    async def get_scan_progress(self, library_id: Optional[str] = None) -> Dict[str, Any]:
+        return self.server.get_scan_progress(library_id)
+
+    # ==================== Media ====================
+
+    async def get_media(self, media_id: str) -> Optional[MediaFile]:
+        await self.ready()
+        return self.server.get_media(media_id)
+
+    async def get_all_media(self, *args, **kwargs) -> List[MediaFile]:
+        await self.ready()
+        return self.server.get_all_media(*args, **kwargs)
+
+    async def search_media(self, query: str, limit: int = 50) -> List[MediaFile]:
+        await self.ready()
+        return self.server.search_media(query, limit)
+
+    async def get_recent_media(self, limit: int = 20) -> List[MediaFile]:
+        await self.ready()
+        return self.server.get_recent_media(limit)
+
+    async def get_continue_watching(self, limit: int = 10, user_id: str = DEFAULT_USER) -> List[MediaFile]:
+        await self.ready()
+        return self.server.get_continue_watching(limit, user_id)
+
+    async def media_to_dict(self, media: MediaFile, user_id: str = DEFAULT_USER) -> Dict[str, Any]:
+        return self.server.media_to_dict(media, user_id)
+
+    # ==================== TV Series ====================
+
+    async def get_series(self, library_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        await self.ready()
+        return self.server.get_series(library_id)
+
+    async def get_seasons(self, series_id: str) -> List[Dict[str, Any]]:
+        await self.ready()
+        return self.server.get_seasons(series_id)
+
+    async def get_episodes(self, series_id: str, season: Optional[int] = None) -> List[MediaFile]:
+        await self.ready()
+        return self.server.get_episodes(series_id, season)
+
+    async def get_next_episode(self, media_id: str) -> Optional[MediaFile]:
+        await self.ready()
+        return self.server.get_next_episode(media_id)
+
+    async def get_previous_episode(self, media_id: str) -> Optional[MediaFile]:
+        await self.ready()
+        return self.server.get_previous_episode(media_id)
+
+    async def get_up_next(self, limit: int = 10, user_id: str = DEFAULT_USER) -> List[MediaFile]:
+        await self.ready()
+        return self.server.get_up_next(limit, user_id)
+
+    # ==================== Watch State ====================
+
+    async def get_watch_state(self, media_id: str, user_id: str = DEFAULT_USER) -> Optional[WatchState]:
+        return self.server.get_watch_state(media_id, user_id)
+
+    async def update_watch_progress(
+        self,
+        media_id: str,
+        progress: float,
+        mark_watched: bool = False,
+        user_id: str = DEFAULT_USER,
+    ) -> bool:
+        await self.ready()
+        return self.server.update_watch_progress(media_id, progress, mark_watched, user_id)
+
+    async def mark_watched(self, media_id: str, watched: bool = True, user_id: str = DEFAULT_USER) -> bool:
+        await self.ready()
+        return self.server.mark_watched(media_id, watched, user_id)
+
+    # ==================== Versions and Streaming ====================
+
+    async def _existing_versions(self, media_id: str) -> List[MediaFile]:
+        versions = self.server._version_group(media_id)
+        return await self._run(lambda: [m for m in versions if os.path.exists(m.path)])
+
+    async def get_versions(self, media_id: str) -> List[MediaFile]:
+        await self.ready()
+        return self.server.get_versions(media_id)
+
+    async def get_version_groups(self, library_id: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        await self.ready()
+        return self.server.get_version_groups(library_id, limit)
+
+    async def pick_version(
+        self,
+        media_id: str,
+        max_height: Optional[int] = None,
+        video_codecs: Optional[List[str]] = None,
+        max_bitrate: Optional[int] = None,
+    ) -> Optional[MediaFile]:
+        await self.ready()
+        if media_id not in self.server.media_files:
+            return None
+        versions = await self._existing_versions(media_id)
+        return pick_version(versions, max_height, video_codecs, max_bitrate) if versions else None
+
+    async def find_duplicates(self, library_id: Optional[str] = None) -> Dict[str, Any]:
+        await self.ready()
+        return await self.server.find_duplicates(library_id)
+
+    async def get_stream_url(
+        self,
+        media_id: str,
+        quality: str = "original",
+        max_height: Optional[int] = None,
+        video_codecs: Optional[List[str]] = None,
+        max_bitrate: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        await self.ready()
+        if media_id not in self.server.media_files:
+            return None
+        versions = await self._existing_versions(media_id)
+        return self.server._stream_info(media_id, versions, quality, max_height, video_codecs, max_bitrate)
+
+    # ==================== Background Work ====================
+
+    async def refresh_metadata(self, library_id: Optional[str] = None) -> Dict[str, Any]:
+        await self.ready()
+        return await self.server.refresh_metadata(library_id)
+
+    async def detect_markers(self, library_id: Optional[str] = None) -> Dict[str, Any]:
+        await self.ready()
+        return await self.server.detect_markers(library_id)
+
+    async def export_catalogue(self, path: str, library_id: Optional[str] = None) -> Dict[str, int]:
+        """
+        Write a backup on the I/O pool. Libraries and watch state are
+        copied on the loop first; media rows are read from the store.
+        """
+        await self.ready()
+        snapshot = snapshot_catalogue(self.server, library_id)
+        await self.flush_writes()
+        return await self._run(self.server.export_catalogue, path, library_id, snapshot)
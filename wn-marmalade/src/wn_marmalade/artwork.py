@@ -0,0 +1,438 @@
+"""
+Marmalade Artwork - local thumbnails and trickplay previews.
+
+A small job queue runs ffmpeg at a fixed concurrency to extract a keyframe
+thumbnail and trickplay sprite sheets (a grid of frames every few seconds,
+used for seek previews) for each media file.
+
+Images are stored content-addressed under ``cache/artwork/objects/`` by
+their SHA-256, so identical images are stored once and the hash doubles
+as a strong ETag. A small JSON ref per source file and artwork kind
+points at the objects. Sources are keyed by file identity, so a replaced
+file gets new artwork. Objects are evicted least recently used first to
+stay within the size budget; a ref whose objects are gone is regenerated
+on the next request.
+"""
+
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Set, Tuple, TYPE_CHECKING
+
+from wn_core.probe import file_key
+
+if TYPE_CHECKING:
+    from .server import MarmaladeServer, MediaFile
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL = "thumbnail"
+TRICKPLAY = "trickplay"
+
+# Queue priorities: requests from clients jump ahead of background work
+PRIORITY_REQUEST = 0
+PRIORITY_BACKGROUND = 1
+
+
+def _unlink(*paths: Path):
+    """Delete files, ignoring ones already gone (blocking)."""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+@dataclass
+class ArtworkObject:
+    """A cached image, addressed by the SHA-256 of its bytes."""
+    digest: str
+    path: Path
+    mime_type: str = "image/jpeg"
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.digest}"'
+
+
+class ArtworkService:
+    """
+    Generates thumbnails and trickplay sheets in the background and keeps
+    them in a size-bounded, content-addressed disk cache.
+    """
+
+    def __init__(
+        self,
+        server: 'MarmaladeServer',
+        cache_dir: Path,
+        ffmpeg_path: str = "ffmpeg",
+        concurrency: int = 1,
+        cache_size: int = 2 * 1024 ** 3,
+        thumbnail_width: int = 480,
+        trickplay_interval: int = 10,
+        trickplay_width: int = 320,
+        trickplay_grid: Tuple[int, int] = (10, 10),
+        job_timeout: float = 600.0,
+    ):
+        self.server = server
+        self.cache_dir = Path(cache_dir)
+        self.ffmpeg_path = ffmpeg_path
+        self.concurrency = max(1, concurrency)  # ffmpeg processes at once
+        self.cache_size = cache_size  # bytes
+        self.thumbnail_width = thumbnail_width
+        self.trickplay_interval = trickplay_interval  # seconds between frames
+        self.trickplay_width = trickplay_width
+        self.trickplay_grid = trickplay_grid  # columns, rows per sheet
+        self.job_timeout = job_timeout
+
+        self._objects_dir = self.cache_dir / "objects"
+        self._refs_dir = self.cache_dir / "refs"
+        self._tmp_dir = self.cache_dir / "tmp"
+        for directory in (self._objects_dir, self._refs_dir, self._tmp_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+
+        self._refs: Dict[str, Dict[str, Any]] = {}  # ref key -> ref, read through
+        self._cache: "OrderedDict[str, int]" = OrderedDict()  # object digest -> size, LRU first
+        self._cache_bytes = 0
+
+        # Created on the running loop by start()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._running: Set[Tuple[str, str]] = set()
+        self._workers: List[asyncio.Task] = []
+        self._sequence = 0  # keeps equal priorities first in, first out
+        self.generated = 0
+        self.failed = 0
+
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        self._tmp_dir.mkdir(exist_ok=True)
+        self._index_cache()
+
+    # ==================== Lookup ====================
+
+    def get_object(self, digest: str) -> Optional[ArtworkObject]:
+        """Get a cached image by digest (as used in trickplay manifests)."""
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            return None
+        if digest not in self._cache:
+            return None
+        self._cache.move_to_end(digest)
+        return ArtworkObject(digest, self._object_path(digest))
+
+    async def get_thumbnail(self, media_id: str, wait: bool = True) -> Optional[ArtworkObject]:
+        """
+        Get the thumbnail of a media file. A missing one is queued ahead of
+        background work; with wait=True the call returns once it is made.
+        """
+        ref = await self._get_ref(media_id, THUMBNAIL, wait)
+        return self.get_object(ref["objects"][0]) if ref else None
+
+    async def get_trickplay(self, media_id: str, wait: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Get the trickplay manifest of a media file: tile size, grid, frame
+        interval and the URLs of its sprite sheets. Sheets take a while to
+        generate, so by default a missing manifest is queued and None returned.
+        """
+        ref = await self._get_ref(media_id, TRICKPLAY, wait)
+        if not ref:
+            return None
+        manifest = {k: v for k, v in ref.items() if k != "objects"}
+        manifest["sheets"] = [f"/artwork/objects/{digest}.jpg" for digest in ref["objects"]]
+        return manifest
+
+    async def _get_ref(self, media_id: str, kind: str, wait: bool) -> Optional[Dict[str, Any]]:
+        media = self.server.get_media(media_id)
+        if not media:
+            return None
+        ref = await self._load_ref(media, kind)
+        if ref is not None:
+            return ref
+        future = self.enqueue(media_id, kind, PRIORITY_REQUEST)
+        if not wait or future is None:
+            return None
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.job_timeout)
+        except Exception:
+            return None
+        return await self._load_ref(media, kind)
+
+    # ==================== Jobs ====================
+
+    def enqueue(self, media_id: str, kind: str, priority: int = PRIORITY_BACKGROUND) -> Optional[asyncio.Future]:
+        """
+        Queue generation of one kind of artwork. Already queued jobs are
+        shared. Returns None when the service is not running.
+        """
+        if self._queue is None:
+            return None
+        key = (media_id, kind)
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.get_running_loop().create_future()
+            self._sequence += 1
+            self._queue.put_nowait((priority, self._sequence, media_id, kind))
+        elif priority == PRIORITY_REQUEST:
+            # Promote a background job; the stale queue entry is skipped when reached
+            self._sequence += 1
+            self._queue.put_nowait((priority, self._sequence, media_id, kind))
+        return future
+
+    def enqueue_media(self, media: List['MediaFile'], trickplay: bool = True):
+        """Queue artwork for newly scanned media in the background."""
+        for item in media:
+            if item.duration <= 0 or not item.width:
+                continue  # audio or unreadable
+            self.enqueue(item.id, THUMBNAIL)
+            if trickplay:
+                self.enqueue(item.id, TRICKPLAY)
+
+    async def start(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        for task in self._workers:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+        self._queue = None
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    async def _worker(self):
+        while True:
+            _, _, media_id, kind = await self._queue.get()
+            key = (media_id, kind)
+            future = self._pending.get(key)
+            if future is None or key in self._running:
+                continue  # handled through the other entry of a promoted job
+            self._running.add(key)
+            try:
+                await self._generate(media_id, kind)
+                future.set_result(True)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Artwork {kind} failed for {media_id}: {e}")
+                future.set_exception(e)
+                future.exception()  # retrieved: nobody may be waiting
+            finally:
+                self._running.discard(key)
+                self._pending.pop(key, None)
+
+    async def _generate(self, media_id: str, kind: str):
+        media = self.server.get_media(media_id)
+        if not media or await self._load_ref(media, kind) is not None:
+            return
+        ref_key = await self._io(self._ref_key, media, kind)
+        if ref_key is None:
+            raise FileNotFoundError(media.path)
+
+        work_dir = Path(await self._io(tempfile.mkdtemp, None, None, self._tmp_dir))
+        try:
+            if kind == THUMBNAIL:
+                ref = await self._make_thumbnail(media, work_dir)
+            else:
+                ref = await self._make_trickplay(media, work_dir)
+            stored = await self._io(self._store_objects, work_dir)
+            if not stored:
+                raise RuntimeError("ffmpeg produced no images")
+        finally:
+            await self._io(shutil.rmtree, work_dir, True)
+        ref["objects"] = [digest for digest, _ in stored]
+        for digest, size in stored:
+            self._touch(digest, size)
+
+        await self._io(self._save_ref, ref_key, ref)
+        self._refs[ref_key] = ref
+        self.generated += 1
+        logger.info(f"Generated {kind} for {media_id} ({len(ref['objects'])} images)")
+
+    async def _make_thumbnail(self, media: 'MediaFile', work_dir: Path) -> Dict[str, Any]:
+        # Seek in before decoding and decode keyframes only: one cheap frame
+        position = min(media.duration * 0.1, 300) if media.duration > 0 else 0
+        await self._run_ffmpeg([
+            '-ss', f"{position:.3f}",
+            '-skip_frame', 'nokey',
+            '-i', media.path,
+            '-map', '0:v:0',
+            '-frames:v', '1',
+            '-vf', f"scale={self.thumbnail_width}:-2",
+            '-q:v', '3',
+            str(work_dir / 'thumb.jpg'),
+        ])
+        return {"width": self.thumbnail_width}
+
+    async def _make_trickplay(self, media: 'MediaFile', work_dir: Path) -> Dict[str, Any]:
+        columns, rows = self.trickplay_grid
+        width = self.trickplay_width
+        height = 2 * round(width * media.height / media.width / 2) if media.width else 0
+        await self._run_ffmpeg([
+            '-skip_frame', 'nokey',
+            '-i', media.path,
+            '-map', '0:v:0',
+            '-an', '-sn',
+            '-vf', f"fps=1/{self.trickplay_interval},scale={width}:{height or -2},tile={columns}x{rows}",
+            '-vsync', 'vfr',
+            '-q:v', '5',
+            str(work_dir / 'sheet_%04d.jpg'),
+        ])
+        return {
+            "interval": self.trickplay_interval,
+            "tile_width": width,
+            "tile_height": height,
+            "columns": columns,
+            "rows": rows,
+            "frames": max(1, int(media.duration // self.trickplay_interval)),
+        }
+
+    async def _run_ffmpeg(self, args: List[str]):
+        proc = await asyncio.create_subprocess_exec(
+            self.ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', *args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), self.job_timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise RuntimeError("ffmpeg timed out")
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with {proc.returncode}: {stderr.decode(errors='replace').strip()}")
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "running": self._queue is not None,
+            "queued": len(self._pending),
+            "generated": self.generated,
+            "failed": self.failed,
+            "objects": len(self._cache),
+            "cache_bytes": self._cache_bytes,
+            "cache_size": self.cache_size,
+        }
+
+    # ==================== Refs ====================
+
+    def _ref_key(self, media: 'MediaFile', kind: str) -> Optional[str]:
+        identity = file_key(media.path)
+        if identity is None:
+            return None
+        if kind == THUMBNAIL:
+            params = (self.thumbnail_width,)
+        else:
+            params = (self.trickplay_interval, self.trickplay_width, *self.trickplay_grid)
+        return hashlib.sha1(repr((identity, kind, params)).encode()).hexdigest()
+
+    async def _load_ref(self, media: 'MediaFile', kind: str) -> Optional[Dict[str, Any]]:
+        """The ref of a media's current artwork; None if missing, unreadable or partly evicted."""
+        key = await self._io(self._ref_key, media, kind)
+        if key is None:
+            return None
+        ref = self._refs.get(key)
+        if ref is None:
+            ref = await self._io(self._read_ref, key)
+            if ref is None:
+                return None
+        if not all(digest in self._cache for digest in ref["objects"]):
+            # Part of it was evicted; regenerate
+            self._refs.pop(key, None)
+            await self._io(_unlink, self._refs_dir / f"{key}.json")
+            return None
+        self._refs[key] = ref
+        return ref
+
+    def _read_ref(self, key: str) -> Optional[Dict[str, Any]]:
+        """Read a ref file (blocking). None if it is missing or not a ref."""
+        try:
+            with open(self._refs_dir / f"{key}.json", 'r') as f:
+                ref = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(ref, dict) or not isinstance(ref.get("objects"), list):
+            return None
+        return ref
+
+    def _save_ref(self, key: str, ref: Dict[str, Any]):
+        """Write a ref file atomically (blocking)."""
+        path = self._refs_dir / f"{key}.json"
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(ref, f)
+        os.replace(tmp, path)
+
+    async def _io(self, func, *args):
+        """Run blocking file system work on the server's I/O pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.server._executor, func, *args)
+
+    # ==================== Object Cache ====================
+
+    def _object_path(self, digest: str) -> Path:
+        return self._objects_dir / digest[:2] / f"{digest}.jpg"
+
+    def _store_objects(self, work_dir: Path) -> List[Tuple[str, int]]:
+        """Move the images ffmpeg wrote into the object store (blocking). Returns (digest, size) pairs."""
+        stored = []
+        for output in sorted(work_dir.glob("*.jpg")):
+            data = output.read_bytes()
+            digest = hashlib.sha256(data).hexdigest()
+            path = self._object_path(digest)
+            if not path.exists():
+                path.parent.mkdir(exist_ok=True)
+                os.replace(output, path)
+            stored.append((digest, len(data)))
+        return stored
+
+    def _index_cache(self):
+        """Pick up objects left from previous runs, oldest first."""
+        objects = []
+        for path in self._objects_dir.glob("*/*.jpg"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            objects.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, digest, size in sorted(objects):
+            self._cache[digest] = size
+            self._cache_bytes += size
+        self._evict()
+
+    def _touch(self, digest: str, size: int):
+        """Mark an object as just used, adding it to the cache if new."""
+        if digest in self._cache:
+            self._cache.move_to_end(digest)
+            return
+        self._cache[digest] = size
+        self._cache_bytes += size
+        self._evict()
+
+    def _evict(self):
+        # The newest object is always kept, it is about to be served
+        evicted = []
+        while self._cache_bytes > self.cache_size and len(self._cache) > 1:
+            digest, size = self._cache.popitem(last=False)
+            self._cache_bytes -= size
+            evicted.append(self._object_path(digest))
+        if not evicted:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            _unlink(*evicted)  # indexing on construction
+            return
+        loop.run_in_executor(self.server._executor, _unlink, *evicted)
@@ -0,0 +1,154 @@
+"""
+Marmalade Backup - streaming export and import of the catalogue.
+
+A backup is newline-delimited JSON: a header line, then one line per
+library, media entry and watch state. Entries are read from the store
+and written one at a time (media rows are copied as stored, without
+being decoded), and imports are written back in fixed-size batches, so
+memory use does not grow with the size of the catalogue; only libraries
+and watch state are copied up front. Files ending in .gz are compressed.
+"""
+
+import gzip
+import json
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Any, IO, TYPE_CHECKING
+
+from .watchstate import WatchState
+
+if TYPE_CHECKING:
+    from .server import MarmaladeServer
+
+logger = logging.getLogger(__name__)
+
+FORMAT = "marmalade-catalogue"
+FORMAT_VERSION = 1
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(data, separators=(',', ':'))
+
+
+def open_backup(path: Path, mode: str = "r") -> IO[str]:
+    """Open a backup file for text reading or writing, gzipped if it ends in .gz."""
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def snapshot_catalogue(server: 'MarmaladeServer', library_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Copy the in-memory part of an export (libraries and watch state), so
+    the rest, read from the store, can be written on another thread.
+    """
+    return {
+        "libraries": [
+            library.to_dict() for library in server.get_libraries()
+            if library_id is None or library.id == library_id
+        ],
+        "watch_states": server.watch_states.snapshot(),
+    }
+
+
+def export_catalogue(
+    server: 'MarmaladeServer',
+    f: IO[str],
+    library_id: Optional[str] = None,
+    snapshot: Optional[Dict[str, Any]] = None,
+) -> Dict[str, int]:
+    """
+    Write libraries, media and watch state (of one library, or all) to f.
+    Libraries and watch state come from snapshot when given; take it with
+    snapshot_catalogue() on the thread that owns the server.
+    """
+    if snapshot is None:
+        snapshot = snapshot_catalogue(server, library_id)
+    counts = {"libraries": 0, "media": 0, "watch_states": 0}
+    f.write(_dumps({
+        "type": FORMAT,
+        "version": FORMAT_VERSION,
+        "exported": datetime.now(timezone.utc).isoformat(),
+        "library_id": library_id,
+    }) + "\n")
+
+    for library in snapshot["libraries"]:
+        f.write(_dumps({"type": "library", "data": library}) + "\n")
+        counts["libraries"] += 1
+
+    for media_id, data in server._store.iter_media_json(library_id):
+        f.write('{"type":"media","data":' + data + '}\n')
+        counts["media"] += 1
+        for state in snapshot["watch_states"].get(media_id, ()):
+            f.write(_dumps({"type": "watch_state", "data": state}) + "\n")
+            counts["watch_states"] += 1
+    return counts
+
+
+def import_catalogue(
+    server: 'MarmaladeServer',
+    f: IO[str],
+    library_id: Optional[str] = None,
+    batch_size: int = 1000,
+) -> Dict[str, int]:
+    """
+    Restore a backup written by export_catalogue, replacing entries with
+    the same ids. With library_id, only that library is restored.
+    """
+    counts = {"libraries": 0, "media": 0, "watch_states": 0, "skipped": 0}
+    header = json.loads(f.readline() or "{}")
+    if header.get("type") != FORMAT:
+        raise ValueError("Not a Marmalade catalogue backup")
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(f"Unsupported backup version {header['version']}")
+
+    media: List[Dict[str, Any]] = []
+    states: List[WatchState] = []
+    media_id = None  # last media restored; its watch states follow it
+
+    def flush_media():
+        server._restore_media(media)
+        media.clear()
+
+    def flush_states():
+        server.watch_states.import_states(states)
+        states.clear()
+
+    for line in f:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        kind, data = record.get("type"), record.get("data")
+        if kind == "library":
+            if library_id is None or data["id"] == library_id:
+                server._restore_library(data)
+                counts["libraries"] += 1
+            else:
+                counts["skipped"] += 1
+        elif kind == "media":
+            if library_id is None or data.get("library_id") == library_id:
+                media.append(data)
+                media_id = data["id"]
+                counts["media"] += 1
+                if len(media) >= batch_size:
+                    flush_media()
+            else:
+                media_id = None
+                counts["skipped"] += 1
+        elif kind == "watch_state":
+            if library_id is None or data["media_id"] == media_id:
+                states.append(WatchState(**data))
+                counts["watch_states"] += 1
+                if len(states) >= batch_size:
+                    flush_states()
+            else:
+                counts["skipped"] += 1
+        else:
+            counts["skipped"] += 1
+
+    flush_media()
+    flush_states()
+    logger.info(f"Imported catalogue backup: {counts}")
+    return counts
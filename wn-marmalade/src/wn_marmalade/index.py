@@ -0,0 +1,525 @@
+"""
+Marmalade Index - in-memory indexes over the media catalogue.
+
+Indexes are kept up to date by MarmaladeServer whenever an entry is added,
+replaced or removed, so read paths never have to scan the whole library.
+Ordered indexes insert single entries in place; when a whole catalogue is
+loaded or imported, bulk() collects entries unordered and sorts once at
+the end instead.
+"""
+
+import os
+import re
+import heapq
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from typing import Dict, List, Set, Tuple, Iterator, Iterable, Hashable, Optional, Any
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into casefolded word tokens."""
+    return _TOKEN_RE.findall(text.casefold())
+
+
+class _BulkIndex:
+    """Base of indexes that can defer ordering during bulk() and rebuild it in one pass."""
+
+    _bulk = False
+
+    @contextmanager
+    def bulk(self):
+        """Add many entries, ordering them once when the block ends. Do not query inside it."""
+        if self._bulk:
+            yield self
+            return
+        self._bulk = True
+        try:
+            yield self
+        finally:
+            self._bulk = False
+            self._rebuild()
+
+    def _rebuild(self):
+        raise NotImplementedError
+
+
+class TitleIndex(_BulkIndex):
+    """
+    Inverted token index over titles and series names.
+    Every query term is matched as a prefix of an indexed token, so
+    results narrow as the user types.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[str]] = {}
+        self._vocab: List[str] = []  # sorted, for prefix ranges
+        self._docs: Dict[str, Tuple[str, Tuple[str, ...]]] = {}  # id -> (casefolded title, tokens)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, media_id: str, title: str, series_name: str = ""):
+        """Index an entry, replacing any previous version of it."""
+        self.remove(media_id)
+        tokens = tuple(dict.fromkeys(tokenize(title) + tokenize(series_name)))
+        self._docs[media_id] = (title.casefold(), tokens)
+        for token in tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                ids = self._postings[token] = set()
+                if not self._bulk:
+                    insort(self._vocab, token)
+            ids.add(media_id)
+
+    def remove(self, media_id: str):
+        doc = self._docs.pop(media_id, None)
+        if doc is None:
+            return
+        for token in doc[1]:
+            ids = self._postings[token]
+            ids.discard(media_id)
+            if not ids:
+                del self._postings[token]
+                if not self._bulk:
+                    del self._vocab[bisect_left(self._vocab, token)]
+
+    def _rebuild(self):
+        self._vocab = sorted(self._postings)
+
+    def _expand(self, prefix: str) -> Iterator[str]:
+        """Indexed tokens starting with prefix."""
+        i = bisect_left(self._vocab, prefix)
+        while i < len(self._vocab) and self._vocab[i].startswith(prefix):
+            yield self._vocab[i]
+            i += 1
+
+    def search(self, query: str, limit: int = 50) -> List[str]:
+        """
+        Get ids of entries matching every term of the query, best first.
+        Entries matching terms as whole words rank above prefix matches,
+        then titles starting with the query, then shorter titles.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or limit <= 0:
+            return []
+
+        # Seed candidates from the most selective term, filter by the rest
+        expansions = {term: list(self._expand(term)) for term in terms}
+        seed = min(terms, key=lambda t: sum(len(self._postings[tok]) for tok in expansions[t]))
+        candidates: Set[str] = set()
+        for token in expansions[seed]:
+            candidates |= self._postings[token]
+
+        others = [t for t in terms if t != seed]
+        query_folded = query.casefold().strip()
+
+        def matches(media_id: str) -> bool:
+            tokens = self._docs[media_id][1]
+            return all(any(tok.startswith(term) for tok in tokens) for term in others)
+
+        def rank(media_id: str) -> tuple:
+            title, tokens = self._docs[media_id]
+            exact = sum(1 for term in terms if term in tokens)
+            return (-exact, not title.startswith(query_folded), len(title), title)
+
+        hits = (mid for mid in candidates if matches(mid)) if others else candidates
+        return heapq.nsmallest(limit, hits, key=rank)
+
+
+class SortedIndex(_BulkIndex):
+    """
+    Ids kept in key order, split into named partitions (e.g. per library
+    or per media type), so a page of any partition is O(log n + page size).
+    """
+
+    def __init__(self):
+        self._partitions: Dict[Hashable, List[tuple]] = {}
+        self._entries: Dict[str, Tuple[Any, Tuple[Hashable, ...]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, media_id: str, key: Any, partitions: Iterable[Hashable] = (None,)):
+        """Insert an entry, replacing any previous key or partitions."""
+        self.remove(media_id)
+        partitions = tuple(partitions)
+        self._entries[media_id] = (key, partitions)
+        if self._bulk:
+            return
+        for name in partitions:
+            insort(self._partitions.setdefault(name, []), (key, media_id))
+
+    def remove(self, media_id: str):
+        entry = self._entries.pop(media_id, None)
+        if entry is None or self._bulk:
+            return
+        key, partitions = entry
+        for name in partitions:
+            items = self._partitions[name]
+            del items[bisect_left(items, (key, media_id))]
+            if not items:
+                del self._partitions[name]
+
+    def _rebuild(self):
+        partitions: Dict[Hashable, List[tuple]] = {}
+        for media_id, (key, names) in self._entries.items():
+            for name in names:
+                partitions.setdefault(name, []).append((key, media_id))
+        for items in partitions.values():
+            items.sort()
+        self._partitions = partitions
+
+    def count(self, partition: Hashable = None) -> int:
+        return len(self._partitions.get(partition, ()))
+
+    def page(self, partition: Hashable = None, offset: int = 0, limit: int = 100) -> List[str]:
+        """Get ids of one page of a partition in ascending key order."""
+        items = self._partitions.get(partition, [])
+        return [media_id for _, media_id in items[offset:offset + limit]]
+
+    def last(self, partition: Hashable = None, limit: int = 20) -> List[str]:
+        """Get ids of the highest-keyed entries of a partition, highest first. O(limit)."""
+        if limit <= 0:
+            return []
+        items = self._partitions.get(partition, [])
+        return [media_id for _, media_id in reversed(items[-limit:])]
+
+
+class PathIndex:
+    """
+    Entries by library and by directory.
+
+    Library membership is a set of ids, so listing or counting a library
+    costs O(items in it) rather than a pass over the whole catalogue, and
+    "/media/tv2" is never mistaken for part of "/media/tv". Directories
+    holding entries form a tree (directory -> child directories), so
+    everything below a removed folder is found without a full scan either.
+    """
+
+    def __init__(self):
+        self._libraries: Dict[str, Set[str]] = {}  # library id -> media ids
+        self._files: Dict[str, Set[str]] = {}  # directory -> ids of entries directly in it
+        self._subdirs: Dict[str, Set[str]] = {}  # directory -> child directories with entries below
+        self._entries: Dict[str, Tuple[str, str]] = {}  # media id -> (library id, path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, media_id: str, library_id: str, path: str):
+        """Index an entry, replacing any previous library or path."""
+        self.remove(media_id)
+        self._entries[media_id] = (library_id, path)
+        self._libraries.setdefault(library_id, set()).add(media_id)
+        directory = os.path.dirname(path)
+        files = self._files.get(directory)
+        if files is None:
+            self._link(directory)
+            files = self._files[directory] = set()
+        files.add(media_id)
+
+    def remove(self, media_id: str):
+        entry = self._entries.pop(media_id, None)
+        if entry is None:
+            return
+        library_id, path = entry
+        members = self._libraries[library_id]
+        members.discard(media_id)
+        if not members:
+            del self._libraries[library_id]
+        directory = os.path.dirname(path)
+        files = self._files[directory]
+        files.discard(media_id)
+        if not files:
+            del self._files[directory]
+            self._unlink(directory)
+
+    def _link(self, directory: str):
+        """Hook a directory into the tree, adding missing ancestors."""
+        while True:
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return
+            known = parent in self._files or parent in self._subdirs
+            self._subdirs.setdefault(parent, set()).add(directory)
+            if known:
+                return
+            directory = parent
+
+    def _unlink(self, directory: str):
+        """Drop a directory, and ancestors left empty, from the tree."""
+        while directory not in self._files and not self._subdirs.get(directory):
+            self._subdirs.pop(directory, None)
+            parent = os.path.dirname(directory)
+            if parent == directory or parent not in self._subdirs:
+                return
+            self._subdirs[parent].discard(directory)
+            directory = parent
+
+    def count(self, library_id: str) -> int:
+        return len(self._libraries.get(library_id, ()))
+
+    def library(self, library_id: str) -> List[str]:
+        """Get ids of a library's entries."""
+        return list(self._libraries.get(library_id, ()))
+
+    def under(self, path: str) -> List[str]:
+        """Get ids of the entry at path and of every entry below it."""
+        path = path.rstrip(os.sep) or os.sep
+        found = [
+            media_id for media_id in self._files.get(os.path.dirname(path), ())
+            if self._entries[media_id][1] == path
+        ]
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            found.extend(self._files.get(directory, ()))
+            stack.extend(self._subdirs.get(directory, ()))
+        return found
+
+
+class VersionIndex:
+    """
+    Files that are versions of the same work, across libraries: one movie
+    (title and year) or one episode (series, season and episode, or air
+    date). Works are keyed by normalised names, so "Heat.1995.2160p" and
+    "Heat (1995)" fall into one group.
+    """
+
+    def __init__(self):
+        self._groups: Dict[tuple, Set[str]] = {}
+        self._entries: Dict[str, tuple] = {}  # media id -> work key
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def movie_key(title: str, year: Optional[int]) -> Optional[tuple]:
+        name = " ".join(tokenize(title))
+        return ("movie", name, year) if name else None
+
+    @staticmethod
+    def episode_key(
+        series_name: str,
+        season: Optional[int],
+        episode: Optional[int],
+        air_date: Optional[str] = None,
+    ) -> Optional[tuple]:
+        name = " ".join(tokenize(series_name))
+        if not name or (episode is None and not air_date):
+            return None
+        return ("episode", name, season, episode, air_date)
+
+    def add(self, media_id: str, key: Optional[tuple]):
+        """Put an entry in the group of a work (or in none, for key None)."""
+        self.remove(media_id)
+        if key is None:
+            return
+        self._entries[media_id] = key
+        self._groups.setdefault(key, set()).add(media_id)
+
+    def remove(self, media_id: str):
+        key = self._entries.pop(media_id, None)
+        if key is None:
+            return
+        group = self._groups[key]
+        group.discard(media_id)
+        if not group:
+            del self._groups[key]
+
+    def key_of(self, media_id: str) -> Optional[tuple]:
+        return self._entries.get(media_id)
+
+    def versions(self, media_id: str) -> List[str]:
+        """Get ids of every file of the same work, this one included."""
+        key = self._entries.get(media_id)
+        return list(self._groups[key]) if key is not None else [media_id]
+
+    def groups(self, min_size: int = 2) -> Iterator[Tuple[tuple, List[str]]]:
+        """Yield (work key, ids) of works with at least min_size files."""
+        for key, group in self._groups.items():
+            if len(group) >= min_size:
+                yield key, list(group)
+
+
+class SeriesIndex(_BulkIndex):
+    """
+    TV hierarchy: series -> season -> episodes in play order.
+
+    Series are keyed by library and normalised name, so "The.Office" and
+    "The Office" are one show. Next/previous links are worked out per
+    series when first needed after a change, then answered with a dict
+    lookup. Multi-episode files and several versions of one episode
+    are stepped over as one slot. Specials (season 0) form their own chain.
+    """
+
+    def __init__(self):
+        self._series: Dict[str, Dict[str, Any]] = {}  # series id -> name, library, chains, seasons
+        self._entries: Dict[str, Tuple[str, Optional[int], tuple]] = {}  # media id -> (series id, season, key)
+        self._next: Dict[str, str] = {}
+        self._prev: Dict[str, str] = {}
+        self._dirty: Set[Tuple[str, int]] = set()  # (series id, chain) needing relinking
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def series_id(library_id: str, series_name: str) -> str:
+        return f"{library_id}/{' '.join(tokenize(series_name))}"
+
+    def add(
+        self,
+        media_id: str,
+        library_id: str,
+        series_name: str,
+        season: Optional[int] = None,
+        episode: Optional[int] = None,
+        episode_end: Optional[int] = None,
+        air_date: Optional[str] = None,
+        title: str = "",
+    ):
+        """Insert an episode, replacing any previous version of it."""
+        self.remove(media_id)
+        series_id = self.series_id(library_id, series_name)
+        series = self._series.get(series_id)
+        if series is None:
+            series = self._series[series_id] = {
+                "name": series_name,
+                "library_id": library_id,
+                "chains": ([], []),  # regular episodes, specials
+                "seasons": {},  # season -> sorted keys
+            }
+        first = episode if episode is not None else 0
+        # Play order: season, first and last episode, air date; title and id break ties
+        key = (season if season is not None else 0, first, episode_end or first, air_date or "", title, media_id)
+        self._entries[media_id] = (series_id, season, key)
+        if self._bulk:
+            return
+        insort(series["chains"][season == 0], key)
+        insort(series["seasons"].setdefault(season, []), key)
+        self._dirty.add((series_id, season == 0))
+
+    def remove(self, media_id: str):
+        entry = self._entries.pop(media_id, None)
+        if entry is None:
+            return
+        if self._bulk:
+            self._next.pop(media_id, None)
+            self._prev.pop(media_id, None)
+            return
+        series_id, season, key = entry
+        series = self._series[series_id]
+        for items in (series["chains"][season == 0], series["seasons"][season]):
+            del items[bisect_left(items, key)]
+        if not series["seasons"][season]:
+            del series["seasons"][season]
+        self._next.pop(media_id, None)
+        self._prev.pop(media_id, None)
+        if series["seasons"]:
+            self._dirty.add((series_id, season == 0))
+        else:
+            del self._series[series_id]
+            self._dirty.discard((series_id, False))
+            self._dirty.discard((series_id, True))
+
+    def _rebuild(self):
+        for series in self._series.values():
+            series["chains"] = ([], [])
+            series["seasons"] = {}
+        for series_id, season, key in self._entries.values():
+            series = self._series[series_id]
+            series["chains"][season == 0].append(key)
+            series["seasons"].setdefault(season, []).append(key)
+        for series_id, series in list(self._series.items()):
+            if not series["seasons"]:
+                del self._series[series_id]
+                continue
+            for items in (*series["chains"], *series["seasons"].values()):
+                items.sort()
+        self._dirty = {(series_id, specials) for series_id in self._series for specials in (False, True)}
+
+    # ==================== Queries ====================
+
+    def series(self, library_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Summaries of all series (of one library), by name."""
+        result = [
+            {
+                "id": series_id,
+                "name": series["name"],
+                "library_id": series["library_id"],
+                "seasons": sum(1 for season in series["seasons"] if season),
+                "episodes": sum(len(chain) for chain in series["chains"]),
+            }
+            for series_id, series in self._series.items()
+            if library_id is None or series["library_id"] == library_id
+        ]
+        result.sort(key=lambda s: s["name"].casefold())
+        return result
+
+    def series_of(self, media_id: str) -> Optional[str]:
+        entry = self._entries.get(media_id)
+        return entry[0] if entry else None
+
+    def seasons(self, series_id: str) -> List[Tuple[Optional[int], int]]:
+        """(season number, episode count) pairs; unnumbered first, then specials, then in order."""
+        series = self._series.get(series_id)
+        if not series:
+            return []
+        return sorted(
+            ((season, len(keys)) for season, keys in series["seasons"].items()),
+            key=lambda item: -1 if item[0] is None else item[0],
+        )
+
+    def episodes(self, series_id: str, season: Optional[int] = None) -> List[str]:
+        """Ids of a season's episodes in play order; all regular episodes when season is None."""
+        series = self._series.get(series_id)
+        if not series:
+            return []
+        keys = series["chains"][0] if season is None else series["seasons"].get(season, [])
+        return [key[-1] for key in keys]
+
+    def next(self, media_id: str) -> Optional[str]:
+        """Id of the episode that plays after this one."""
+        self._relink_for(media_id)
+        return self._next.get(media_id)
+
+    def previous(self, media_id: str) -> Optional[str]:
+        """Id of the episode that plays before this one."""
+        self._relink_for(media_id)
+        return self._prev.get(media_id)
+
+    def _relink_for(self, media_id: str):
+        entry = self._entries.get(media_id)
+        if entry is not None and (entry[0], entry[1] == 0) in self._dirty:
+            self._relink(entry[0], entry[1] == 0)
+
+    def _relink(self, series_id: str, specials: bool):
+        """Recompute next/previous links of one chain of a series."""
+        self._dirty.discard((series_id, specials))
+        keys = self._series[series_id]["chains"][specials]
+
+        # Group versions of the same slot: (season, first episode, air date)
+        slots: List[List[tuple]] = []
+        for key in keys:
+            if slots and slots[-1][0][:2] + slots[-1][0][3:4] == key[:2] + key[3:4]:
+                slots[-1].append(key)
+            else:
+                slots.append([key])
+
+        for i, slot in enumerate(slots):
+            for key in slot:
+                media_id = key[-1]
+                # Skip slots covered by a multi-episode file
+                last = (key[0], key[2], key[3])
+                j = i + 1
+                while j < len(slots) and (slots[j][0][0], slots[j][0][1], slots[j][0][3]) <= last:
+                    j += 1
+                if j < len(slots):
+                    self._next[media_id] = slots[j][0][-1]
+                else:
+                    self._next.pop(media_id, None)
+                if i > 0:
+                    self._prev[media_id] = slots[i - 1][0][-1]
+                else:
+                    self._prev.pop(media_id, None)
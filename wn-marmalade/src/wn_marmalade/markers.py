@@ -0,0 +1,360 @@
+"""
+Marmalade Markers - chapters, intros and end credits.
+
+Chapters come with the probe data, and chapters titled like "Intro" or
+"Credits" give markers directly. Where they do not, episodes of a season
+are compared with each other: the opening and closing minutes of each
+file are reduced to an audio fingerprint (a few bits per eighth of a
+second describing how the energy of three frequency bands moves), and a
+stretch that recurs in other episodes is taken as the intro, or near the
+end as the credits. Fingerprints are computed once per file and kept in
+the store. Markers are saved on the MediaFile, so playback only reads them.
+"""
+
+import re
+import sys
+import asyncio
+import logging
+from array import array
+from typing import Dict, List, Optional, Any, Iterable, Sequence, Tuple, TYPE_CHECKING
+
+from .storage import MarmaladeStore
+
+if TYPE_CHECKING:
+    from .server import MarmaladeServer, MediaFile
+
+logger = logging.getLogger(__name__)
+
+_INTRO_RE = re.compile(r'\b(?:intro|opening|op|main title)\b', re.IGNORECASE)
+_CREDITS_RE = re.compile(r'\b(?:credits|ending|ed|outro|end title)\b', re.IGNORECASE)
+
+SAMPLE_RATE = 4000
+FRAME = 0.125  # seconds of audio per fingerprint code
+_FRAME_SAMPLES = int(SAMPLE_RATE * FRAME)
+_QUIET = 40 * _FRAME_SAMPLES * 3  # summed band energy below which a frame is silence
+_SILENT = 32  # code of silent frames; matches nothing
+_GRAM = 5  # codes per lookup key when aligning two fingerprints
+_COMMON_GRAM = 20  # keys seen this often in one file (steady tones) are ignored
+
+# Mono audio split into low, mid and high bands, as three interleaved channels
+_BANDS_FILTER = (
+    f"aresample={SAMPLE_RATE},aformat=channel_layouts=mono,asplit=3[a][b][c];"
+    "[a]lowpass=f=300[l];[b]bandpass=f=700:width_type=o:w=1.5[m];[c]highpass=f=1200[h];"
+    "[l][m][h]amerge=inputs=3"
+)
+
+
+def chapter_markers(chapters: Iterable[Tuple[float, float, str]]) -> Dict[str, float]:
+    """intro_start, intro_end and credits_start given by chapter titles."""
+    markers: Dict[str, float] = {}
+    for start, end, title in chapters:
+        if 'intro_start' not in markers and _INTRO_RE.search(title):
+            markers['intro_start'], markers['intro_end'] = start, end
+        elif 'credits_start' not in markers and _CREDITS_RE.search(title):
+            markers['credits_start'] = start
+    return markers
+
+
+def fingerprint(pcm: bytes) -> bytes:
+    """
+    One code per frame of three-band s16le audio: whether each band got
+    louder than in the previous frame, and how the bands compare.
+    """
+    samples = array('h')
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % 6])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    n = _FRAME_SAMPLES
+    frames = len(samples) // (3 * n)
+    low, mid, high = (
+        [sum(map(abs, band[i * n:(i + 1) * n])) for i in range(frames)]
+        for band in (samples[0::3], samples[1::3], samples[2::3])
+    )
+
+    codes = bytearray(frames)
+    prev = None
+    for i in range(frames):
+        current = (low[i], mid[i], high[i])
+        if sum(current) < _QUIET:
+            codes[i] = _SILENT
+            prev = None
+            continue
+        if prev is None:
+            prev = current
+        codes[i] = (
+            (current[0] > prev[0])
+            | (current[1] > prev[1]) << 1
+            | (current[2] > prev[2]) << 2
+            | (current[0] > current[1]) << 3
+            | (current[1] > current[2]) << 4
+        )
+        prev = current
+    return bytes(codes)
+
+
+def _aligned_run(a: bytes, b: bytes, offset: int) -> Optional[Tuple[int, int]]:
+    """Best-matching stretch [start, end) of a against b shifted by offset."""
+    best, best_score = None, 0.0
+    score, start = 0.0, None
+    for i in range(max(0, -offset), min(len(a), len(b) - offset)):
+        x, y = a[i], b[i + offset]
+        if x == y and x != _SILENT:
+            if start is None:
+                start = i
+            score += 1
+            if score > best_score:
+                best, best_score = (start, i + 1), score
+        elif x != _SILENT or y != _SILENT:
+            score -= 1  # a stretch survives the odd frame that differs
+            if score <= 0:
+                score, start = 0.0, None
+    return best
+
+
+def common_segment(a: bytes, b: bytes, min_frames: int) -> Optional[Tuple[int, int, int]]:
+    """
+    Longest stretch of a that also occurs in b, as (start, end) in a and
+    start in b, in frames. None if shorter than min_frames.
+    """
+    positions: Dict[bytes, List[int]] = {}
+    for j in range(len(b) - _GRAM + 1):
+        gram = b[j:j + _GRAM]
+        if _SILENT not in gram:
+            positions.setdefault(gram, []).append(j)
+
+    votes: Dict[int, int] = {}
+    for i in range(len(a) - _GRAM + 1):
+        found = positions.get(a[i:i + _GRAM])
+        if found and len(found) < _COMMON_GRAM:
+            for j in found:
+                votes[j - i] = votes.get(j - i, 0) + 1
+
+    best = None
+    for offset in sorted(votes, key=votes.get, reverse=True)[:3]:
+        run = _aligned_run(a, b, offset)
+        if run and (best is None or run[1] - run[0] > best[1] - best[0]):
+            best = (run[0], run[1], run[0] + offset)
+    if best is None or best[1] - best[0] < min_frames:
+        return None
+    return best
+
+
+def find_recurring(
+    prints: Sequence[Tuple[str, Any, bytes]],
+    min_frames: int,
+    max_frames: Optional[int] = None,
+    neighbours: int = 3,
+) -> Dict[str, Tuple[int, int]]:
+    """
+    For (media id, episode key, fingerprint) entries of one season, find
+    the stretch of each that recurs in nearby episodes, in frames. Files
+    with the same episode key are versions of one episode and are not
+    compared with each other.
+    """
+    pairs: Dict[Tuple[int, int], Optional[Tuple[int, int, int]]] = {}
+    result: Dict[str, Tuple[int, int]] = {}
+    for i, (media_id, key, codes) in enumerate(prints):
+        others = sorted(
+            (j for j, other in enumerate(prints) if other[1] != key),
+            key=lambda j: abs(j - i),
+        )[:neighbours]
+        best = None
+        for j in others:
+            if (j, i) in pairs:
+                found = pairs[(j, i)]
+                # Same match seen from the other file
+                segment = (found[2], found[2] + found[1] - found[0]) if found else None
+            else:
+                found = pairs[(i, j)] = common_segment(codes, prints[j][2], min_frames)
+                segment = found[:2] if found else None
+            if segment is None or (max_frames and segment[1] - segment[0] > max_frames):
+                continue
+            if best is None or segment[1] - segment[0] > best[1] - best[0]:
+                best = segment
+        if best:
+            result[media_id] = best
+    return result
+
+
+class MarkerAnalyzer:
+    """
+    Detects intros and end credits of episodes in the background, season
+    by season, for episodes whose chapters did not provide them.
+    """
+
+    def __init__(
+        self,
+        server: 'MarmaladeServer',
+        store: MarmaladeStore,
+        ffmpeg_path: str = "ffmpeg",
+        head: float = 600.0,
+        tail: float = 300.0,
+        min_length: float = 15.0,
+        max_intro: float = 150.0,
+        neighbours: int = 3,
+        concurrency: int = 1,
+        batch_delay: float = 10.0,
+        job_timeout: float = 300.0,
+    ):
+        self.server = server
+        self._store = store
+        self.ffmpeg_path = ffmpeg_path
+        self.head = head  # seconds from the start searched for an intro
+        self.tail = tail  # seconds before the end searched for credits
+        self.min_length = min_length  # seconds a recurring stretch must last
+        self.max_intro = max_intro  # seconds; longer matches are not intros
+        self.neighbours = neighbours  # episodes each one is compared with
+        self.concurrency = max(1, concurrency)  # ffmpeg processes at once
+        self.batch_delay = batch_delay  # seconds to collect queued seasons before a batch
+        self.job_timeout = job_timeout
+
+        self._semaphore: Optional[asyncio.Semaphore] = None  # created on the running loop
+        self._queued: Dict[Tuple[str, Optional[int]], None] = {}  # (series id, season), in order
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.stats = {"fingerprinted": 0, "intros": 0, "credits": 0, "failed": 0}
+
+    # ==================== Fingerprints ====================
+
+    async def _extract(self, path: str, length: float, from_end: bool) -> bytes:
+        args = [self.ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-nostdin']
+        if from_end:
+            args += ['-sseof', f"-{length:.0f}"]
+        args += ['-i', path, '-t', f"{length:.0f}", '-vn', '-map', '0:a:0',
+                 '-af', _BANDS_FILTER, '-f', 's16le', 'pipe:1']
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), self.job_timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise RuntimeError("ffmpeg timed out")
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with {proc.returncode}: {stderr.decode(errors='replace').strip()}")
+        return stdout
+
+    async def _fingerprints(self, media: 'MediaFile') -> Optional[Tuple[bytes, bytes]]:
+        """(head, tail) fingerprints of a file, from the store when unchanged."""
+        loop = asyncio.get_running_loop()
+        executor = self.server._executor
+        cached = await loop.run_in_executor(
+            executor, self._store.get_fingerprints, media.path, media.size, media.modified_date
+        )
+        if cached is not None:
+            return cached
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            async with self._semaphore:
+                head_pcm = await self._extract(media.path, min(self.head, media.duration or self.head), False)
+                tail_pcm = await self._extract(media.path, min(self.tail, media.duration or self.tail), True)
+            head = await loop.run_in_executor(executor, fingerprint, head_pcm)
+            tail = await loop.run_in_executor(executor, fingerprint, tail_pcm)
+        except Exception as e:
+            logger.warning(f"Cannot fingerprint {media.path}: {e}")
+            self.stats["failed"] += 1
+            return None
+        self.server._persist(
+            f"saving fingerprints of {media.path}", self._store.put_fingerprints,
+            media.path, media.size, media.modified_date, head, tail,
+        )
+        self.stats["fingerprinted"] += 1
+        return head, tail
+
+    # ==================== Detection ====================
+
+    async def analyse_season(self, series_id: str, season: Optional[int]) -> List['MediaFile']:
+        """
+        Fill in missing intro and credits markers of a season's episodes.
+        Season None means the episodes without a season number, not the
+        whole series. Returns the items that changed.
+        """
+        episodes = [m for m in self.server.get_episodes(series_id, season) if m.season_number == season]
+        if len(episodes) < 2 or all(m.intro_start is not None and m.credits_start is not None for m in episodes):
+            return []
+
+        prints = await asyncio.gather(*(self._fingerprints(m) for m in episodes))
+        found = [(m, p) for m, p in zip(episodes, prints) if p is not None]
+        keys = {m.id: (m.season_number, m.episode_number, m.air_date) for m, _ in found}
+        min_frames = int(self.min_length / FRAME)
+        loop = asyncio.get_running_loop()
+        intros = await loop.run_in_executor(
+            self.server._executor, find_recurring, [(m.id, keys[m.id], p[0]) for m, p in found],
+            min_frames, int(self.max_intro / FRAME), self.neighbours,
+        )
+        credits = await loop.run_in_executor(
+            self.server._executor, find_recurring, [(m.id, keys[m.id], p[1]) for m, p in found],
+            min_frames, None, self.neighbours,
+        )
+
+        changed = []
+        for media, _ in found:
+            updated = False
+            if media.intro_start is None and media.id in intros:
+                start, end = intros[media.id]
+                media.intro_start, media.intro_end = round(start * FRAME, 3), round(end * FRAME, 3)
+                self.stats["intros"] += 1
+                updated = True
+            if media.credits_start is None and media.id in credits and media.duration:
+                tail_start = max(0.0, media.duration - self.tail)
+                media.credits_start = round(tail_start + credits[media.id][0] * FRAME, 3)
+                self.stats["credits"] += 1
+                updated = True
+            if updated:
+                changed.append(media)
+        return changed
+
+    # ==================== Background ====================
+
+    def enqueue_media(self, media: Iterable['MediaFile']):
+        """Queue the seasons of new or changed episodes for the next background batch."""
+        if self._task is None:
+            return
+        for item in media:
+            series_id = self.server._series.series_of(item.id)
+            if series_id is not None:
+                self._queued[(series_id, item.season_number)] = None
+        if self._queued:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.batch_delay)  # let the rest of a scan batch arrive
+            self._wakeup.clear()
+            seasons, self._queued = list(self._queued), {}
+            for series_id, season in seasons:
+                try:
+                    changed = await self.analyse_season(series_id, season)
+                    if changed:
+                        self.server._save_media(changed)
+                except Exception as e:
+                    logger.error(f"Marker detection error for {series_id} season {season}: {e}")
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "queued": len(self._queued),
+            **self.stats,
+        }
@@ -0,0 +1,356 @@
+"""
+Marmalade Metadata - TMDB enrichment of the media catalogue.
+
+Items without a tmdb_id are grouped before any request is made: movies
+by normalised title and year, episodes by series and then by season. Each
+group costs one search (plus one season request per season), however many
+files it has. Requests go through a token bucket so the API rate limit is
+respected. Responses are cached in the Marmalade store with a TTL, so
+rescans and restarts do not repeat lookups; "no match" answers are cached
+too, for a shorter time.
+
+After scans, new items are queued and enriched in batches in the background.
+"""
+
+import re
+import sys
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Any, Iterable, Tuple, TYPE_CHECKING
+
+import httpx
+
+from .index import tokenize
+from .storage import MarmaladeStore
+
+if TYPE_CHECKING:
+    from .server import MarmaladeServer, MediaFile
+
+logger = logging.getLogger(__name__)
+
+TMDB_API_URL = "https://api.themoviedb.org/3"
+TMDB_IMAGE_URL = "https://image.tmdb.org/t/p"
+
+_TRAILING_YEAR_RE = re.compile(r'^(?P<name>.+?)\s+\(?(?P<year>(?:19|20)\d{2})\)?$')
+
+
+def normalise_title(title: str) -> str:
+    """Casefolded words only, so "The.Office (US)" and "the office us" group together."""
+    return " ".join(tokenize(title))
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, in bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class MetadataEnricher:
+    """
+    Fills tmdb_id, overview, artwork URLs, rating, year and genres of
+    media files from TMDB. Does nothing without an API key.
+    """
+
+    MAX_RETRIES = 3
+
+    def __init__(
+        self,
+        server: 'MarmaladeServer',
+        store: MarmaladeStore,
+        api_key: Optional[str] = None,
+        base_url: str = TMDB_API_URL,
+        image_base_url: str = TMDB_IMAGE_URL,
+        language: str = "en-US",
+        rate: float = 4.0,
+        burst: int = 40,
+        concurrency: int = 4,
+        cache_ttl: float = 7 * 86400,
+        negative_ttl: float = 86400,
+        batch_delay: float = 5.0,
+    ):
+        self.server = server
+        self._store = store
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.image_base_url = image_base_url.rstrip('/')
+        self.language = language
+        self.concurrency = max(1, concurrency)  # requests in flight
+        self.cache_ttl = cache_ttl  # seconds
+        self.negative_ttl = negative_ttl  # seconds, for searches without results
+        self.batch_delay = batch_delay  # seconds to collect queued items before a batch
+        self._bucket = TokenBucket(rate, burst)
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None  # created on the running loop
+        self._genres: Dict[str, Dict[int, str]] = {}
+        self._queued: Dict[str, None] = {}  # media ids, in order
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.stats = {"requests": 0, "cache_hits": 0, "enriched": 0, "unmatched": 0, "errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_key)
+
+    # ==================== HTTP ====================
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            headers = {"Accept": "application/json"}
+            if self.api_key and self.api_key.startswith("eyJ"):
+                # v4 read access token
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            self._client = httpx.AsyncClient(base_url=self.base_url, headers=headers, timeout=30.0)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._client
+
+    async def _get(self, path: str, **params) -> Optional[Dict[str, Any]]:
+        """GET an API path through the response cache. None on failure."""
+        params = {k: v for k, v in params.items() if v is not None}
+        params.setdefault("language", self.language)
+        key = path + "?" + "&".join(f"{k}={params[k]}" for k in sorted(params))
+        cached = await asyncio.get_running_loop().run_in_executor(
+            self.server._executor, self._store.get_cached_response, key, time.time()
+        )
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            return cached
+
+        client = self._get_client()
+        if not self.api_key.startswith("eyJ"):
+            params["api_key"] = self.api_key
+
+        async with self._semaphore:
+            for attempt in range(self.MAX_RETRIES + 1):
+                await self._bucket.acquire()
+                self.stats["requests"] += 1
+                try:
+                    response = await client.get(path, params=params)
+                except httpx.HTTPError as e:
+                    logger.warning(f"TMDB request {path} failed: {e}")
+                    response = None
+
+                if response is not None and response.status_code == 200:
+                    data = response.json()
+                    ttl = self.negative_ttl if data.get("results") == [] else self.cache_ttl
+                    self.server._persist(
+                        f"caching TMDB response {path}", self._store.put_cached_response,
+                        key, data, time.time() + ttl,
+                    )
+                    return data
+                if response is not None and response.status_code == 404:
+                    self.server._persist(
+                        f"caching TMDB response {path}", self._store.put_cached_response,
+                        key, {}, time.time() + self.negative_ttl,
+                    )
+                    return {}
+                if response is not None and response.status_code not in (429, 500, 502, 503, 504):
+                    logger.error(f"TMDB request {path} returned {response.status_code}")
+                    break
+                if attempt < self.MAX_RETRIES:
+                    retry_after = response.headers.get("Retry-After") if response is not None else None
+                    await asyncio.sleep(float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt)
+
+        self.stats["errors"] += 1
+        return None
+
+    async def _genre_names(self, kind: str) -> Dict[int, str]:
+        if kind not in self._genres:
+            data = await self._get(f"/genre/{kind}/list")
+            if data is None:
+                return {}
+            self._genres[kind] = {g["id"]: sys.intern(g["name"]) for g in data.get("genres", [])}
+        return self._genres[kind]
+
+    def _image(self, path: Optional[str], size: str) -> str:
+        return f"{self.image_base_url}/{size}{path}" if path else ""
+
+    # ==================== Enrichment ====================
+
+    async def enrich(self, media: Iterable['MediaFile']) -> List['MediaFile']:
+        """Look up items that have no tmdb_id yet. Returns the items that changed."""
+        if not self.enabled:
+            return []
+
+        movies: Dict[Tuple[str, Optional[int]], List['MediaFile']] = {}
+        shows: Dict[Tuple[str, Optional[int]], Dict[Optional[int], List['MediaFile']]] = {}
+        for item in media:
+            if item.tmdb_id is not None:
+                continue
+            if item.media_type.value == "movie":
+                key = (normalise_title(item.title), item.year)
+                if key[0]:
+                    movies.setdefault(key, []).append(item)
+            elif item.media_type.value == "episode" and item.series_name:
+                name, year = item.series_name, None
+                match = _TRAILING_YEAR_RE.match(name)
+                if match:
+                    name, year = match.group("name"), int(match.group("year"))
+                key = (normalise_title(name), year)
+                if key[0]:
+                    shows.setdefault(key, {}).setdefault(item.season_number, []).append(item)
+
+        if not movies and not shows:
+            return []
+
+        # Genre lists are shared by every group; fetch them once up front
+        if movies:
+            await self._genre_names("movie")
+        if shows:
+            await self._genre_names("tv")
+        results = await asyncio.gather(
+            *(self._enrich_movie(title, year, items) for (title, year), items in movies.items()),
+            *(self._enrich_show(name, year, seasons) for (name, year), seasons in shows.items()),
+        )
+        # Items removed while their lookup was in flight are not brought back
+        changed = [item for group in results for item in group if self.server.media_files.get(item.id) is item]
+        self.stats["enriched"] += len(changed)
+        for item in changed:
+            self.server._put_media_entry(item)  # the year is part of index keys
+        if changed:
+            self.server._save_media(changed)
+        logger.info(f"Metadata enrichment: {len(movies)} movie and {len(shows)} show groups, {len(changed)} items updated")
+        return changed
+
+    def _best(
+        self,
+        results: List[Dict[str, Any]],
+        title: str,
+        year: Optional[int],
+        title_key: str,
+        date_key: str,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        The result whose title matches, or failing that the first one from
+        the same year. None rather than a guess when neither is found.
+        """
+        for result in results:
+            if normalise_title(result.get(title_key, "")) == title:
+                return result
+        if year is not None:
+            for result in results:
+                if (result.get(date_key) or "")[:4] == str(year):
+                    return result
+        return None
+
+    async def _enrich_movie(self, title: str, year: Optional[int], items: List['MediaFile']) -> List['MediaFile']:
+        data = await self._get("/search/movie", query=title, year=year)
+        result = self._best(data.get("results", []), title, year, "title", "release_date") if data else None
+        if not result:
+            self.stats["unmatched"] += len(items)
+            return []
+
+        genres = await self._genre_names("movie")
+        release_year = (result.get("release_date") or "")[:4]
+        for item in items:
+            item.tmdb_id = result["id"]
+            item.overview = result.get("overview") or ""
+            item.poster_url = self._image(result.get("poster_path"), "w500")
+            item.backdrop_url = self._image(result.get("backdrop_path"), "w1280")
+            item.rating = float(result.get("vote_average") or 0)
+            item.genres = tuple(genres[g] for g in result.get("genre_ids", []) if g in genres)
+            if item.year is None and release_year.isdigit():
+                item.year = int(release_year)
+        return items
+
+    async def _enrich_show(
+        self,
+        name: str,
+        year: Optional[int],
+        seasons: Dict[Optional[int], List['MediaFile']],
+    ) -> List['MediaFile']:
+        data = await self._get("/search/tv", query=name, first_air_date_year=year)
+        show = self._best(data.get("results", []), name, year, "name", "first_air_date") if data else None
+        if not show:
+            self.stats["unmatched"] += sum(len(items) for items in seasons.values())
+            return []
+
+        genres = await self._genre_names("tv")
+        show_genres = tuple(genres[g] for g in show.get("genre_ids", []) if g in genres)
+        numbers = [number for number in seasons if number is not None]
+        fetched = await asyncio.gather(*(self._get(f"/tv/{show['id']}/season/{n}") for n in numbers))
+        season_data = dict(zip(numbers, fetched))
+
+        changed = []
+        for number, items in seasons.items():
+            season = season_data.get(number) or {}
+            episodes = {ep.get("episode_number"): ep for ep in season.get("episodes", [])}
+            for item in items:
+                episode = episodes.get(item.episode_number, {})
+                item.tmdb_id = show["id"]
+                item.overview = episode.get("overview") or show.get("overview") or ""
+                item.poster_url = self._image(show.get("poster_path"), "w500")
+                item.backdrop_url = self._image(
+                    episode.get("still_path") or show.get("backdrop_path"), "w1280"
+                )
+                item.rating = float(episode.get("vote_average") or show.get("vote_average") or 0)
+                item.genres = show_genres
+                changed.append(item)
+        return changed
+
+    # ==================== Background ====================
+
+    def enqueue_media(self, media: Iterable['MediaFile']):
+        """Queue items for enrichment in the next background batch."""
+        if not self.enabled or self._task is None:
+            return
+        for item in media:
+            if item.tmdb_id is None:
+                self._queued[item.id] = None
+        if self._queued:
+            self._wakeup.set()
+
+    async def start(self):
+        if self.enabled and self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.batch_delay)  # let the rest of a scan batch arrive
+            self._wakeup.clear()
+            ids, self._queued = list(self._queued), {}
+            media = [m for m in (self.server.get_media(mid) for mid in ids) if m]
+            try:
+                await self.enrich(media)
+                self.server._persist(
+                    "purging TMDB responses", self._store.purge_cached_responses, time.time()
+                )
+            except Exception as e:
+                logger.error(f"Metadata enrichment error: {e}")
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "running": self._task is not None,
+            "queued": len(self._queued),
+            **self.stats,
+        }
@@ -0,0 +1,226 @@
+"""
+Marmalade Naming - release-name parsing.
+
+Every episode layout Marmalade understands is one alternative of a single
+compiled regex, so a name is scanned once whatever layout it uses; the
+alternative that matched picks how its fields are read. When a filename
+leaves something out (e.g. "Show/Season 2/Episode 03.mkv"), folder names
+fill it in. parse_release_names() parses a whole listing and reads each
+directory only once.
+"""
+
+import os
+import re
+from typing import Dict, List, Optional, Any, Iterable, Tuple
+
+_SEP = r'[\s._\-]'
+
+# Episode markers, best first. When several are found in one name the
+# highest ranked wins, regardless of where it appears.
+_EPISODE_MARKERS: List[Tuple[str, str]] = [
+    # Show.S01E01, S01E01E02, S01E01-E02, S01E01-02
+    ('se', rf'(?<![a-z0-9])s(?P<se_season>\d{{1,3}}){_SEP}*e(?P<se_episode>\d{{1,4}})'
+           rf'(?:(?:{_SEP}*e|-)(?P<se_end>\d{{1,4}}))*(?![\dp])'),
+    # Show - 1x01, 1x01-1x02, 1x01-02
+    ('x', rf'(?<![a-z0-9])(?P<x_season>\d{{1,2}})x(?P<x_episode>\d{{2,3}})'
+          rf'(?:{_SEP}*(?:\d{{1,2}}x|-)(?P<x_end>\d{{2,3}}))?(?![a-z0-9])'),
+    # Show Season 1 Episode 3
+    ('words', rf'(?<![a-z0-9])season{_SEP}*(?P<words_season>\d{{1,3}}){_SEP}*'
+              rf'episode{_SEP}*(?P<words_episode>\d{{1,4}})(?!\d)'),
+    # Daily shows: Show.2023.05.14
+    ('date', rf'(?<!\d)(?P<date_year>(?:19|20)\d{{2}}){_SEP}(?P<date_month>0[1-9]|1[0-2])'
+             rf'{_SEP}(?P<date_day>0[1-9]|[12]\d|3[01])(?!\d)'),
+    # Episode 03, Ep03, E03-04
+    ('ep', rf'(?<![a-z0-9])(?:episode|ep|e){_SEP}*(?P<ep_episode>\d{{1,4}})'
+           rf'(?:-(?P<ep_end>\d{{1,4}}))?(?![a-z0-9])'),
+    # Absolute numbering: [Group] Show - 123 [1080p]
+    ('absolute', rf'(?:(?<={_SEP})|^)-{_SEP}*(?!(?:19|20)\d\d(?!\d))(?P<absolute_episode>\d{{1,4}})'
+                 rf'(?:v\d)?(?!\w|[.\-]\d)'),
+    # A bare leading number: "03 - Pilot.mkv" inside a season folder
+    ('lead', r'^(?P<lead_episode>\d{1,3})(?![\dp])'),
+]
+
+# Every marker starts with one of these characters; checking that first lets
+# the engine skip most positions without trying each alternative
+_EPISODE_RE = re.compile(
+    r'(?=[\dse\-])(?:'
+    + '|'.join(f'(?P<{name}>{pattern})' for name, pattern in _EPISODE_MARKERS)
+    + ')',
+    re.IGNORECASE,
+)
+_RANK = {name: rank for rank, (name, _) in enumerate(_EPISODE_MARKERS)}
+# Group names holding (episode, season, last episode) for each marker
+_FIELDS = {
+    name: tuple(
+        group if group in _EPISODE_RE.groupindex else None
+        for group in (f'{name}_episode', f'{name}_season', f'{name}_end')
+    )
+    for name, _ in _EPISODE_MARKERS
+}
+
+# Year candidates and the release tags that end a movie title, in one pass
+_MOVIE_RE = re.compile(
+    r'(?<![a-z0-9])[(\[]?(?P<year>(?:19|20)\d{2})[)\]]?(?![a-z0-9])'
+    r'|(?<![a-z0-9])(?P<tag>2160p|1080p|720p|576p|480p|blu-?ray|bdrip|brrip|web-?dl|webrip'
+    r'|hdtv|dvdrip|hdrip|x26[45]|h\.?26[45]|hevc|xvid|remux)(?![a-z0-9])',
+    re.IGNORECASE,
+)
+
+_SEASON_DIR_RE = re.compile(
+    rf'^(?:(?:season|series|staffel|saison){_SEP}*|s)(?P<season>\d{{1,3}})$|^(?P<specials>specials?)$',
+    re.IGNORECASE,
+)
+_GROUP_TAGS_RE = re.compile(r'\[[^\]]*\]')
+_SPACING_RE = re.compile(r'[._\s]+')
+
+
+def _clean(text: str) -> str:
+    """Turn a dotted/underscored release fragment into a readable title."""
+    text = _GROUP_TAGS_RE.sub(' ', text)
+    text = _SPACING_RE.sub(' ', text)
+    return text.strip(' -([')
+
+
+def _match_episode(stem: str) -> Optional[re.Match]:
+    best = None
+    for match in _EPISODE_RE.finditer(stem):
+        if best is None or _RANK[match.lastgroup] < _RANK[best.lastgroup]:
+            best = match
+            if _RANK[best.lastgroup] == 0:
+                break
+    return best
+
+
+def _episode_fields(match: re.Match) -> Dict[str, Any]:
+    kind = match.lastgroup
+    if kind == 'date':
+        return {'air_date': '-'.join(match.group('date_year', 'date_month', 'date_day'))}
+
+    episode_group, season_group, end_group = _FIELDS[kind]
+    fields: Dict[str, Any] = {'episode': int(match.group(episode_group))}
+    season = match.group(season_group) if season_group else None
+    if season is not None:
+        fields['season'] = int(season)
+    end = match.group(end_group) if end_group else None
+    if end is not None and int(end) > fields['episode']:
+        fields['episode_end'] = int(end)
+    return fields
+
+
+def _parse_season_dir(name: str) -> Optional[int]:
+    match = _SEASON_DIR_RE.match(name.strip())
+    if not match:
+        return None
+    return 0 if match.group('specials') else int(match.group('season'))
+
+
+def _folder_context(directory: str, root: Optional[str]) -> Dict[str, Any]:
+    """Series name and season implied by the folders a file sits in."""
+    if root is not None:
+        root = root.rstrip(os.sep)
+    context: Dict[str, Any] = {}
+    parts = []
+    while directory and (root is None or len(directory) > len(root)):
+        parent, name = os.path.split(directory)
+        if not name or parent == directory:
+            break
+        parts.append(name)
+        if len(parts) == 2:
+            break
+        directory = parent
+
+    if parts:
+        season = _parse_season_dir(parts[0])
+        if season is not None:
+            context['season'] = season
+            if len(parts) > 1:
+                context['series_name'] = _clean(parts[1])
+        else:
+            context['series_name'] = _clean(parts[0])
+    return context
+
+
+def _parse_tv(stem: str, folder: Dict[str, Any]) -> Dict[str, Any]:
+    match = _match_episode(stem)
+    if match is None or (match.lastgroup == 'lead' and 'season' not in folder):
+        result = {'title': _clean(stem) or stem}
+        if folder.get('series_name'):
+            result['series_name'] = folder['series_name']
+        return result
+
+    result = _episode_fields(match)
+    series = _clean(stem[:match.start()]) or folder.get('series_name', '')
+    if series:
+        result['series_name'] = series
+    if 'season' not in result and 'episode' in result and 'season' in folder:
+        result['season'] = folder['season']
+
+    if 'air_date' in result:
+        label = result['air_date']
+    else:
+        label = f"E{result['episode']:02d}"
+        if 'season' in result:
+            label = f"S{result['season']:02d}{label}"
+        if 'episode_end' in result:
+            label += f"-E{result['episode_end']:02d}"
+    result['title'] = f"{series} {label}" if series else label
+    return result
+
+
+def _parse_movie(stem: str) -> Dict[str, Any]:
+    year_match = None
+    cut = len(stem)
+    for match in _MOVIE_RE.finditer(stem):
+        if match.group('tag'):
+            cut = match.start()
+            break
+        if match.start() > 0:
+            year_match = match  # the last year before any tag, so "2001.A.Space.Odyssey.1968" works
+
+    if year_match:
+        return {'title': _clean(stem[:year_match.start()]), 'year': int(year_match.group('year'))}
+    return {'title': _clean(stem[:cut]) or _clean(stem) or stem}
+
+
+def parse_release_name(
+    path: str,
+    media_type: str,
+    root: Optional[str] = None,
+    _folders: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    Parse a release path into title, year, series_name, season, episode,
+    episode_end and air_date (keys are present only when known).
+    Folders below root are consulted for what the filename lacks.
+    """
+    directory, _, filename = path.rpartition(os.sep)
+    stem, dot, _ = filename.rpartition('.')
+    if not dot:
+        stem = filename
+
+    if _folders is not None:
+        folder = _folders.get(directory)
+        if folder is None:
+            folder = _folders[directory] = _folder_context(directory, root)
+    else:
+        folder = _folder_context(directory, root)
+
+    if media_type == 'tv':
+        return _parse_tv(stem, folder)
+
+    if folder.get('series_name'):
+        # "Movie (2020)/movie.mkv": a folder per movie carries the proper name
+        from_folder = _parse_movie(folder['series_name'])
+        if 'year' in from_folder:
+            return from_folder
+    return _parse_movie(stem)
+
+
+def parse_release_names(
+    paths: Iterable[str],
+    media_type: str,
+    root: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Parse a batch of paths, reading each distinct directory once."""
+    folders: Dict[str, Dict[str, Any]] = {}
+    return [parse_release_name(path, media_type, root, folders) for path in paths]
@@ -0,0 +1,210 @@
+"""
+Marmalade Scheduler - periodic library scans.
+
+Libraries are rescanned when their scan_interval has elapsed since
+last_scan. Scans are grouped by the device their path lives on: at most
+max_per_device scans run on one device at a time, and scan starts on
+one device are spaced by a stagger delay, so several libraries on one
+spinning disk are not scanned all at once. While anything is being
+streamed or transcoded, scheduled scans hold off between directories and
+files until playback stops. Scans started by hand are not affected.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .server import MarmaladeServer, Library
+
+logger = logging.getLogger(__name__)
+
+
+class ScanScheduler:
+    """Runs due library scans in the background within per-device limits."""
+
+    def __init__(
+        self,
+        server: 'MarmaladeServer',
+        tick: float = 30.0,
+        max_per_device: int = 1,
+        stagger: float = 60.0,
+        pause_for_streams: bool = True,
+    ):
+        self.server = server
+        self.tick = tick  # seconds between checks for due libraries
+        self.max_per_device = max(1, max_per_device)  # concurrent scans per filesystem
+        self.stagger = stagger  # seconds between scan starts on one device
+        self.pause_for_streams = pause_for_streams
+
+        self._queue: Dict[str, float] = {}  # library id -> time it was queued, in order
+        self._running: Dict[str, asyncio.Task] = {}  # library id -> scan task
+        self._last_start: Dict[int, float] = {}  # device -> monotonic time of last scan start
+        self._task: Optional[asyncio.Task] = None
+        # Set on the loop while playback is active; scans read it from their walking thread
+        self._paused = threading.Event()
+        self._playback_task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self._playback_task = asyncio.create_task(self._track_playback())
+            logger.info("Scan scheduler started")
+
+    async def stop(self):
+        """Stop scheduling; scans already running are cancelled."""
+        for task in (self._task, self._playback_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._playback_task = None
+        self._paused.clear()
+        for task in list(self._running.values()):
+            task.cancel()
+        await asyncio.gather(*self._running.values(), return_exceptions=True)
+        self._running.clear()
+        self._queue.clear()
+
+    def scan_now(self, library_id: str) -> bool:
+        """Queue a library ahead of its interval (still subject to the device limits)."""
+        if library_id not in self.server.libraries:
+            return False
+        if library_id not in self._queue and library_id not in self._running:
+            self._queue[library_id] = time.time()
+        return True
+
+    def should_pause(self) -> bool:
+        """True while playback is using the disks. Reads loop-owned state; call on the loop."""
+        return self.pause_for_streams and self.server.active_streams() > 0
+
+    async def _track_playback(self):
+        """Mirror should_pause() into the event that scheduled scans poll."""
+        while True:
+            if self.should_pause():
+                self._paused.set()
+            else:
+                self._paused.clear()
+            await asyncio.sleep(self.server.SCAN_PAUSE_POLL)
+
+    async def _run(self):
+        while True:
+            try:
+                self._queue_due()
+                await self._dispatch()
+            except Exception as e:
+                logger.error(f"Scan scheduler error: {e}")
+            await asyncio.sleep(self.tick)
+
+    # ==================== Queue ====================
+
+    def _is_due(self, library: 'Library', now: float) -> bool:
+        if not library.enabled or library.scan_interval <= 0:
+            return False
+        if not library.last_scan:
+            return True
+        try:
+            last = datetime.fromisoformat(library.last_scan).timestamp()
+        except ValueError:
+            return True
+        return now - last >= library.scan_interval
+
+    def _queue_due(self):
+        now = time.time()
+        for library_id, library in self.server.libraries.items():
+            if library_id in self._queue or library_id in self._running:
+                continue
+            if self.server.scan_progress.get(library_id, {}).get("status") in ("walking", "probing", "paused"):
+                continue  # started by hand
+            if self._is_due(library, now):
+                self._queue[library_id] = now
+        for library_id in [lid for lid in self._queue if lid not in self.server.libraries]:
+            del self._queue[library_id]
+
+    @staticmethod
+    def _devices(paths: Dict[str, str]) -> Dict[str, Optional[int]]:
+        devices: Dict[str, Optional[int]] = {}
+        for library_id, path in paths.items():
+            try:
+                devices[library_id] = os.stat(path).st_dev
+            except OSError:
+                devices[library_id] = None
+        return devices
+
+    async def _dispatch(self):
+        """Start queued scans that fit within the per-device limits."""
+        paths = {
+            library_id: self.server.libraries[library_id].path
+            for library_id in set(self._running) | set(self._queue)
+            if library_id in self.server.libraries
+        }
+        devices = await asyncio.get_running_loop().run_in_executor(
+            self.server._executor, self._devices, paths
+        )
+        now = time.monotonic()
+        busy: Dict[int, int] = {}
+        for library_id in self._running:
+            device = devices.get(library_id)
+            if device is not None:
+                busy[device] = busy.get(device, 0) + 1
+
+        for library_id in list(self._queue):
+            if library_id not in devices and library_id in self.server.libraries:
+                continue  # queued while the paths were being checked
+            device = devices.get(library_id)
+            if device is None or library_id not in self.server.libraries:
+                del self._queue[library_id]  # library gone or path unavailable
+                continue
+            if busy.get(device, 0) >= self.max_per_device:
+                continue
+            if now - self._last_start.get(device, -self.stagger) < self.stagger:
+                continue
+            del self._queue[library_id]
+            busy[device] = busy.get(device, 0) + 1
+            self._last_start[device] = now
+            self._running[library_id] = asyncio.create_task(self._scan(library_id))
+
+    async def _scan(self, library_id: str):
+        try:
+            await self.server.scan_library(library_id, pause=self._paused.is_set)
+        except Exception as e:
+            logger.error(f"Scheduled scan of {library_id} failed: {e}")
+        finally:
+            self._running.pop(library_id, None)
+
+    def get_status(self) -> Dict[str, Any]:
+        now = time.time()
+        upcoming: List[Dict[str, Any]] = []
+        for library_id, library in self.server.libraries.items():
+            if not library.enabled or library.scan_interval <= 0:
+                continue
+            next_scan = None
+            if library.last_scan:
+                try:
+                    next_scan = datetime.fromtimestamp(
+                        datetime.fromisoformat(library.last_scan).timestamp() + library.scan_interval,
+                        tz=timezone.utc,
+                    ).isoformat()
+                except ValueError:
+                    pass
+            upcoming.append({"library_id": library_id, "name": library.name, "next_scan": next_scan})
+        return {
+            "running": self.running,
+            "paused": self.should_pause(),
+            "queued": [
+                {"library_id": library_id, "waiting": round(now - queued, 1)}
+                for library_id, queued in self._queue.items()
+            ],
+            "scanning": list(self._running),
+            "schedule": upcoming,
+        }
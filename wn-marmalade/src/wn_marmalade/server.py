@@ -12,18 +12,37 @@ Features:
 """
 
 import os
-import json
+import sys
+import time
 import hashlib
 import asyncio
 import logging
 import mimetypes
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from typing import Dict, List, Optional, Any
-from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional, Any, Tuple, Callable
+from concurrent.futures import Executor, Future
+from dataclasses import dataclass, fields, asdict
 from datetime import datetime, timezone
 from enum import Enum
-import re
-import subprocess
+
+from wn_core import ProbeCache, probe_file, probe_file_async, load_config
+
+from .storage import MarmaladeStore
+from .index import TitleIndex, SortedIndex, SeriesIndex, PathIndex, VersionIndex
+from .naming import parse_release_names
+from .watchstate import WatchState, WatchStateStore, DEFAULT_USER
+from .transcoder import TranscodeManager, QUALITY_PRESETS
+from .artwork import ArtworkService
+from .metadata import MetadataEnricher, TMDB_API_URL
+from .scheduler import ScanScheduler
+from .watcher import LibraryWatcher
+from .markers import MarkerAnalyzer, chapter_markers
+from .backup import open_backup, export_catalogue, import_catalogue
+from .versions import (
+    effective_height, version_label, split_by_duration, pick_version, pick_source, find_duplicates,
+)
+from .streaming import StreamMetrics
 
 logger = logging.getLogger(__name__)
 
@@ -36,9 +55,29 @@ class MediaType(Enum):
     UNKNOWN = "unknown"
 
 
+def _slotted(cls):
+    """
+    Rebuild a dataclass with __slots__ so instances carry no __dict__.
+    Equivalent to dataclass(slots=True), which needs Python 3.10.
+    """
+    names = tuple(f.name for f in fields(cls))
+    namespace = dict(cls.__dict__)
+    namespace['__slots__'] = names
+    for name in names:
+        namespace.pop(name, None)
+    namespace.pop('__dict__', None)
+    namespace.pop('__weakref__', None)
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@_slotted
 @dataclass
 class MediaFile:
-    """Represents a media file in the library."""
+    """
+    Represents a media file in the library.
+    Slotted, with low-cardinality strings (codecs, container, series,
+    genres) interned so large catalogues stay compact in memory.
+    """
     id: str
     path: str
     filename: str
@@ -54,6 +93,7 @@ class MediaFile:
     bitrate: int = 0
     added_date: str = ""
     modified_date: str = ""
+    library_id: str = ""
     # Metadata from TMDB/manual
     tmdb_id: Optional[int] = None
     imdb_id: Optional[str] = None
@@ -62,19 +102,34 @@ class MediaFile:
     backdrop_url: str = ""
     year: Optional[int] = None
     rating: float = 0.0
-    genres: List[str] = field(default_factory=list)
+    genres: Tuple[str, ...] = ()
     # TV specific
     series_name: str = ""
     season_number: Optional[int] = None
     episode_number: Optional[int] = None
-    # Watch status
-    watched: bool = False
-    watch_progress: float = 0  # seconds
-    last_watched: Optional[str] = None
+    episode_number_end: Optional[int] = None  # last episode of a multi-episode file
+    air_date: Optional[str] = None  # date-based shows
+    # Playback markers, seconds
+    chapters: Tuple[Tuple[float, float, str], ...] = ()  # (start, end, title)
+    intro_start: Optional[float] = None
+    intro_end: Optional[float] = None
+    credits_start: Optional[float] = None
+    
+    def __post_init__(self):
+        intern = sys.intern
+        self.codec_video = intern(self.codec_video)
+        self.codec_audio = intern(self.codec_audio)
+        self.container = intern(self.container)
+        self.library_id = intern(self.library_id)
+        self.series_name = intern(self.series_name)
+        self.genres = tuple(intern(g) for g in self.genres)
+        self.chapters = tuple((start, end, intern(title)) for start, end, title in self.chapters)
     
     def to_dict(self) -> Dict[str, Any]:
-        result = asdict(self)
+        result = {name: getattr(self, name) for name in self.__slots__}
         result["media_type"] = self.media_type.value
+        result["genres"] = list(self.genres)
+        result["chapters"] = [list(chapter) for chapter in self.chapters]
         return result
     
     @classmethod
@@ -109,30 +164,33 @@ class MarmaladeServer:
     VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm', '.m4v', '.mpg', '.mpeg', '.ts'}
     AUDIO_EXTENSIONS = {'.mp3', '.flac', '.wav', '.aac', '.ogg', '.m4a', '.wma'}
     
-    # Regex patterns for parsing filenames
-    MOVIE_PATTERNS = [
-        # Movie.Name.2020.1080p.BluRay.x264
-        re.compile(r'^(.+?)[\.\s](\d{4})[\.\s]', re.IGNORECASE),
-        # Movie Name (2020)
-        re.compile(r'^(.+?)\s*\((\d{4})\)', re.IGNORECASE),
-    ]
-    
-    TV_PATTERNS = [
-        # Show.Name.S01E01 or Show Name - S01E01
-        re.compile(r'^(.+?)[\.\s\-]+S(\d{1,2})E(\d{1,2})', re.IGNORECASE),
-        # Show Name - 1x01
-        re.compile(r'^(.+?)[\.\s\-]+(\d{1,2})x(\d{2})', re.IGNORECASE),
-    ]
+    # Seconds between checks while a scan is paused for playback
+    SCAN_PAUSE_POLL = 1.0
     
     def __init__(
         self,
         data_dir: str = "/var/lib/marmalade",
         ffprobe_path: str = "ffprobe",
         ffmpeg_path: str = "ffmpeg",
+        probe_concurrency: Optional[int] = None,
+        watch_flush_interval: float = 10.0,
+        max_transcodes: int = 2,
+        transcode_cache_size: int = 10 * 1024 ** 3,
+        probe_cache: Optional[ProbeCache] = None,
+        artwork_concurrency: int = 1,
+        artwork_cache_size: int = 2 * 1024 ** 3,
+        tmdb_api_key: Optional[str] = None,
+        tmdb_base_url: str = TMDB_API_URL,
     ):
         self.data_dir = Path(data_dir)
         self.ffprobe_path = ffprobe_path
         self.ffmpeg_path = ffmpeg_path
+        # Number of ffprobe processes a scan may run at once
+        self.probe_concurrency = max(1, probe_concurrency or os.cpu_count() or 4)
+        # ffprobe output keyed by file identity, kept in data_dir unless one is
+        # given (e.g. get_probe_cache() to share it with Sieve)
+        self._owns_probe_cache = probe_cache is None
+        self.probe_cache = probe_cache if probe_cache is not None else ProbeCache(str(self.data_dir / "probe_cache.db"))
         
         # Create data directories
         self.data_dir.mkdir(parents=True, exist_ok=True)
@@ -141,44 +199,232 @@ class MarmaladeServer:
         
         # Storage
         self.libraries: Dict[str, Library] = {}
-        self.media_files: Dict[str, MediaFile] = {}
+        self._media_files: Optional[Dict[str, MediaFile]] = None
+        self._title_index = TitleIndex()
+        self._title_order = SortedIndex()
+        self._recent = SortedIndex()
+        self._series = SeriesIndex()
+        self._paths = PathIndex()
+        self._versions = VersionIndex()
         
-        # Persistence files
+        # Persistence (legacy JSON files are migrated into the database)
         self._libraries_file = self.data_dir / "libraries.json"
         self._media_file = self.data_dir / "media.json"
+        self._store = MarmaladeStore(self.data_dir / "marmalade.db")
+        
+        # Per-user watch state, flushed to the store every watch_flush_interval seconds
+        self.watch_states = WatchStateStore(self._store, flush_interval=watch_flush_interval)
+        
+        # HLS transcoding into the transcodes directory
+        self.transcoder = TranscodeManager(
+            self,
+            self.data_dir / "transcodes",
+            ffmpeg_path=ffmpeg_path,
+            max_sessions=max_transcodes,
+            cache_size=transcode_cache_size,
+        )
+        
+        # Thumbnails and trickplay sheets, generated in the background into the cache directory
+        self.artwork = ArtworkService(
+            self,
+            self.data_dir / "cache" / "artwork",
+            ffmpeg_path=ffmpeg_path,
+            concurrency=artwork_concurrency,
+            cache_size=artwork_cache_size,
+        )
+        
+        # TMDB enrichment of scanned items; disabled without an API key
+        self.metadata = MetadataEnricher(self, self._store, api_key=tmdb_api_key, base_url=tmdb_base_url)
+        
+        # Intro and credits detection for episodes without chapter markers
+        self.markers = MarkerAnalyzer(self, self._store, ffmpeg_path=ffmpeg_path)
+        
+        # Direct-play stream counters, shared with the StreamingServer
+        self.stream_metrics = StreamMetrics()
+        
+        # Periodic scans per Library.scan_interval; started by the application
+        self.scheduler = ScanScheduler(self)
+        
+        # Live updates from filesystem events, one watch per enabled library; started by the application
+        self.watcher = LibraryWatcher(self)
+        
+        # Per-library scan progress
+        self.scan_progress: Dict[str, Dict[str, Any]] = {}
+        # Held while a library's entries are changed by a scan, file changes or removal
+        self._library_locks: Dict[str, asyncio.Lock] = {}
+        
+        # Blocking reads (walks, stats) run on _executor (the loop's default when None).
+        # With a _writer attached, store writes are queued on it in order instead
+        # of blocking the caller. Both are set by AsyncMarmaladeServer.
+        self._executor: Optional[Executor] = None
+        self._writer: Optional[Executor] = None
         
         # Load existing data
         self._load_data()
         
         logger.info(f"MarmaladeServer initialized. Data dir: {data_dir}")
     
+    @property
+    def media_files(self) -> Dict[str, MediaFile]:
+        """The media catalogue, loaded from the store on first access."""
+        if self._media_files is None:
+            self._load_media()
+        return self._media_files
+    
     def _load_data(self):
-        """Load persisted data from disk."""
+        """Load persisted libraries; media entries are loaded lazily."""
         try:
-            if self._libraries_file.exists():
-                with open(self._libraries_file, 'r') as f:
-                    data = json.load(f)
-                    self.libraries = {lib['id']: Library(**lib) for lib in data}
-                    logger.info(f"Loaded {len(self.libraries)} libraries")
+            self._store.migrate_json(self._libraries_file, self._media_file)
             
-            if self._media_file.exists():
-                with open(self._media_file, 'r') as f:
-                    data = json.load(f)
-                    self.media_files = {m['id']: MediaFile.from_dict(m) for m in data}
-                    logger.info(f"Loaded {len(self.media_files)} media files")
+            self.libraries = {lib['id']: Library(**lib) for lib in self._store.load_libraries()}
+            logger.info(f"Loaded {len(self.libraries)} libraries")
         except Exception as e:
             logger.error(f"Error loading data: {e}")
     
-    def _save_data(self):
-        """Save data to disk."""
+    def _load_media(self):
+        """Load media entries from the store."""
+        self._media_files = {}
+        # Watch status used to live on the media entries themselves
+        migrate_watch_state = self._store.get_meta("watch_state_migrated") is None
+        legacy_states = []
+        relinked = []
         try:
-            with open(self._libraries_file, 'w') as f:
-                json.dump([lib.to_dict() for lib in self.libraries.values()], f, indent=2)
+            with self._bulk_indexes():
+                for data in self._store.iter_media():
+                    if migrate_watch_state and (data.get('watch_progress') or data.get('watched')):
+                        legacy_states.append(WatchState(
+                            user_id=DEFAULT_USER,
+                            media_id=data['id'],
+                            watched=bool(data.get('watched')),
+                            watch_progress=data.get('watch_progress') or 0,
+                            last_watched=data.get('last_watched'),
+                        ))
+                    media = MediaFile.from_dict(data)
+                    if not media.library_id:
+                        # Entries written before library ids were stored
+                        library = self._library_for_path(media.path)
+                        media.library_id = library.id if library else ""
+                        if library:
+                            relinked.append(media)
+                    self._put_media_entry(media)
+            logger.info(f"Loaded {len(self._media_files)} media files")
+            
+            # Store the ids too, so queries on the store (per-library export) see them
+            self._save_media(relinked)
             
-            with open(self._media_file, 'w') as f:
-                json.dump([m.to_dict() for m in self.media_files.values()], f, indent=2)
+            if migrate_watch_state:
+                self.watch_states.import_states(legacy_states)
+                self._store.set_meta("watch_state_migrated", "1")
         except Exception as e:
-            logger.error(f"Error saving data: {e}")
+            logger.error(f"Error loading media: {e}")
+    
+    @contextmanager
+    def _bulk_indexes(self):
+        """Put many entries at once: ordered indexes are sorted once when the block ends."""
+        with ExitStack() as stack:
+            for index in (self._title_index, self._title_order, self._recent, self._series):
+                stack.enter_context(index.bulk())
+            yield
+    
+    def _put_media_entry(self, media: MediaFile):
+        """Add or replace a catalogue entry and update the indexes."""
+        self.media_files[media.id] = media
+        self._title_index.add(media.id, media.title, media.series_name)
+        media_type = media.media_type.value
+        self._title_order.add(media.id, media.title.casefold(), (
+            None,
+            ("library", media.library_id),
+            ("type", media_type),
+            ("library_type", media.library_id, media_type),
+        ))
+        self._recent.add(media.id, media.added_date)
+        self._paths.add(media.id, media.library_id, media.path)
+        if media.media_type == MediaType.EPISODE and media.series_name:
+            self._series.add(
+                media.id, media.library_id, media.series_name,
+                media.season_number, media.episode_number, media.episode_number_end,
+                media.air_date, media.title,
+            )
+            self._versions.add(media.id, VersionIndex.episode_key(
+                media.series_name, media.season_number, media.episode_number, media.air_date,
+            ))
+        else:
+            self._series.remove(media.id)
+            self._versions.add(
+                media.id,
+                VersionIndex.movie_key(media.title, media.year) if media.media_type == MediaType.MOVIE else None,
+            )
+    
+    def _drop_media_entry(self, media_id: str) -> Optional[MediaFile]:
+        """Remove a catalogue entry and its index entries."""
+        media = self.media_files.pop(media_id, None)
+        if media is not None:
+            self._title_index.remove(media_id)
+            self._title_order.remove(media_id)
+            self._recent.remove(media_id)
+            self._series.remove(media_id)
+            self._paths.remove(media_id)
+            self._versions.remove(media_id)
+            self.watch_states.forget_media(media_id)
+        return media
+    
+    def _persist(self, action: str, write: Callable, *args):
+        """Run a store write now, or queue it on the writer when one is attached."""
+        if self._writer is None:
+            try:
+                write(*args)
+            except Exception as e:
+                logger.error(f"Error {action}: {e}")
+            return
+        
+        def done(future: Future):
+            if future.exception() is not None:
+                logger.error(f"Error {action}: {future.exception()}")
+        
+        self._writer.submit(write, *args).add_done_callback(done)
+    
+    def _save_library(self, library: Library):
+        """Persist a single library."""
+        self._persist(f"saving library {library.id}", self._store.put_library, library.to_dict())
+    
+    def _save_media(self, media: List[MediaFile]):
+        """Persist the given media entries in one transaction."""
+        if media:
+            self._persist("saving media", self._store.put_media, [m.to_dict() for m in media])
+    
+    def _delete_media(self, media_ids: List[str]):
+        """Remove media entries from the store."""
+        if media_ids:
+            self._persist("deleting media", self._store.delete_media, list(media_ids))
+    
+    def _library_lock(self, library_id: str) -> asyncio.Lock:
+        lock = self._library_locks.get(library_id)
+        if lock is None:
+            lock = self._library_locks[library_id] = asyncio.Lock()
+        return lock
+    
+    def _was_removed(self, library: Library) -> bool:
+        """True if the library was removed (or replaced) since it was looked up."""
+        return self.libraries.get(library.id) is not library
+    
+    def close(self):
+        """Flush pending watch state and queued writes and release the store and probe cache."""
+        self.watch_states.flush()
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+        self._store.close()
+        if self._owns_probe_cache:
+            self._owns_probe_cache = False  # close() may be called again
+            self.probe_cache.close()
+    
+    def _library_for_path(self, path: str) -> Optional[Library]:
+        """Find the library containing a path (the deepest one if nested)."""
+        best = None
+        for library in self.libraries.values():
+            root = library.path.rstrip(os.sep) + os.sep
+            if path.startswith(root) and (best is None or len(library.path) > len(best.path)):
+                best = library
+        return best
     
     def _generate_id(self, path: str) -> str:
         """Generate a unique ID from a path."""
@@ -207,28 +453,31 @@ class MarmaladeServer:
         )
         
         self.libraries[lib_id] = library
-        self._save_data()
+        self._save_library(library)
         
         logger.info(f"Added library: {name} ({path})")
         return library
     
     def remove_library(self, library_id: str) -> bool:
-        """Remove a library and its media entries."""
+        """
+        Remove a library and its media entries.
+        A scan already running on it stops and persists nothing.
+        """
         if library_id not in self.libraries:
             return False
         
         library = self.libraries[library_id]
         
         # Remove all media from this library
-        to_remove = [
-            mid for mid, media in self.media_files.items()
-            if media.path.startswith(library.path)
-        ]
+        self.media_files  # make sure the catalogue (and so the index) is loaded
+        to_remove = self._paths.library(library_id)
         for mid in to_remove:
-            del self.media_files[mid]
+            self._drop_media_entry(mid)
+        self._delete_media(to_remove)
         
         del self.libraries[library_id]
-        self._save_data()
+        self._persist(f"deleting library {library_id}", self._store.delete_library, library_id)
+        self._persist(f"deleting library {library_id}", self._store.clear_dir_snapshots, library_id)
         
         logger.info(f"Removed library: {library.name}")
         return True
@@ -243,74 +492,92 @@ class MarmaladeServer:
     
     # ==================== Library Scanning ====================
     
-    async def scan_library(self, library_id: str) -> Dict[str, Any]:
-        """Scan a library for new media files."""
+    async def scan_library(
+        self,
+        library_id: str,
+        full: bool = False,
+        pause: Optional[Callable[[], bool]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Scan a library for new media files.
+        Directories whose mtime is unchanged since the last scan are not
+        listed again; pass full=True to re-check every file.
+        While pause() returns True the scan waits between directories and
+        files (used by the scheduler to yield to playback). It is also called
+        from the walking thread, so it must only read thread-safe state.
+        A scan started while another is running on the library waits for it.
+        """
+        async with self._library_lock(library_id):
+            return await self._scan_library(library_id, full, pause)
+    
+    async def _scan_library(
+        self,
+        library_id: str,
+        full: bool,
+        pause: Optional[Callable[[], bool]],
+    ) -> Dict[str, Any]:
         library = self.libraries.get(library_id)
         if not library:
             return {"error": "Library not found"}
         
-        if not Path(library.path).exists():
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(self._executor, os.path.exists, library.path):
             return {"error": f"Library path does not exist: {library.path}"}
         
         logger.info(f"Scanning library: {library.name}")
         
-        new_files = 0
-        updated_files = 0
+        progress = {
+            "library": library.name,
+            "status": "walking",
+            "total": 0,
+            "processed": 0,
+            "started": datetime.now(timezone.utc).isoformat(),
+        }
+        self.scan_progress[library_id] = progress
+        
         removed_files = 0
         
         # Get existing files in this library
-        existing_paths = {
-            m.path for m in self.media_files.values()
-            if m.path.startswith(library.path)
-        }
+        media_files = self.media_files
+        existing_paths = {media_files[mid].path for mid in self._paths.library(library_id)}
         
-        found_paths = set()
+        removed_ids: List[str] = []
         
-        # Scan for media files
-        extensions = self.VIDEO_EXTENSIONS if library.media_type in ['movies', 'tv'] else self.AUDIO_EXTENSIONS
+        # Walk the library off the event loop
+        found_paths, to_probe = await loop.run_in_executor(
+            self._executor, self._walk_library, library, existing_paths, full, pause
+        )
         
-        for root, dirs, files in os.walk(library.path):
-            # Skip hidden directories
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
-            
-            for filename in files:
-                ext = Path(filename).suffix.lower()
-                if ext not in extensions:
-                    continue
-                
-                file_path = os.path.join(root, filename)
-                found_paths.add(file_path)
-                
-                if file_path in existing_paths:
-                    # Check if file was modified
-                    media_id = self._generate_id(file_path)
-                    if media_id in self.media_files:
-                        stat = os.stat(file_path)
-                        current_mtime = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc).isoformat()
-                        if self.media_files[media_id].modified_date != current_mtime:
-                            # File was modified, update it
-                            await self._process_file(file_path, library)
-                            updated_files += 1
-                else:
-                    # New file
-                    await self._process_file(file_path, library)
-                    new_files += 1
+        # Probe new and modified files with a bounded worker pool
+        progress["status"] = "probing"
+        progress["total"] = len(to_probe)
+        changed = await self._probe_files(library, [path for path, _ in to_probe], progress, pause)
+        if self._was_removed(library):
+            # remove_library() does not wait for the scan; persist nothing for it
+            self._persist(f"deleting library {library_id}", self._store.clear_dir_snapshots, library_id)
+            self.scan_progress.pop(library_id, None)
+            return {"error": "Library removed during scan"}
+        new_files = sum(1 for _, is_new in to_probe if is_new)
+        updated_files = len(to_probe) - new_files
         
         # Remove files that no longer exist
         for path in existing_paths - found_paths:
             media_id = self._generate_id(path)
             if media_id in self.media_files:
-                del self.media_files[media_id]
+                self._drop_media_entry(media_id)
+                removed_ids.append(media_id)
                 removed_files += 1
         
         # Update library stats
         library.last_scan = datetime.now(timezone.utc).isoformat()
-        library.item_count = len([
-            m for m in self.media_files.values()
-            if m.path.startswith(library.path)
-        ])
+        library.item_count = self._paths.count(library.id)
         
-        self._save_data()
+        self._save_media(changed)
+        self._delete_media(removed_ids)
+        self._save_library(library)
+        self.artwork.enqueue_media(changed)
+        self.metadata.enqueue_media(changed)
+        self.markers.enqueue_media(changed)
         
         result = {
             "library": library.name,
@@ -320,20 +587,231 @@ class MarmaladeServer:
             "total": library.item_count,
         }
         
+        progress.update(result)
+        progress["status"] = "complete"
+        
         logger.info(f"Scan complete: {result}")
         return result
     
-    async def _process_file(self, file_path: str, library: Library) -> Optional[MediaFile]:
+    def _walk_library(
+        self,
+        library: Library,
+        existing_paths: set,
+        full: bool = False,
+        pause: Optional[Callable[[], bool]] = None,
+    ) -> tuple:
+        """
+        Walk a library directory (blocking).
+        
+        Each directory's mtime and its files' (size, mtime_ns, inode) are
+        recorded in a snapshot. On rescans a directory whose mtime has not
+        changed is not listed again, and only files whose stat signature
+        changed are re-probed.
+        
+        Returns the set of media paths found and a list of
+        (path, is_new) tuples for files that need probing.
+        """
+        found_paths = set()
+        to_probe = []
+        extensions = self._library_extensions(library)
+        
+        snapshots = self._store.load_dir_snapshots(library.id)
+        current: Dict[str, Dict[str, Any]] = {}
+        stack = [library.path]
+        
+        while stack:
+            while pause is not None and pause():
+                time.sleep(self.SCAN_PAUSE_POLL)
+            dir_path = stack.pop()
+            try:
+                dir_mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            
+            previous = snapshots.get(dir_path)
+            if previous and not full and previous['mtime_ns'] == dir_mtime:
+                # Listing unchanged, reuse the recorded entries
+                current[dir_path] = previous
+                for name in previous['files']:
+                    file_path = os.path.join(dir_path, name)
+                    found_paths.add(file_path)
+                    if file_path not in existing_paths:
+                        # Never made it into the catalogue (e.g. probe failed)
+                        to_probe.append((file_path, True))
+                stack.extend(os.path.join(dir_path, d) for d in previous['dirs'])
+                continue
+            
+            old_files = previous['files'] if previous else {}
+            snapshot = {'mtime_ns': dir_mtime, 'dirs': [], 'files': {}}
+            
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            # Skip hidden directories
+                            if not entry.name.startswith('.'):
+                                snapshot['dirs'].append(entry.name)
+                            continue
+                        
+                        ext = os.path.splitext(entry.name)[1].lower()
+                        if ext not in extensions:
+                            continue
+                        
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        
+                        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+                        snapshot['files'][entry.name] = signature
+                        file_path = entry.path
+                        found_paths.add(file_path)
+                        
+                        if file_path not in existing_paths:
+                            to_probe.append((file_path, True))
+                        elif entry.name in old_files and not full:
+                            if old_files[entry.name] != signature:
+                                to_probe.append((file_path, False))
+                        else:
+                            # No snapshot yet, compare with the stored mtime
+                            media = self.media_files.get(self._generate_id(file_path))
+                            current_mtime = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc).isoformat()
+                            if media and media.modified_date != current_mtime:
+                                to_probe.append((file_path, False))
+            except OSError as e:
+                logger.warning(f"Cannot list {dir_path}: {e}")
+                continue
+            
+            current[dir_path] = snapshot
+            stack.extend(os.path.join(dir_path, d) for d in snapshot['dirs'])
+        
+        changed = {path: snap for path, snap in current.items() if snapshots.get(path) is not snap}
+        self._store.save_dir_snapshots(library.id, changed, snapshots.keys() - current.keys())
+        
+        return found_paths, to_probe
+    
+    def _library_extensions(self, library: Library) -> set:
+        """File extensions a library picks up."""
+        return self.VIDEO_EXTENSIONS if library.media_type in ['movies', 'tv'] else self.AUDIO_EXTENSIONS
+    
+    async def _probe_files(
+        self,
+        library: Library,
+        paths: List[str],
+        progress: Optional[Dict[str, Any]] = None,
+        pause: Optional[Callable[[], bool]] = None,
+    ) -> List[MediaFile]:
+        """Process files with at most probe_concurrency probes in flight."""
+        processed: List[MediaFile] = []
+        loop = asyncio.get_running_loop()
+        names = await loop.run_in_executor(
+            self._executor, parse_release_names, paths, library.media_type, library.path
+        )
+        pending = iter(zip(paths, names))
+        
+        async def probe_worker():
+            for file_path, parsed in pending:
+                if self._was_removed(library):
+                    return  # removed while scanning
+                while pause is not None and pause():
+                    if progress is not None:
+                        progress["status"] = "paused"
+                    await asyncio.sleep(self.SCAN_PAUSE_POLL)
+                if progress is not None:
+                    progress["status"] = "probing"
+                media = await self._process_file(file_path, library, parsed)
+                if media:
+                    processed.append(media)
+                if progress is not None:
+                    progress["processed"] += 1
+        
+        await asyncio.gather(*(
+            probe_worker() for _ in range(min(self.probe_concurrency, len(paths)))
+        ))
+        return processed
+    
+    async def apply_file_changes(
+        self,
+        library_id: str,
+        changed_paths: List[str],
+        removed_paths: List[str],
+    ) -> Dict[str, Any]:
+        """
+        Apply a batch of filesystem changes to a library without rescanning it.
+        Removed paths may be directories, in which case everything below them goes.
+        """
+        async with self._library_lock(library_id):
+            return await self._apply_file_changes(library_id, changed_paths, removed_paths)
+    
+    async def _apply_file_changes(
+        self,
+        library_id: str,
+        changed_paths: List[str],
+        removed_paths: List[str],
+    ) -> Dict[str, Any]:
+        library = self.libraries.get(library_id)
+        if not library:
+            return {"error": "Library not found"}
+        
+        removed_ids = []
+        self.media_files  # make sure the catalogue (and so the index) is loaded
+        for path in removed_paths:
+            for mid in self._paths.under(path):
+                self._drop_media_entry(mid)
+                removed_ids.append(mid)
+        
+        extensions = self._library_extensions(library)
+        candidates = [p for p in changed_paths if os.path.splitext(p)[1].lower() in extensions]
+        loop = asyncio.get_running_loop()
+        paths = await loop.run_in_executor(
+            self._executor, lambda: [p for p in candidates if os.path.isfile(p)]
+        )
+        processed = await self._probe_files(library, paths)
+        if self._was_removed(library):
+            return {"error": "Library removed while applying changes"}
+        
+        library.item_count = self._paths.count(library.id)
+        
+        self._save_media(processed)
+        self._delete_media(removed_ids)
+        self._save_library(library)
+        self.artwork.enqueue_media(processed)
+        self.metadata.enqueue_media(processed)
+        self.markers.enqueue_media(processed)
+        
+        result = {
+            "library": library.name,
+            "updated": len(processed),
+            "removed": len(removed_ids),
+            "total": library.item_count,
+        }
+        logger.info(f"Applied file changes: {result}")
+        return result
+    
+    def get_scan_progress(self, library_id: Optional[str] = None) -> Dict[str, Any]:
+        """Get progress of running or finished scans, for one library or all."""
+        if library_id:
+            return self.scan_progress.get(library_id, {})
+        return dict(self.scan_progress)
+    
+    async def _process_file(
+        self,
+        file_path: str,
+        library: Library,
+        parsed: Optional[Dict[str, Any]] = None,
+    ) -> Optional[MediaFile]:
         """Process a media file and add to database."""
         try:
-            stat = os.stat(file_path)
+            loop = asyncio.get_running_loop()
+            stat = await loop.run_in_executor(self._executor, os.stat, file_path)
             filename = os.path.basename(file_path)
             
             # Generate ID
             media_id = self._generate_id(file_path)
             
-            # Parse filename for metadata
-            parsed = self._parse_filename(filename, library.media_type)
+            # Parse filename (and folders) for metadata
+            if parsed is None:
+                parsed = parse_release_names([file_path], library.media_type, library.path)[0]
             
             # Get media info using ffprobe
             media_info = await self._get_media_info(file_path)
@@ -364,87 +842,74 @@ class MarmaladeServer:
                 bitrate=media_info.get('bitrate', 0),
                 added_date=datetime.now(timezone.utc).isoformat(),
                 modified_date=datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc).isoformat(),
+                library_id=library.id,
                 year=parsed.get('year'),
                 series_name=parsed.get('series_name', ''),
                 season_number=parsed.get('season'),
                 episode_number=parsed.get('episode'),
+                episode_number_end=parsed.get('episode_end'),
+                air_date=parsed.get('air_date'),
+                chapters=media_info.get('chapters', ()),
+                intro_start=media_info.get('intro_start'),
+                intro_end=media_info.get('intro_end'),
+                credits_start=media_info.get('credits_start'),
             )
             
-            self.media_files[media_id] = media_file
+            if self._was_removed(library):
+                return None
+            self._put_media_entry(media_file)
             return media_file
             
         except Exception as e:
             logger.error(f"Error processing file {file_path}: {e}")
             return None
     
-    def _parse_filename(self, filename: str, media_type: str) -> Dict[str, Any]:
-        """Parse a filename to extract metadata."""
-        result = {'title': Path(filename).stem}
-        
-        if media_type == 'tv':
-            for pattern in self.TV_PATTERNS:
-                match = pattern.match(filename)
-                if match:
-                    groups = match.groups()
-                    result['series_name'] = groups[0].replace('.', ' ').strip()
-                    result['season'] = int(groups[1])
-                    result['episode'] = int(groups[2])
-                    result['title'] = f"{result['series_name']} S{result['season']:02d}E{result['episode']:02d}"
-                    break
-        else:
-            for pattern in self.MOVIE_PATTERNS:
-                match = pattern.match(filename)
-                if match:
-                    groups = match.groups()
-                    result['title'] = groups[0].replace('.', ' ').strip()
-                    result['year'] = int(groups[1])
-                    break
-        
-        return result
-    
     async def _get_media_info(self, file_path: str) -> Dict[str, Any]:
-        """Get media information using ffprobe."""
+        """Get media information using ffprobe (or the probe cache)."""
         try:
-            cmd = [
-                self.ffprobe_path,
-                '-v', 'quiet',
-                '-print_format', 'json',
-                '-show_format',
-                '-show_streams',
-                file_path
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-            
-            if result.returncode != 0:
+            if self._executor is not None:
+                # Cache lookups and writes are disk I/O too; keep all of it off the loop
+                data = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, probe_file, file_path, self.ffprobe_path, self.probe_cache
+                )
+            else:
+                data = await probe_file_async(file_path, self.ffprobe_path, self.probe_cache)
+            if data is None:
                 return {}
-            
-            data = json.loads(result.stdout)
-            
-            info = {
-                'container': Path(file_path).suffix.lower().lstrip('.'),
-            }
-            
-            # Get format info
-            fmt = data.get('format', {})
-            info['duration'] = float(fmt.get('duration', 0))
-            info['bitrate'] = int(fmt.get('bit_rate', 0))
-            
-            # Get stream info
-            for stream in data.get('streams', []):
-                if stream.get('codec_type') == 'video' and not info.get('codec_video'):
-                    info['codec_video'] = stream.get('codec_name', '')
-                    info['width'] = stream.get('width', 0)
-                    info['height'] = stream.get('height', 0)
-                elif stream.get('codec_type') == 'audio' and not info.get('codec_audio'):
-                    info['codec_audio'] = stream.get('codec_name', '')
-            
-            return info
-            
+            return self._parse_probe_data(data, file_path)
         except Exception as e:
             logger.error(f"ffprobe error: {e}")
             return {}
     
+    def _parse_probe_data(self, data: Dict[str, Any], file_path: str) -> Dict[str, Any]:
+        """Extract the fields Marmalade stores from ffprobe JSON output."""
+        info = {
+            'container': Path(file_path).suffix.lower().lstrip('.'),
+        }
+        
+        # Get format info
+        fmt = data.get('format', {})
+        info['duration'] = float(fmt.get('duration', 0))
+        info['bitrate'] = int(fmt.get('bit_rate', 0))
+        
+        # Get stream info
+        for stream in data.get('streams', []):
+            if stream.get('codec_type') == 'video' and not info.get('codec_video'):
+                info['codec_video'] = stream.get('codec_name', '')
+                info['width'] = stream.get('width', 0)
+                info['height'] = stream.get('height', 0)
+            elif stream.get('codec_type') == 'audio' and not info.get('codec_audio'):
+                info['codec_audio'] = stream.get('codec_name', '')
+        
+        # Chapters, and intro/credits markers where their titles say so
+        info['chapters'] = tuple(
+            (float(ch.get('start_time', 0)), float(ch.get('end_time', 0)), ch.get('tags', {}).get('title', ''))
+            for ch in data.get('chapters', [])
+        )
+        info.update(chapter_markers(info['chapters']))
+        
+        return info
+    
     # ==================== Media Retrieval ====================
     
     def get_media(self, media_id: str) -> Optional[MediaFile]:
@@ -458,103 +923,363 @@ class MarmaladeServer:
         limit: int = 100,
         offset: int = 0,
     ) -> List[MediaFile]:
-        """Get media files with optional filtering."""
-        media = list(self.media_files.values())
-        
-        if library_id:
-            library = self.libraries.get(library_id)
-            if library:
-                media = [m for m in media if m.path.startswith(library.path)]
+        """Get media files with optional filtering, sorted by title."""
+        media_files = self.media_files
         
+        partition = None
+        if library_id and library_id in self.libraries:
+            partition = ("library", library_id)
         if media_type:
-            type_enum = MediaType(media_type)
-            media = [m for m in media if m.media_type == type_enum]
-        
-        # Sort by title
-        media.sort(key=lambda m: m.title.lower())
+            type_value = MediaType(media_type).value
+            if partition:
+                partition = ("library_type", library_id, type_value)
+            else:
+                partition = ("type", type_value)
         
-        return media[offset:offset + limit]
+        return [media_files[mid] for mid in self._title_order.page(partition, offset, limit)]
     
     def search_media(self, query: str, limit: int = 50) -> List[MediaFile]:
-        """Search for media by title."""
-        query_lower = query.lower()
-        results = [
-            m for m in self.media_files.values()
-            if query_lower in m.title.lower() or query_lower in m.series_name.lower()
-        ]
-        results.sort(key=lambda m: m.title.lower())
-        return results[:limit]
+        """Search for media by title or series name, best matches first."""
+        media_files = self.media_files
+        return [media_files[mid] for mid in self._title_index.search(query, limit)]
     
     def get_recent_media(self, limit: int = 20) -> List[MediaFile]:
         """Get recently added media."""
-        media = list(self.media_files.values())
-        media.sort(key=lambda m: m.added_date, reverse=True)
-        return media[:limit]
-    
-    def get_continue_watching(self, limit: int = 10) -> List[MediaFile]:
-        """Get media that was partially watched."""
-        media = [
-            m for m in self.media_files.values()
-            if m.watch_progress > 0 and not m.watched
+        media_files = self.media_files
+        return [media_files[mid] for mid in self._recent.last(limit=limit)]
+    
+    def get_continue_watching(self, limit: int = 10, user_id: str = DEFAULT_USER) -> List[MediaFile]:
+        """Get media that was partially watched by a user."""
+        media_files = self.media_files
+        return [
+            media_files[mid] for mid in self.watch_states.continue_watching(user_id, limit)
+            if mid in media_files
+        ]
+    
+    def media_to_dict(self, media: MediaFile, user_id: str = DEFAULT_USER) -> Dict[str, Any]:
+        """Serialise a media file together with a user's watch status."""
+        result = media.to_dict()
+        state = self.watch_states.get(user_id, media.id)
+        result["watched"] = state.watched if state else False
+        result["watch_progress"] = state.watch_progress if state else 0
+        result["last_watched"] = state.last_watched if state else None
+        if media.media_type in (MediaType.MOVIE, MediaType.EPISODE):
+            result["thumbnail_url"] = f"/artwork/{media.id}/thumbnail.jpg"
+            result["trickplay_url"] = f"/artwork/{media.id}/trickplay.json"
+            result["version"] = version_label(media)
+            result["version_count"] = len(self._version_group(media.id))
+        return result
+    
+    # ==================== TV Series ====================
+    
+    def get_series(self, library_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """List TV series with their season and episode counts."""
+        self.media_files  # make sure the catalogue (and so the index) is loaded
+        return self._series.series(library_id)
+    
+    def get_seasons(self, series_id: str) -> List[Dict[str, Any]]:
+        """List the seasons of a series."""
+        self.media_files
+        return [
+            {"season_number": season, "episode_count": count}
+            for season, count in self._series.seasons(series_id)
         ]
-        media.sort(key=lambda m: m.last_watched or '', reverse=True)
-        return media[:limit]
+    
+    def get_episodes(self, series_id: str, season: Optional[int] = None) -> List[MediaFile]:
+        """Get the episodes of a season (or the whole series) in play order."""
+        media_files = self.media_files
+        return [media_files[mid] for mid in self._series.episodes(series_id, season)]
+    
+    def get_next_episode(self, media_id: str) -> Optional[MediaFile]:
+        """Get the episode to auto-play after this one."""
+        next_id = self._series.next(media_id) if media_id in self.media_files else None
+        return self.media_files.get(next_id) if next_id else None
+    
+    def get_previous_episode(self, media_id: str) -> Optional[MediaFile]:
+        previous_id = self._series.previous(media_id) if media_id in self.media_files else None
+        return self.media_files.get(previous_id) if previous_id else None
+    
+    def get_up_next(self, limit: int = 10, user_id: str = DEFAULT_USER) -> List[MediaFile]:
+        """
+        Next unwatched episode of each series the user recently finished an
+        episode of, most recent first.
+        """
+        media_files = self.media_files
+        result: List[MediaFile] = []
+        seen_series = set()
+        for media_id in self.watch_states.recently_watched(user_id, limit=limit * 5):
+            series_id = self._series.series_of(media_id)
+            if series_id is None or series_id in seen_series:
+                continue
+            seen_series.add(series_id)
+            next_id = self._series.next(media_id)
+            while next_id:
+                state = self.watch_states.get(user_id, next_id)
+                if not (state and state.watched):
+                    break
+                next_id = self._series.next(next_id)
+            if next_id and next_id in media_files:
+                result.append(media_files[next_id])
+                if len(result) >= limit:
+                    break
+        return result
     
     # ==================== Watch Progress ====================
     
+    def get_watch_state(self, media_id: str, user_id: str = DEFAULT_USER) -> Optional[WatchState]:
+        """Get a user's watch status for a media file."""
+        return self.watch_states.get(user_id, media_id)
+    
     def update_watch_progress(
         self,
         media_id: str,
         progress: float,
         mark_watched: bool = False,
+        user_id: str = DEFAULT_USER,
     ) -> bool:
-        """Update watch progress for a media file."""
+        """
+        Update a user's watch progress for a media file.
+        Progress is buffered in memory and written out in batches.
+        """
         media = self.media_files.get(media_id)
         if not media:
             return False
         
-        media.watch_progress = progress
-        media.last_watched = datetime.now(timezone.utc).isoformat()
-        
         # Auto-mark as watched if > 90% complete
+        watched = None
         if mark_watched or (media.duration > 0 and progress / media.duration > 0.9):
-            media.watched = True
+            watched = True
         
-        self._save_data()
+        self.watch_states.update(user_id, media_id, progress=progress, watched=watched)
         return True
     
-    def mark_watched(self, media_id: str, watched: bool = True) -> bool:
-        """Mark a media file as watched/unwatched."""
+    def mark_watched(self, media_id: str, watched: bool = True, user_id: str = DEFAULT_USER) -> bool:
+        """Mark a media file as watched/unwatched for a user."""
         media = self.media_files.get(media_id)
         if not media:
             return False
         
-        media.watched = watched
-        if watched:
-            media.watch_progress = media.duration
-        
-        self._save_data()
+        self.watch_states.update(
+            user_id, media_id,
+            progress=media.duration if watched else None,
+            watched=watched,
+        )
         return True
     
+    # ==================== Metadata ====================
+    
+    async def refresh_metadata(self, library_id: Optional[str] = None) -> Dict[str, Any]:
+        """Enrich every item of a library (or all libraries) that has no TMDB match yet."""
+        if not self.metadata.enabled:
+            return {"error": "TMDB API key not configured"}
+        
+        media_files = self.media_files
+        if library_id:
+            media = [media_files[mid] for mid in self._paths.library(library_id)]
+        else:
+            media = list(media_files.values())
+        changed = await self.metadata.enrich(media)
+        return {"updated": len(changed), **self.metadata.get_status()}
+    
+    # ==================== Markers ====================
+    
+    async def detect_markers(self, library_id: Optional[str] = None) -> Dict[str, Any]:
+        """Detect missing intro and credits markers for every season of a library (or all)."""
+        self.media_files
+        changed = []
+        for series in self._series.series(library_id):
+            for season, _ in self._series.seasons(series["id"]):
+                changed.extend(await self.markers.analyse_season(series["id"], season))
+        self._save_media(changed)
+        return {"updated": len(changed), **self.markers.get_status()}
+    
+    # ==================== Versions ====================
+    
+    def _version_group(self, media_id: str) -> List[MediaFile]:
+        """Files of the same work as a media, this one included."""
+        media_files = self.media_files
+        group = [media_files[mid] for mid in self._versions.versions(media_id) if mid in media_files]
+        key = self._versions.key_of(media_id)
+        if len(group) > 1 and key[0] == "movie" and key[2] is None:
+            # Without a year the title alone may name different films
+            group = next(c for c in split_by_duration(group) if any(m.id == media_id for m in c))
+        return group
+    
+    def get_versions(self, media_id: str) -> List[MediaFile]:
+        """Get every version of a media's movie or episode, highest quality first."""
+        if media_id not in self.media_files:
+            return []
+        return sorted(
+            self._version_group(media_id),
+            key=lambda m: (effective_height(m), m.bitrate),
+            reverse=True,
+        )
+    
+    def get_version_groups(self, library_id: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """List works that exist as more than one file (touching one library, or any)."""
+        media_files = self.media_files
+        result = []
+        for key, ids in self._versions.groups():
+            group = [media_files[mid] for mid in ids]
+            clusters = split_by_duration(group) if key[0] == "movie" and key[2] is None else [group]
+            for cluster in clusters:
+                if len(cluster) < 2:
+                    continue
+                if library_id and not any(m.library_id == library_id for m in cluster):
+                    continue
+                cluster.sort(key=lambda m: (effective_height(m), m.bitrate), reverse=True)
+                result.append({
+                    "title": cluster[0].title,
+                    "versions": [
+                        {"id": m.id, "label": version_label(m), "library_id": m.library_id,
+                         "path": m.path, "size": m.size}
+                        for m in cluster
+                    ],
+                })
+        result.sort(key=lambda g: g["title"].casefold())
+        return result[:limit]
+    
+    def pick_version(
+        self,
+        media_id: str,
+        max_height: Optional[int] = None,
+        video_codecs: Optional[List[str]] = None,
+        max_bitrate: Optional[int] = None,
+    ) -> Optional[MediaFile]:
+        """Choose the version of a media best suited to a client's limits."""
+        versions = [m for m in self.get_versions(media_id) if Path(m.path).exists()]
+        if not versions:
+            return None
+        return pick_version(versions, max_height, video_codecs, max_bitrate)
+    
+    async def find_duplicates(self, library_id: Optional[str] = None) -> Dict[str, Any]:
+        """Find files with identical content by size and sampled-chunk hashes."""
+        media_files = self.media_files
+        if library_id:
+            media = [media_files[mid] for mid in self._paths.library(library_id)]
+        else:
+            media = list(media_files.values())
+        loop = asyncio.get_running_loop()
+        groups = await loop.run_in_executor(self._executor, find_duplicates, media, self._store)
+        return {
+            "groups": [
+                [{"id": m.id, "path": m.path, "library_id": m.library_id} for m in group]
+                for group in groups
+            ],
+            "duplicate_files": sum(len(group) - 1 for group in groups),
+            "wasted_bytes": sum(group[0].size * (len(group) - 1) for group in groups),
+        }
+    
+    # ==================== Backup ====================
+    
+    def export_catalogue(
+        self,
+        path: str,
+        library_id: Optional[str] = None,
+        snapshot: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, int]:
+        """
+        Write the catalogue (or one library of it) to an NDJSON backup file (blocking).
+        Off the loop, pass a snapshot_catalogue() taken on it.
+        """
+        if library_id is not None:
+            self.media_files  # loading stores the library ids of legacy entries
+        self.watch_states.flush()
+        with open_backup(Path(path), "w") as f:
+            counts = export_catalogue(self, f, library_id, snapshot)
+        logger.info(f"Exported catalogue to {path}: {counts}")
+        return counts
+    
+    def import_catalogue(self, path: str, library_id: Optional[str] = None) -> Dict[str, int]:
+        """Restore an NDJSON backup file, or one library from it (blocking)."""
+        with open_backup(Path(path)) as f, self._bulk_indexes():
+            counts = import_catalogue(self, f, library_id)
+        if self._media_files is not None:
+            for library in self.libraries.values():
+                if library_id is None or library.id == library_id:
+                    library.item_count = self._paths.count(library.id)
+                    self._save_library(library)
+        return counts
+    
+    def _restore_library(self, data: Dict[str, Any]):
+        library = Library(**data)
+        self.libraries[library.id] = library
+        self._save_library(library)
+    
+    def _restore_media(self, items: List[Dict[str, Any]]):
+        """Store imported media entries; the catalogue is updated too if already loaded."""
+        self._store.put_media(items)
+        if self._media_files is not None:
+            for data in items:
+                self._put_media_entry(MediaFile.from_dict(data))
+    
     # ==================== Streaming ====================
     
-    def get_stream_url(self, media_id: str, quality: str = "original") -> Optional[Dict[str, Any]]:
-        """Get streaming URL for a media file."""
+    def get_stream_url(
+        self,
+        media_id: str,
+        quality: str = "original",
+        max_height: Optional[int] = None,
+        video_codecs: Optional[List[str]] = None,
+        max_bitrate: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Get streaming URL for a media file.
+        Transcodes are made from the smallest version that needs no
+        upscaling; with client limits given, direct play may switch to
+        another version of the same work.
+        """
+        if media_id not in self.media_files:
+            return None
+        versions = [m for m in self._version_group(media_id) if os.path.exists(m.path)]
+        return self._stream_info(media_id, versions, quality, max_height, video_codecs, max_bitrate)
+    
+    def _stream_info(
+        self,
+        media_id: str,
+        versions: List[MediaFile],
+        quality: str,
+        max_height: Optional[int],
+        video_codecs: Optional[List[str]],
+        max_bitrate: Optional[int],
+    ) -> Optional[Dict[str, Any]]:
+        """Stream URL from the versions of a media whose files exist."""
         media = self.media_files.get(media_id)
-        if not media or not Path(media.path).exists():
+        if not media or not versions:
             return None
+        if quality in QUALITY_PRESETS:
+            media = pick_source(versions, QUALITY_PRESETS[quality]["height"])
+        elif max_height or video_codecs or max_bitrate or all(m.id != media_id for m in versions):
+            media = pick_version(versions, max_height, video_codecs, max_bitrate)
+        media_id = media.id
         
-        # For original quality, return direct path
-        # For transcoded, would generate HLS playlist
+        if quality in QUALITY_PRESETS:
+            # Transcoded HLS; segments are produced on demand
+            return {
+                "id": media_id,
+                "url": f"/transcode/{media_id}/{quality}/index.m3u8",
+                "path": media.path,
+                "mime_type": "application/vnd.apple.mpegurl",
+                "quality": quality,
+                "duration": media.duration,
+                "version": version_label(media),
+            }
         
+        # Direct play of the original file
         return {
             "id": media_id,
+            "url": f"/stream/{media_id}",
             "path": media.path,
             "mime_type": self._get_mime_type(media.path),
             "quality": quality,
             "duration": media.duration,
+            "version": version_label(media),
         }
     
+    def active_streams(self) -> int:
+        """Number of direct-play streams and running transcodes."""
+        return self.stream_metrics.active_streams + self.transcoder.active_sessions()
+    
     def _get_mime_type(self, path: str) -> str:
         """Get MIME type for a file."""
         mime, _ = mimetypes.guess_type(path)
@@ -571,6 +1296,6 @@ def get_marmalade_server() -> MarmaladeServer:
     
     if _marmalade_server is None:
         data_dir = os.environ.get("MARMALADE_DATA_DIR", "/var/lib/marmalade")
-        _marmalade_server = MarmaladeServer(data_dir=data_dir)
+        _marmalade_server = MarmaladeServer(data_dir=data_dir, tmdb_api_key=load_config().tmdb_api_key)
     
     return _marmalade_server
@@ -0,0 +1,349 @@
+"""
+Marmalade Storage - persistence engine for the media server.
+
+Libraries and media entries are stored one per row in an embedded SQLite
+database (WAL mode), so updating a single item is a single-row write
+instead of a rewrite of the whole catalogue. Legacy ``libraries.json`` /
+``media.json`` files are imported automatically on first start.
+"""
+
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Iterable, Iterator, Optional, Any, Tuple, TextIO
+
+logger = logging.getLogger(__name__)
+
+
+def _dumps(data: Dict[str, Any]) -> str:
+    return json.dumps(data, separators=(',', ':'))
+
+
+def _iter_json_array(f: TextIO, chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """Yield the items of a JSON array file one at a time, reading it in chunks."""
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size).lstrip()
+    if not buf.startswith('['):
+        raise ValueError("Expected a JSON array")
+    buf, pos, eof = buf[1:], 0, False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            item, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield item
+
+
+class MarmaladeStore:
+    """
+    SQLite-backed storage for Marmalade libraries and media entries.
+    Safe to share between threads; all access is serialised on one connection.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, db_path: str):
+        self.db_path = Path(db_path)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            isolation_level=None,  # explicit transactions only
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        with self.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS libraries (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS media (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS dir_snapshots ("
+                "library_id TEXT NOT NULL, path TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (library_id, path))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS watch_state ("
+                "user_id TEXT NOT NULL, media_id TEXT NOT NULL, watched INTEGER NOT NULL, "
+                "progress REAL NOT NULL, last_watched TEXT, PRIMARY KEY (user_id, media_id))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sample_hashes ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, modified TEXT NOT NULL, hash TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, modified TEXT NOT NULL, "
+                "head BLOB NOT NULL, tail BLOB NOT NULL)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('schema_version', ?)",
+                (str(self.SCHEMA_VERSION),)
+            )
+
+    @contextmanager
+    def transaction(self):
+        """Run a block of statements atomically."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # ==================== Meta ====================
+
+    def get_meta(self, key: str, default: str = None) -> str:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # ==================== Libraries ====================
+
+    def load_libraries(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM libraries").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def put_library(self, data: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO libraries (id, data) VALUES (?, ?)",
+                (data['id'], _dumps(data))
+            )
+
+    def delete_library(self, library_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM libraries WHERE id = ?", (library_id,))
+
+    # ==================== Media ====================
+
+    def count_media(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+
+    def iter_media(self, batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Yield stored media entries without materialising the whole table."""
+        for _, data in self.iter_media_json(batch_size=batch_size):
+            yield json.loads(data)
+
+    def iter_media_json(
+        self,
+        library_id: Optional[str] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Tuple[str, str]]:
+        """Yield (id, stored JSON text) of media entries, optionally of one library only."""
+        query = "SELECT rowid, id, data FROM media WHERE rowid > ?"
+        if library_id is not None:
+            query += " AND json_extract(data, '$.library_id') = ?"
+        query += " ORDER BY rowid LIMIT ?"
+        last_rowid = 0
+        while True:
+            params = (last_rowid, library_id, batch_size) if library_id is not None else (last_rowid, batch_size)
+            with self._lock:
+                rows = self._conn.execute(query, params).fetchall()
+            if not rows:
+                return
+            for rowid, media_id, data in rows:
+                yield media_id, data
+            last_rowid = rows[-1][0]
+
+    def put_media(self, items: Iterable[Dict[str, Any]]) -> int:
+        """Insert or replace media entries in a single transaction."""
+        rows = [(item['id'], _dumps(item)) for item in items]
+        if rows:
+            with self.transaction() as conn:
+                conn.executemany("INSERT OR REPLACE INTO media (id, data) VALUES (?, ?)", rows)
+        return len(rows)
+
+    def delete_media(self, media_ids: Iterable[str]) -> int:
+        rows = [(mid,) for mid in media_ids]
+        if rows:
+            with self.transaction() as conn:
+                conn.executemany("DELETE FROM media WHERE id = ?", rows)
+        return len(rows)
+
+    # ==================== Watch State ====================
+
+    def load_watch_states(self) -> List[tuple]:
+        """Get all (user_id, media_id, watched, progress, last_watched) rows."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, media_id, watched, progress, last_watched FROM watch_state"
+            ).fetchall()
+        return [(user, media, bool(watched), progress, last) for user, media, watched, progress, last in rows]
+
+    def put_watch_states(self, rows: Iterable[tuple]) -> int:
+        """Insert or replace (user_id, media_id, watched, progress, last_watched) rows."""
+        rows = list(rows)
+        if rows:
+            with self.transaction() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO watch_state "
+                    "(user_id, media_id, watched, progress, last_watched) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+        return len(rows)
+
+    # ==================== Response Cache ====================
+
+    def get_cached_response(self, key: str, now: float) -> Optional[Any]:
+        """Get a cached remote API response unless it has expired."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM response_cache WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_cached_response(self, key: str, data: Any, expires: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, data, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(data, separators=(',', ':')), expires)
+            )
+
+    def purge_cached_responses(self, now: float) -> int:
+        """Drop expired responses."""
+        with self._lock:
+            return self._conn.execute("DELETE FROM response_cache WHERE expires <= ?", (now,)).rowcount
+
+    # ==================== Sample Hashes ====================
+
+    def get_sample_hash(self, path: str, size: int, modified: str) -> Optional[str]:
+        """Get the recorded sample hash of a file, unless it has changed since."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT hash FROM sample_hashes WHERE path = ? AND size = ? AND modified = ?",
+                (path, size, modified)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_sample_hashes(self, rows: Iterable[tuple]) -> int:
+        """Insert or replace (path, size, modified, hash) rows."""
+        rows = list(rows)
+        if rows:
+            with self.transaction() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO sample_hashes (path, size, modified, hash) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+        return len(rows)
+
+    # ==================== Fingerprints ====================
+
+    def get_fingerprints(self, path: str, size: int, modified: str) -> Optional[Tuple[bytes, bytes]]:
+        """Get the (head, tail) audio fingerprints of a file, unless it has changed since."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT head, tail FROM fingerprints WHERE path = ? AND size = ? AND modified = ?",
+                (path, size, modified)
+            ).fetchone()
+        return (bytes(row[0]), bytes(row[1])) if row else None
+
+    def put_fingerprints(self, path: str, size: int, modified: str, head: bytes, tail: bytes):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fingerprints (path, size, modified, head, tail) VALUES (?, ?, ?, ?, ?)",
+                (path, size, modified, head, tail)
+            )
+
+    # ==================== Directory Snapshots ====================
+
+    def load_dir_snapshots(self, library_id: str) -> Dict[str, Dict[str, Any]]:
+        """Get the recorded directory snapshots of a library, keyed by path."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, data FROM dir_snapshots WHERE library_id = ?", (library_id,)
+            ).fetchall()
+        return {path: json.loads(data) for path, data in rows}
+
+    def save_dir_snapshots(
+        self,
+        library_id: str,
+        changed: Dict[str, Dict[str, Any]],
+        removed: Iterable[str],
+    ):
+        """Write changed directory snapshots and drop vanished ones."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM dir_snapshots WHERE library_id = ? AND path = ?",
+                [(library_id, path) for path in removed]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO dir_snapshots (library_id, path, data) VALUES (?, ?, ?)",
+                [(library_id, path, _dumps(data)) for path, data in changed.items()]
+            )
+
+    def clear_dir_snapshots(self, library_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM dir_snapshots WHERE library_id = ?", (library_id,))
+
+    # ==================== Migration ====================
+
+    def migrate_json(self, libraries_file: Path, media_file: Path) -> bool:
+        """
+        Import legacy JSON files into the database.
+        The originals are renamed to ``*.migrated`` once the import commits.
+        """
+        legacy = [p for p in (libraries_file, media_file) if p.exists()]
+        if not legacy:
+            return False
+
+        libraries = []
+        if libraries_file.exists():
+            with open(libraries_file, 'r') as f:
+                libraries = json.load(f)
+
+        migrated = 0
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO libraries (id, data) VALUES (?, ?)",
+                [(lib['id'], _dumps(lib)) for lib in libraries]
+            )
+            if media_file.exists():
+                # media.json can be large; insert it as it is read
+                with open(media_file, 'r') as f:
+                    rows = []
+                    for m in _iter_json_array(f):
+                        rows.append((m['id'], _dumps(m)))
+                        if len(rows) >= 1000:
+                            conn.executemany("INSERT OR REPLACE INTO media (id, data) VALUES (?, ?)", rows)
+                            migrated += len(rows)
+                            rows = []
+                    conn.executemany("INSERT OR REPLACE INTO media (id, data) VALUES (?, ?)", rows)
+                    migrated += len(rows)
+
+        for path in legacy:
+            path.rename(path.with_name(path.name + ".migrated"))
+
+        logger.info(f"Migrated {len(libraries)} libraries and {migrated} media files from JSON")
+        return True
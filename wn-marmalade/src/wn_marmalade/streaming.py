@@ -0,0 +1,451 @@
+"""
+Marmalade Streaming - direct play over HTTP byte ranges.
+
+Serves media files with Range / If-Range support. File bodies are handed
+to the kernel with loop.sendfile(), which uses os.sendfile() (zero-copy)
+on plain sockets and falls back to buffered reads elsewhere. Every
+request opens its own descriptor, so any number of clients can read the
+same file at once while sharing the page cache.
+
+Generated artwork (thumbnails, trickplay sheets) is served the same way,
+with content-hash ETags so clients revalidate with If-None-Match. HLS
+transcodes are served from the transcoder's playlists and segments.
+
+The response builder is independent of the bundled HTTP server and can be
+used from other web frameworks as well.
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs
+from typing import Dict, Optional, Tuple, Any, TYPE_CHECKING
+
+from .transcoder import QUALITY_PRESETS
+
+if TYPE_CHECKING:
+    from .server import MarmaladeServer
+
+logger = logging.getLogger(__name__)
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_SEGMENT_RE = re.compile(r'^seg_(\d{5})\.ts$')
+
+
+class RangeNotSatisfiable(Exception):
+    """The requested range lies outside the file."""
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a Range header into an inclusive (start, end) pair.
+    Returns None when the whole file should be sent (no header, a
+    malformed one, or multiple ranges, which are not supported).
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip().replace(' ', ''))
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if size == 0:
+        # No byte of an empty file can be addressed
+        raise RangeNotSatisfiable()
+
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+@dataclass
+class StreamResponse:
+    """Status, headers and the byte span of a file to send."""
+    status: int
+    headers: Dict[str, str]
+    path: Optional[str] = None
+    offset: int = 0
+    length: int = 0
+    body: bytes = b''  # sent instead of a file span when there is no path
+
+
+def build_response(
+    path: str,
+    mime_type: str,
+    range_header: Optional[str] = None,
+    if_range: Optional[str] = None,
+    if_none_match: Optional[str] = None,
+    etag: Optional[str] = None,
+) -> StreamResponse:
+    """
+    Work out the response for a (possibly ranged) request of a file.
+    The ETag is derived from the file's identity unless one is given,
+    e.g. a content hash.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return StreamResponse(404, {"Content-Length": "0"})
+
+    size = stat.st_size
+    etag = etag or f'"{stat.st_ino:x}-{size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    headers = {
+        "Content-Type": mime_type,
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": last_modified,
+    }
+
+    if if_none_match and _if_none_match_matches(if_none_match, etag):
+        headers["Content-Length"] = "0"
+        return StreamResponse(304, headers)
+
+    # A stale If-Range validator means the client's partial copy is outdated
+    if range_header and if_range and not _if_range_matches(if_range, etag, int(stat.st_mtime)):
+        range_header = None
+
+    try:
+        span = parse_range(range_header, size)
+    except RangeNotSatisfiable:
+        headers["Content-Range"] = f"bytes */{size}"
+        headers["Content-Length"] = "0"
+        return StreamResponse(416, headers)
+
+    if span is None:
+        headers["Content-Length"] = str(size)
+        return StreamResponse(200, headers, path, 0, size)
+
+    start, end = span
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamResponse(206, headers, path, start, end - start + 1)
+
+
+def _if_none_match_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, so W/"x" matches "x"
+    tags = (tag.strip() for tag in if_none_match.split(','))
+    return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+
+def _if_range_matches(if_range: str, etag: str, mtime: int) -> bool:
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag  # weak validators never match
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == mtime
+    except (TypeError, ValueError):
+        return False
+
+
+class StreamMetrics:
+    """Counters and a sliding-window throughput figure for served streams."""
+
+    def __init__(self, window: float = 10.0):
+        self.window = window
+        self.requests = 0
+        self.bytes_sent = 0
+        self.active: Dict[str, int] = {}  # media_id -> open streams
+        self._samples: deque = deque()  # (timestamp, bytes)
+
+    @property
+    def active_streams(self) -> int:
+        return sum(self.active.values())
+
+    def opened(self, media_id: str):
+        self.requests += 1
+        self.active[media_id] = self.active.get(media_id, 0) + 1
+
+    def closed(self, media_id: str):
+        count = self.active.get(media_id, 0) - 1
+        if count > 0:
+            self.active[media_id] = count
+        else:
+            self.active.pop(media_id, None)
+
+    def sent(self, count: int):
+        now = time.monotonic()
+        self.bytes_sent += count
+        self._samples.append((now, count))
+        self._expire(now)
+
+    def throughput(self) -> float:
+        """Bytes per second over the last window."""
+        self._expire(time.monotonic())
+        return sum(count for _, count in self._samples) / self.window
+
+    def _expire(self, now: float):
+        """Drop samples older than the window, so only the window is ever held."""
+        cutoff = now - self.window
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "bytes_sent": self.bytes_sent,
+            "active_streams": self.active_streams,
+            "active_by_media": dict(self.active),
+            "throughput_bps": self.throughput(),
+        }
+
+
+_REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request",
+            404: "Not Found", 405: "Method Not Allowed", 416: "Range Not Satisfiable",
+            503: "Service Unavailable"}
+
+# Content-addressed artwork never changes under the same URL
+_IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class StreamingServer:
+    """
+    Minimal HTTP/1.1 server for direct play and artwork:
+
+        GET/HEAD /stream/{media_id}
+        GET/HEAD /artwork/{media_id}/thumbnail.jpg
+        GET/HEAD /artwork/{media_id}/trickplay.json
+        GET/HEAD /artwork/objects/{digest}.jpg
+        GET/HEAD /transcode/{media_id}/{quality}/index.m3u8
+        GET/HEAD /transcode/{media_id}/{quality}/seg_{index:05d}.ts[?client={id}]
+
+    Supports keep-alive so players can issue many range requests on one connection.
+    """
+
+    MAX_HEADER_LINES = 100
+    IDLE_TIMEOUT = 60.0  # seconds
+    SENDFILE_CHUNK = 8 * 1024 * 1024  # bytes per sendfile call, for metrics granularity
+
+    def __init__(self, server: 'MarmaladeServer', host: str = "0.0.0.0", port: int = 8097):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.metrics = server.stream_metrics
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        sockets = self._server.sockets or []
+        if sockets:
+            self.port = sockets[0].getsockname()[1]
+        logger.info(f"Streaming server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return self.metrics.to_dict()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, version, headers = request
+                keep_alive = (
+                    headers.get("connection", "").lower() != "close"
+                    and version == "HTTP/1.1"
+                )
+                await self._handle_request(writer, method, target, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            logger.error(f"Streaming connection error: {e}")
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise ConnectionError("malformed request line")
+        headers = {}
+        for _ in range(self.MAX_HEADER_LINES):
+            line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ConnectionError("too many headers")
+        return parts[0], parts[1], parts[2], headers
+
+    async def _handle_request(self, writer, method: str, target: str, headers: Dict[str, str], keep_alive: bool):
+        if method not in ("GET", "HEAD"):
+            await self._write_head(writer, StreamResponse(405, {"Allow": "GET, HEAD", "Content-Length": "0"}), keep_alive)
+            return
+
+        path, _, query = target.partition('?')
+        if path.startswith("/artwork/") or path.startswith("/transcode/"):
+            if path.startswith("/artwork/"):
+                response = await self._artwork_response(path[len("/artwork/"):], headers)
+            else:
+                client_id = parse_qs(query).get("client", [None])[0] or self._peer(writer)
+                response = await self._transcode_response(path[len("/transcode/"):], headers, client_id)
+            await self._write_head(writer, response, keep_alive)
+            if method == "GET":
+                await self._send_body(writer, response)
+            return
+        if not path.startswith("/stream/"):
+            await self._write_head(writer, StreamResponse(404, {"Content-Length": "0"}), keep_alive)
+            return
+
+        media_id = path[len("/stream/"):].strip('/')
+        media = self.server.get_media(media_id)
+        if not media:
+            await self._write_head(writer, StreamResponse(404, {"Content-Length": "0"}), keep_alive)
+            return
+
+        response = await self._build_response(
+            media.path,
+            self.server._get_mime_type(media.path),
+            headers.get("range"),
+            headers.get("if-range"),
+        )
+        await self._write_head(writer, response, keep_alive)
+        if method == "HEAD" or not response.length:
+            return
+
+        self.metrics.opened(media_id)
+        try:
+            await self._send_body(writer, response)
+        finally:
+            self.metrics.closed(media_id)
+
+    async def _artwork_response(self, path: str, headers: Dict[str, str]) -> StreamResponse:
+        artwork = self.server.artwork
+        not_found = StreamResponse(404, {"Content-Length": "0"})
+
+        if path.startswith("objects/") and path.endswith(".jpg"):
+            obj = artwork.get_object(path[len("objects/"):-len(".jpg")])
+            if not obj:
+                return not_found
+            response = await self._build_response(
+                str(obj.path), obj.mime_type, headers.get("range"), headers.get("if-range"),
+                headers.get("if-none-match"), obj.etag,
+            )
+            response.headers["Cache-Control"] = _IMMUTABLE
+            return response
+
+        media_id, _, name = path.partition('/')
+        if name == "thumbnail.jpg":
+            obj = await artwork.get_thumbnail(media_id)
+            if not obj:
+                return not_found
+            response = await self._build_response(
+                str(obj.path), obj.mime_type, headers.get("range"), headers.get("if-range"),
+                headers.get("if-none-match"), obj.etag,
+            )
+            response.headers["Cache-Control"] = "no-cache"  # revalidate, the file may change
+            return response
+
+        if name == "trickplay.json":
+            manifest = await artwork.get_trickplay(media_id)
+            if not manifest:
+                # Queued; ask the client to come back rather than wait on sprite sheets
+                return StreamResponse(404, {"Content-Length": "0", "Retry-After": "30"})
+            body = json.dumps(manifest).encode()
+            return StreamResponse(200, {
+                "Content-Type": "application/json",
+                "Content-Length": str(len(body)),
+                "Cache-Control": "no-cache",
+            }, body=body)
+
+        return not_found
+
+    async def _transcode_response(self, path: str, headers: Dict[str, str], client_id: Optional[str]) -> StreamResponse:
+        transcoder = self.server.transcoder
+        not_found = StreamResponse(404, {"Content-Length": "0"})
+
+        parts = path.split('/')
+        if len(parts) != 3:
+            return not_found
+        media_id, quality, name = parts
+
+        if name == "index.m3u8":
+            playlist = transcoder.get_playlist(media_id, quality)
+            if playlist is None:
+                return not_found
+            body = playlist.encode()
+            return StreamResponse(200, {
+                "Content-Type": "application/vnd.apple.mpegurl",
+                "Content-Length": str(len(body)),
+                "Cache-Control": "no-cache",
+            }, body=body)
+
+        match = _SEGMENT_RE.match(name)
+        media = self.server.get_media(media_id)
+        if not match or not media or quality not in QUALITY_PRESETS:
+            return not_found
+        index = int(match.group(1))
+        if index * transcoder.segment_duration >= media.duration:
+            return not_found
+        segment = await transcoder.get_segment(media_id, quality, index, client_id)
+        if segment is None:
+            # Out of transcode slots, or ffmpeg failed; players retry segments
+            return StreamResponse(503, {"Content-Length": "0", "Retry-After": "5"})
+        return await self._build_response(str(segment), "video/mp2t", headers.get("range"), headers.get("if-range"))
+
+    async def _build_response(self, *args) -> StreamResponse:
+        """build_response on the server's I/O pool: it stats the file."""
+        return await asyncio.get_running_loop().run_in_executor(self.server._executor, build_response, *args)
+
+    @staticmethod
+    def _peer(writer: asyncio.StreamWriter) -> Optional[str]:
+        peer = writer.get_extra_info('peername')
+        return str(peer[0]) if peer else None
+
+    async def _send_body(self, writer: asyncio.StreamWriter, response: StreamResponse):
+        if response.path is None:
+            if response.body:
+                writer.write(response.body)
+                await writer.drain()
+            return
+
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(self.server._executor, open, response.path, 'rb')
+        with f:
+            offset = response.offset
+            remaining = response.length
+            while remaining > 0:
+                sent = await loop.sendfile(
+                    writer.transport, f, offset, min(remaining, self.SENDFILE_CHUNK)
+                )
+                if not sent:
+                    break
+                self.metrics.sent(sent)
+                offset += sent
+                remaining -= sent
+
+    async def _write_head(self, writer: asyncio.StreamWriter, response: StreamResponse, keep_alive: bool):
+        lines = [f"HTTP/1.1 {response.status} {_REASONS.get(response.status, '')}"]
+        lines.extend(f"{name}: {value}" for name, value in response.headers.items())
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        await writer.drain()
@@ -0,0 +1,492 @@
+"""
+Marmalade Transcoder - on-demand HLS transcoding.
+
+Each session is one ffmpeg process writing MPEG-TS segments of fixed
+length into ``transcodes/``. Clients watching the same file at the same
+quality share a session while they are near the same position, and all
+sessions of a file share its segments. A request for a segment far
+ahead of (or behind) what a session produces restarts that session at
+the new position, unless another client is still watching from it, in
+which case a second session is started for the requesting client.
+
+Finished segments are kept in a size-bounded LRU cache and served again
+without transcoding.
+"""
+
+import os
+import math
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .server import MarmaladeServer, MediaFile
+
+logger = logging.getLogger(__name__)
+
+QUALITY_PRESETS: Dict[str, Dict[str, Any]] = {
+    "1080p": {"height": 1080, "video_bitrate": 8000, "audio_bitrate": 192},
+    "720p": {"height": 720, "video_bitrate": 4000, "audio_bitrate": 160},
+    "480p": {"height": 480, "video_bitrate": 1500, "audio_bitrate": 128},
+    "360p": {"height": 360, "video_bitrate": 800, "audio_bitrate": 96},
+}
+
+
+def _file_size(path: Path) -> Optional[int]:
+    """Size of a file, None if it does not exist (blocking)."""
+    try:
+        return path.stat().st_size
+    except OSError:
+        return None
+
+
+def _remove_segments(paths: List[str], in_use: Set[Path]):
+    """Delete evicted segments, and session directories left empty and unused (blocking)."""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    for directory in {Path(os.path.dirname(path)) for path in paths} - in_use:
+        if not any(directory.glob("seg_*.ts")):
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+@dataclass
+class TranscodeSession:
+    """A running (or finished) ffmpeg process for one media and quality from one position."""
+    media_id: str
+    quality: str
+    directory: Path
+    start_index: int = 0
+    next_index: int = 0  # first segment not yet seen on disk
+    process: Optional[asyncio.subprocess.Process] = None
+    clients: Dict[str, float] = field(default_factory=dict)  # client id -> time of last request
+    last_access: float = field(default_factory=time.monotonic)
+    starting: bool = False  # ffmpeg is being (re)started
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def covers(self, index: int, seek_threshold: int) -> bool:
+        """Whether the running process produces (or soon reaches) a segment."""
+        return self.running and self.start_index <= index <= self.next_index + seek_threshold
+
+    def needed_by_others(self, client_id: Optional[str], since: float) -> bool:
+        """Whether a client other than client_id requested segments since a time."""
+        return any(other != client_id and seen >= since for other, seen in self.clients.items())
+
+
+class TranscodeManager:
+    """
+    Manages HLS transcode sessions, limits concurrent ffmpeg processes
+    on this host, and keeps the segment cache within its size budget.
+    """
+
+    SEGMENT_PATTERN = "seg_{:05d}.ts"
+
+    def __init__(
+        self,
+        server: 'MarmaladeServer',
+        transcode_dir: Path,
+        ffmpeg_path: str = "ffmpeg",
+        segment_duration: int = 6,
+        max_sessions: int = 2,
+        cache_size: int = 10 * 1024 ** 3,
+        seek_threshold: int = 3,
+        idle_timeout: float = 120.0,
+        segment_timeout: float = 30.0,
+        client_timeout: float = 30.0,
+    ):
+        self.server = server
+        self.transcode_dir = Path(transcode_dir)
+        self.ffmpeg_path = ffmpeg_path
+        self.segment_duration = segment_duration  # seconds
+        self.max_sessions = max_sessions  # concurrent ffmpeg processes
+        self.cache_size = cache_size  # bytes
+        self.seek_threshold = seek_threshold  # segments ahead before restarting
+        self.idle_timeout = idle_timeout
+        self.segment_timeout = segment_timeout
+        self.client_timeout = client_timeout  # seconds a client holds its session's position
+
+        self._sessions: Dict[Tuple[str, str], List[TranscodeSession]] = {}
+        self._lock: Optional[asyncio.Lock] = None  # created on the running loop
+        self._cache: "OrderedDict[str, int]" = OrderedDict()  # segment path -> size, LRU first
+        self._cache_bytes = 0
+        self._reaper: Optional[asyncio.Task] = None
+        self._removals: Set[asyncio.Task] = set()  # deletions of evicted segments
+
+        self.transcode_dir.mkdir(parents=True, exist_ok=True)
+        self._index_cache()
+
+    # ==================== Playlists ====================
+
+    def get_playlist(self, media_id: str, quality: str) -> Optional[str]:
+        """
+        Build the VOD playlist for a media at a quality.
+        Segment URIs are relative: seg_00000.ts, seg_00001.ts, ...
+        """
+        media = self.server.get_media(media_id)
+        if not media or quality not in QUALITY_PRESETS or media.duration <= 0:
+            return None
+
+        count = math.ceil(media.duration / self.segment_duration)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{self.segment_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        for index in range(count):
+            length = min(self.segment_duration, media.duration - index * self.segment_duration)
+            lines.append(f"#EXTINF:{length:.3f},")
+            lines.append(self.SEGMENT_PATTERN.format(index))
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    # ==================== Segments ====================
+
+    async def get_segment(
+        self,
+        media_id: str,
+        quality: str,
+        index: int,
+        client_id: Optional[str] = None,
+    ) -> Optional[Path]:
+        """
+        Get the path of a finished segment, transcoding it if needed.
+        Returns None if the segment cannot be produced (unknown media,
+        transcode slots exhausted, ffmpeg failure or timeout).
+        """
+        media = self.server.get_media(media_id)
+        if not media or quality not in QUALITY_PRESETS or index < 0:
+            return None
+        if index * self.segment_duration >= media.duration:
+            return None
+
+        directory = self._session_dir(media, quality)
+        segment = directory / self.SEGMENT_PATTERN.format(index)
+
+        async with self._get_lock():
+            sessions = self._sessions.setdefault((media_id, quality), [])
+            for stale in [s for s in sessions if s.directory != directory]:
+                # The source file was replaced
+                await self._stop_process(stale)
+                sessions.remove(stale)
+
+            size = await self._io(_file_size, segment)
+            if size is not None:
+                self._touch(segment, size)
+                session = self._session_of(sessions, client_id) or next(
+                    (s for s in sessions if s.covers(index, self.seek_threshold)), None
+                )
+                if session is not None:
+                    self._seen(session, client_id)
+                return segment
+
+            for session in sessions:
+                await self._advance(session)
+            session = next((s for s in sessions if s.covers(index, self.seek_threshold)), None)
+            if session is None:
+                session = self._movable_session(sessions, client_id)
+                if session is None:
+                    session = TranscodeSession(media_id, quality, directory)
+                    sessions.append(session)
+                if not await self._start(session, media, index):
+                    if not session.clients:
+                        sessions.remove(session)
+                    return None
+            self._seen(session, client_id)
+
+        return await self._wait_for(session, segment, index)
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _iter_sessions(self) -> Iterator[TranscodeSession]:
+        for sessions in self._sessions.values():
+            yield from sessions
+
+    def _seen(self, session: TranscodeSession, client_id: Optional[str]):
+        """Record that a client is watching from a session, and forget it elsewhere."""
+        now = time.monotonic()
+        session.last_access = now
+        if client_id:
+            for other in self._sessions.get((session.media_id, session.quality), []):
+                if other is not session:
+                    other.clients.pop(client_id, None)
+            session.clients[client_id] = now
+
+    def _session_of(self, sessions: List[TranscodeSession], client_id: Optional[str]) -> Optional[TranscodeSession]:
+        if client_id:
+            for session in sessions:
+                if client_id in session.clients:
+                    return session
+        return None
+
+    def _movable_session(
+        self,
+        sessions: List[TranscodeSession],
+        client_id: Optional[str],
+    ) -> Optional[TranscodeSession]:
+        """A session that may be restarted elsewhere: no other client watches from it."""
+        since = time.monotonic() - self.client_timeout
+        movable = [s for s in sessions if not s.starting and not s.needed_by_others(client_id, since)]
+        if not movable:
+            return None
+        own = self._session_of(movable, client_id)
+        return own or min(movable, key=lambda s: s.last_access)
+
+    async def _advance(self, session: TranscodeSession):
+        """Move next_index past segments ffmpeg has finished."""
+        if session.next_index < session.start_index:
+            session.next_index = session.start_index
+        sizes = await self._io(self._finished_sizes, session.directory, session.next_index)
+        for size in sizes:
+            self._add_to_cache(session.directory / self.SEGMENT_PATTERN.format(session.next_index), size)
+            session.next_index += 1
+
+    def _finished_sizes(self, directory: Path, index: int) -> List[int]:
+        """Sizes of the consecutive finished segments from an index on (blocking)."""
+        sizes = []
+        while True:
+            size = _file_size(directory / self.SEGMENT_PATTERN.format(index + len(sizes)))
+            if size is None:
+                return sizes
+            sizes.append(size)
+
+    async def _io(self, func, *args):
+        """Run blocking file system work on the server's I/O pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.server._executor, func, *args)
+
+    async def _wait_for(self, session: TranscodeSession, segment: Path, index: int) -> Optional[Path]:
+        deadline = time.monotonic() + self.segment_timeout
+        while time.monotonic() < deadline:
+            size = await self._io(_file_size, segment)
+            if size is not None:
+                self._add_to_cache(segment, size)
+                return segment
+            if session.starting:
+                await asyncio.sleep(0.2)
+                continue
+            if session.running and index < session.start_index:
+                # The same client seeked back and the session moved past this segment
+                return None
+            if not session.running:
+                # Process may have finished right after writing the segment
+                size = await self._io(_file_size, segment)
+                if size is not None:
+                    self._add_to_cache(segment, size)
+                    return segment
+                logger.warning(f"Transcode of {session.media_id} ({session.quality}) ended without {segment.name}")
+                return None
+            await asyncio.sleep(0.2)
+        logger.warning(f"Timed out waiting for {segment}")
+        return None
+
+    # ==================== Sessions ====================
+
+    def _session_dir(self, media: 'MediaFile', quality: str) -> Path:
+        # Tied to the source file's identity so a replaced file never reuses stale segments
+        stamp = hashlib.md5(f"{media.size}:{media.modified_date}".encode()).hexdigest()[:8]
+        return self.transcode_dir / f"{media.id}-{quality}-{stamp}"
+
+    async def _start(self, session: TranscodeSession, media: 'MediaFile', index: int) -> bool:
+        """(Re)start ffmpeg for a session at a segment index."""
+        session.starting = True
+        try:
+            return await self._spawn(session, media, index)
+        finally:
+            session.starting = False
+
+    async def _spawn(self, session: TranscodeSession, media: 'MediaFile', index: int) -> bool:
+        await self._stop_process(session)
+
+        running = [s for s in self._iter_sessions() if s.running]
+        if len(running) >= self.max_sessions:
+            idle = min(running, key=lambda s: s.last_access)
+            if time.monotonic() - idle.last_access < self.idle_timeout:
+                logger.warning(f"Transcode limit reached ({self.max_sessions}), refusing {media.id}")
+                return False
+            await self._stop_process(idle)
+
+        preset = QUALITY_PRESETS[session.quality]
+        await self._io(lambda: session.directory.mkdir(parents=True, exist_ok=True))
+        start_time = index * self.segment_duration
+        cmd = [
+            self.ffmpeg_path,
+            '-hide_banner', '-loglevel', 'error', '-nostdin',
+            '-ss', str(start_time),
+            '-i', media.path,
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-c:v', 'libx264', '-preset', 'veryfast',
+            '-vf', f"scale=-2:'min({preset['height']},ih)'",
+            '-b:v', f"{preset['video_bitrate']}k",
+            '-maxrate', f"{preset['video_bitrate']}k",
+            '-bufsize', f"{preset['video_bitrate'] * 2}k",
+            '-force_key_frames', f"expr:gte(t,n_forced*{self.segment_duration})",
+            '-c:a', 'aac', '-ac', '2', '-b:a', f"{preset['audio_bitrate']}k",
+            '-output_ts_offset', str(start_time),
+            '-f', 'hls',
+            '-hls_time', str(self.segment_duration),
+            '-hls_list_size', '0',
+            '-hls_segment_type', 'mpegts',
+            '-hls_flags', 'temp_file',  # segments appear only once complete
+            '-start_number', str(index),
+            '-hls_segment_filename', str(session.directory / 'seg_%05d.ts'),
+            str(session.directory / f'ffmpeg_{index}.m3u8'),
+        ]
+        try:
+            session.process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except OSError as e:
+            logger.error(f"Cannot start ffmpeg: {e}")
+            return False
+
+        session.start_index = index
+        session.next_index = index
+        logger.info(f"Transcoding {media.id} at {session.quality} from segment {index}")
+        return True
+
+    async def _stop_process(self, session: TranscodeSession):
+        if session.running:
+            session.process.kill()
+            await session.process.wait()
+        session.process = None
+
+    async def stop_session(self, media_id: str, quality: str):
+        async with self._get_lock():
+            for session in self._sessions.pop((media_id, quality), []):
+                await self._stop_process(session)
+
+    def release(self, media_id: str, quality: str, client_id: str):
+        """A client stopped watching; idle sessions are reaped later."""
+        for session in self._sessions.get((media_id, quality), []):
+            session.clients.pop(client_id, None)
+
+    async def reap_idle(self):
+        """Stop ffmpeg for sessions nobody requested segments from recently."""
+        now = time.monotonic()
+        async with self._get_lock():
+            for key, sessions in list(self._sessions.items()):
+                for session in list(sessions):
+                    if now - session.last_access > self.idle_timeout:
+                        await self._stop_process(session)
+                        sessions.remove(session)
+                if not sessions:
+                    del self._sessions[key]
+
+    async def start(self):
+        """Reap idle sessions in the background."""
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+            self._reaper = None
+        async with self._get_lock():
+            for session in self._iter_sessions():
+                await self._stop_process(session)
+            self._sessions.clear()
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            try:
+                await self.reap_idle()
+            except Exception as e:
+                logger.error(f"Transcode reaper error: {e}")
+
+    def active_sessions(self) -> int:
+        return sum(1 for s in self._iter_sessions() if s.running)
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "sessions": [
+                {
+                    "media_id": s.media_id,
+                    "quality": s.quality,
+                    "running": s.running,
+                    "start_segment": s.start_index,
+                    "next_segment": s.next_index,
+                    "clients": len(s.clients),
+                }
+                for s in self._iter_sessions()
+            ],
+            "max_sessions": self.max_sessions,
+            "cache_bytes": self._cache_bytes,
+            "cache_size": self.cache_size,
+        }
+
+    # ==================== Segment Cache ====================
+
+    def _index_cache(self):
+        """Pick up segments left from previous runs, oldest first."""
+        segments = []
+        for path in self.transcode_dir.glob("*/seg_*.ts"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            segments.append((stat.st_mtime, str(path), stat.st_size))
+        for _, path, size in sorted(segments):
+            self._cache[path] = size
+            self._cache_bytes += size
+        self._evict()
+
+    def _touch(self, segment: Path, size: int):
+        key = str(segment)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            self._add_to_cache(segment, size)
+
+    def _add_to_cache(self, segment: Path, size: int):
+        key = str(segment)
+        if key in self._cache:
+            return
+        self._cache[key] = size
+        self._cache_bytes += size
+        self._evict()
+
+    def _evict(self):
+        # The newest segment is always kept, it is about to be served
+        evicted = []
+        while self._cache_bytes > self.cache_size and len(self._cache) > 1:
+            path, size = self._cache.popitem(last=False)
+            self._cache_bytes -= size
+            evicted.append(path)
+        if not evicted:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            _remove_segments(evicted, set())  # indexing on construction, no sessions yet
+            return
+        task = loop.create_task(self._remove_evicted(evicted))
+        self._removals.add(task)
+        task.add_done_callback(self._removals.discard)
+
+    async def _remove_evicted(self, paths: List[str]):
+        # Under the lock, so no session starts in a directory while it is checked and removed
+        async with self._get_lock():
+            in_use = {s.directory for s in self._iter_sessions()}
+            await self._io(_remove_segments, paths, in_use)
@@ -0,0 +1,143 @@
+"""
+Marmalade Versions - alternate versions and duplicate files.
+
+Files of the same work (see VersionIndex) are versions of it: a 1080p and
+a 2160p encode, a remux next to a WEB-DL. The stream path picks the
+version that suits a client, or the cheapest adequate source for a
+transcode.
+
+Exact duplicates are found without reading whole files: only files of
+equal size are compared at all, by a hash of the size and a few chunks
+spread over the file. Hashes are recorded per (path, size, mtime), so a
+rescan only reads files that changed.
+"""
+
+import hashlib
+import logging
+from typing import Dict, List, Optional, Iterable, Sequence, TYPE_CHECKING
+
+from .storage import MarmaladeStore
+
+if TYPE_CHECKING:
+    from .server import MediaFile
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SIZE = 64 * 1024  # bytes per chunk
+SAMPLE_COUNT = 8  # chunks per file, first and last included
+
+
+def sample_hash(path: str, size: int, sample_size: int = SAMPLE_SIZE, samples: int = SAMPLE_COUNT) -> str:
+    """Hash a file's size and evenly spaced chunks of it (all of it, if small)."""
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        if size <= sample_size * samples:
+            digest.update(f.read())
+        else:
+            for i in range(samples):
+                # Rounded per chunk, so the last one ends at the end of the file
+                f.seek(i * (size - sample_size) // (samples - 1))
+                digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def effective_height(media: 'MediaFile') -> int:
+    """Vertical resolution class, so a cropped 1920x800 encode counts as 1080p."""
+    return max(media.height, media.width * 9 // 16)
+
+
+def version_label(media: 'MediaFile') -> str:
+    """Short description such as "2160p HEVC"."""
+    height = effective_height(media)
+    if not height:
+        return media.container.upper() or "Unknown"
+    for threshold, name in ((2000, "2160p"), (1000, "1080p"), (700, "720p"), (560, "576p")):
+        if height >= threshold:
+            break
+    else:
+        name = "SD"
+    return f"{name} {media.codec_video.upper()}".strip()
+
+
+def split_by_duration(media: Sequence['MediaFile'], tolerance: float = 0.1) -> List[List['MediaFile']]:
+    """
+    Split files whose running times differ by more than tolerance.
+    Used where the name alone is ambiguous (a movie title without a year).
+    """
+    clusters: List[List['MediaFile']] = []
+    for item in sorted(media, key=lambda m: m.duration):
+        if clusters and item.duration <= clusters[-1][-1].duration * (1 + tolerance) + 60:
+            clusters[-1].append(item)
+        else:
+            clusters.append([item])
+    return clusters
+
+
+def pick_version(
+    versions: Sequence['MediaFile'],
+    max_height: Optional[int] = None,
+    video_codecs: Optional[Iterable[str]] = None,
+    max_bitrate: Optional[int] = None,
+) -> 'MediaFile':
+    """
+    Choose the version a client should play directly: one whose codec it
+    decodes, then the best one within its resolution and bitrate limits,
+    or failing that the smallest one over them.
+    """
+    codecs = {c.lower() for c in video_codecs} if video_codecs else None
+
+    def rank(media: 'MediaFile') -> tuple:
+        height = effective_height(media)
+        playable = codecs is None or media.codec_video.lower() in codecs
+        fits = (max_height is None or height <= max_height) and (
+            max_bitrate is None or not media.bitrate or media.bitrate <= max_bitrate
+        )
+        if fits:
+            return (playable, True, height, media.bitrate)
+        return (playable, False, -height, -media.bitrate)
+
+    return max(versions, key=rank)
+
+
+def pick_source(versions: Sequence['MediaFile'], height: int) -> 'MediaFile':
+    """Choose the version to transcode to a height: the smallest that is not upscaled."""
+    def rank(media: 'MediaFile') -> tuple:
+        source = effective_height(media)
+        if source >= height:
+            return (True, -source, -media.bitrate)
+        return (False, source, media.bitrate)
+
+    return max(versions, key=rank)
+
+
+def find_duplicates(media: Iterable['MediaFile'], store: MarmaladeStore) -> List[List['MediaFile']]:
+    """
+    Group files with identical content (blocking). Only files that share
+    their size with another are hashed. Sampling would miss a difference
+    that falls entirely between chunks, but copies of a video that differ
+    at all practically never keep the exact same size.
+    """
+    by_size: Dict[int, List['MediaFile']] = {}
+    for item in media:
+        if item.size > 0:
+            by_size.setdefault(item.size, []).append(item)
+
+    by_hash: Dict[str, List['MediaFile']] = {}
+    new_rows = []
+    for size, items in by_size.items():
+        if len(items) < 2:
+            continue
+        for item in items:
+            digest = store.get_sample_hash(item.path, size, item.modified_date)
+            if digest is None:
+                try:
+                    digest = sample_hash(item.path, size)
+                except OSError as e:
+                    logger.warning(f"Cannot hash {item.path}: {e}")
+                    continue
+                new_rows.append((item.path, size, item.modified_date, digest))
+            by_hash.setdefault(digest, []).append(item)
+
+    store.put_sample_hashes(new_rows)
+    logger.info(f"Duplicate check hashed {len(new_rows)} files")
+    return [items for items in by_hash.values() if len(items) > 1]
@@ -0,0 +1,242 @@
+"""
+Marmalade Watcher - live library updates from filesystem events.
+
+Uses watchdog's native observer (inotify on Linux) and falls back to a
+polling observer for libraries where native watches cannot be set up
+(network shares, exhausted inotify watch limits). Events are debounced
+per path, so a file that is still being written is only picked up once
+it has been quiet for a while, and then applied to the server in batches.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Set, Tuple, Optional, TYPE_CHECKING
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+
+if TYPE_CHECKING:
+    from .server import MarmaladeServer, Library
+
+logger = logging.getLogger(__name__)
+
+CHANGED = "changed"
+REMOVED = "removed"
+
+
+class _LibraryEventHandler(FileSystemEventHandler):
+    """Forwards watchdog events for one library to the watcher."""
+
+    def __init__(self, watcher: 'LibraryWatcher', library_id: str):
+        self._watcher = watcher
+        self._library_id = library_id
+
+    def on_created(self, event):
+        self._watcher._post(self._library_id, event.src_path, CHANGED, event.is_directory)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._watcher._post(self._library_id, event.src_path, CHANGED, False)
+
+    def on_closed(self, event):
+        self._watcher._post(self._library_id, event.src_path, CHANGED, False)
+
+    def on_deleted(self, event):
+        self._watcher._post(self._library_id, event.src_path, REMOVED, event.is_directory)
+
+    def on_moved(self, event):
+        self._watcher._post(self._library_id, event.src_path, REMOVED, event.is_directory)
+        self._watcher._post(self._library_id, event.dest_path, CHANGED, event.is_directory)
+
+
+class LibraryWatcher:
+    """
+    Watches all enabled libraries of a MarmaladeServer and feeds
+    create/move/delete events into it incrementally.
+    """
+
+    def __init__(
+        self,
+        server: 'MarmaladeServer',
+        debounce: float = 5.0,
+        max_batch: int = 500,
+        poll_interval: float = 30.0,
+        force_polling: bool = False,
+    ):
+        self.server = server
+        self.debounce = debounce  # seconds a path must be quiet before it is applied
+        self.max_batch = max_batch
+        self.poll_interval = poll_interval
+        self.force_polling = force_polling
+
+        # path -> (library_id, kind, is_directory, last event time)
+        self._pending: Dict[str, Tuple[str, str, bool, float]] = {}
+        self._watches: Dict[str, tuple] = {}
+        self._observer = None
+        self._polling_observer: Optional[PollingObserver] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        """Start watching; must be called from the event loop that owns the server."""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        if self.force_polling:
+            self._observer = PollingObserver(timeout=self.poll_interval)
+        else:
+            self._observer = Observer()
+        self._observer.start()
+        await self._sync_libraries()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Library watcher started ({len(self._watches)} libraries)")
+
+    async def stop(self):
+        """Stop watching and apply any events still pending."""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        for observer in (self._observer, self._polling_observer):
+            if observer is not None:
+                observer.stop()
+                await self._loop.run_in_executor(self.server._executor, observer.join)
+        self._observer = None
+        self._polling_observer = None
+        self._watches.clear()
+
+        await self._flush(force=True)
+        logger.info("Library watcher stopped")
+
+    def get_status(self) -> Dict[str, object]:
+        """Get watched libraries and the number of pending events."""
+        return {
+            "running": self.running,
+            "libraries": {
+                library_id: "polling" if isinstance(observer, PollingObserver) else "native"
+                for library_id, (observer, _) in self._watches.items()
+            },
+            "pending": len(self._pending),
+        }
+
+    # ==================== Watches ====================
+
+    async def _sync_libraries(self):
+        """Keep watches in line with the server's enabled libraries."""
+        enabled = {
+            library_id: library.path for library_id, library in self.server.libraries.items()
+            if library.enabled
+        }
+        wanted = await self._loop.run_in_executor(self.server._executor, self._existing, enabled)
+        for library_id in set(self._watches) - wanted:
+            observer, watch = self._watches.pop(library_id)
+            observer.unschedule(watch)
+        for library_id in wanted - set(self._watches):
+            self._watch(self.server.libraries[library_id])
+
+    @staticmethod
+    def _existing(paths: Dict[str, str]) -> Set[str]:
+        return {library_id for library_id, path in paths.items() if os.path.isdir(path)}
+
+    def _watch(self, library: 'Library'):
+        handler = _LibraryEventHandler(self, library.id)
+        try:
+            watch = self._observer.schedule(handler, library.path, recursive=True)
+            self._watches[library.id] = (self._observer, watch)
+            return
+        except OSError as e:
+            logger.warning(f"Native watch failed for {library.path} ({e}), falling back to polling")
+
+        if self._polling_observer is None:
+            self._polling_observer = PollingObserver(timeout=self.poll_interval)
+            self._polling_observer.start()
+        try:
+            watch = self._polling_observer.schedule(handler, library.path, recursive=True)
+            self._watches[library.id] = (self._polling_observer, watch)
+        except OSError as e:
+            logger.error(f"Cannot watch {library.path}: {e}")
+
+    # ==================== Events ====================
+
+    def _post(self, library_id: str, path: str, kind: str, is_directory: bool):
+        """Called from observer threads."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._record, library_id, path, kind, is_directory)
+
+    def _record(self, library_id: str, path: str, kind: str, is_directory: bool):
+        library = self.server.libraries.get(library_id)
+        if not library:
+            return
+        # Skip hidden directories, as library scans do
+        parts = os.path.relpath(path, library.path).split(os.sep)
+        if not is_directory:
+            parts = parts[:-1]
+        if any(part.startswith('.') and part not in ('.', '..') for part in parts):
+            return
+        self._pending[path] = (library_id, kind, is_directory, time.monotonic())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(min(1.0, self.debounce))
+            try:
+                await self._sync_libraries()
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Library watcher error: {e}")
+
+    async def _flush(self, force: bool = False):
+        """Apply pending events that have been quiet for the debounce period."""
+        now = time.monotonic()
+        ready = [
+            path for path, (_, _, _, seen) in self._pending.items()
+            if force or now - seen >= self.debounce
+        ]
+        if not force:
+            ready = ready[:self.max_batch]
+        if not ready:
+            return
+
+        batches: Dict[str, Tuple[List[str], List[str]]] = {}
+        new_dirs: List[Tuple[str, str]] = []
+        for path in ready:
+            library_id, kind, is_directory, _ = self._pending.pop(path)
+            changed, removed = batches.setdefault(library_id, ([], []))
+            if kind == REMOVED:
+                removed.append(path)
+            elif is_directory:
+                new_dirs.append((library_id, path))
+            else:
+                changed.append(path)
+
+        # Directories moved into a library may not produce events for their contents
+        for library_id, dir_path in new_dirs:
+            files = await self._loop.run_in_executor(self.server._executor, self._list_files, dir_path)
+            batches[library_id][0].extend(files)
+
+        for library_id, (changed, removed) in batches.items():
+            if library_id not in self.server.libraries:
+                continue
+            try:
+                await self.server.apply_file_changes(library_id, changed, removed)
+            except Exception as e:
+                logger.error(f"Error applying file changes for {library_id}: {e}")
+
+    @staticmethod
+    def _list_files(dir_path: str) -> List[str]:
+        files = []
+        for root, dirs, names in os.walk(dir_path):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            files.extend(os.path.join(root, name) for name in names)
+        return files
@@ -0,0 +1,196 @@
+"""
+Marmalade Watch State - per-user playback progress.
+
+Watch state is kept apart from the media catalogue and keyed by
+(user, media). Player heartbeats only update memory; dirty entries are
+written to the store in one transaction every flush interval.
+"""
+
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import Executor
+from contextlib import ExitStack
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple, Iterable, Any
+
+from .index import SortedIndex
+from .storage import MarmaladeStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER = "default"
+
+
+@dataclass
+class WatchState:
+    """Watch status of one media file for one user."""
+    user_id: str
+    media_id: str
+    watched: bool = False
+    watch_progress: float = 0  # seconds
+    last_watched: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class WatchStateStore:
+    """
+    In-memory watch state with coalesced writes.
+    Safe to call from multiple threads.
+    """
+
+    def __init__(self, store: MarmaladeStore, flush_interval: float = 10.0):
+        self._store = store
+        self.flush_interval = flush_interval  # seconds
+        self._states: Dict[Tuple[str, str], WatchState] = {}
+        self._dirty: Set[Tuple[str, str]] = set()
+        self._continue: Dict[str, SortedIndex] = {}  # per user, keyed by last_watched
+        self._watched: Dict[str, SortedIndex] = {}  # per user, finished media by last_watched
+        self._lock = threading.RLock()
+        self._last_flush = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._executor: Optional[Executor] = None
+
+        with ExitStack() as stack:
+            for user_id, media_id, watched, progress, last_watched in store.load_watch_states():
+                state = WatchState(user_id, media_id, watched, progress, last_watched)
+                self._states[(user_id, media_id)] = state
+                if user_id not in self._continue:
+                    # Rails are ordered once everything is loaded
+                    self._continue[user_id] = stack.enter_context(SortedIndex().bulk())
+                    self._watched[user_id] = stack.enter_context(SortedIndex().bulk())
+                self._update_index(state)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def get(self, user_id: str, media_id: str) -> Optional[WatchState]:
+        return self._states.get((user_id, media_id))
+
+    def update(
+        self,
+        user_id: str,
+        media_id: str,
+        progress: Optional[float] = None,
+        watched: Optional[bool] = None,
+    ) -> WatchState:
+        """Record a progress heartbeat and/or watched flag. Does not touch disk."""
+        key = (user_id, media_id)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = WatchState(user_id, media_id)
+            if progress is not None:
+                state.watch_progress = progress
+            if watched is not None:
+                state.watched = watched
+            state.last_watched = datetime.now(timezone.utc).isoformat()
+            self._update_index(state)
+            self._dirty.add(key)
+
+        if self._task is None and time.monotonic() - self._last_flush >= self.flush_interval:
+            # No background flusher; write from the caller
+            self.flush()
+        return state
+
+    def import_states(self, states: Iterable[WatchState]):
+        """Load states from elsewhere (e.g. a migration) and persist them."""
+        with self._lock:
+            for state in states:
+                key = (state.user_id, state.media_id)
+                self._states[key] = state
+                self._update_index(state)
+                self._dirty.add(key)
+        self.flush()
+
+    def _update_index(self, state: WatchState):
+        index = self._continue.setdefault(state.user_id, SortedIndex())
+        if state.watch_progress > 0 and not state.watched:
+            index.add(state.media_id, state.last_watched or '')
+        else:
+            index.remove(state.media_id)
+        watched = self._watched.setdefault(state.user_id, SortedIndex())
+        if state.watched:
+            watched.add(state.media_id, state.last_watched or '')
+        else:
+            watched.remove(state.media_id)
+
+    def continue_watching(self, user_id: str, limit: int = 10) -> List[str]:
+        """Get ids of partially watched media, most recently watched first."""
+        index = self._continue.get(user_id)
+        return index.last(limit=limit) if index else []
+
+    def recently_watched(self, user_id: str, limit: int = 50) -> List[str]:
+        """Get ids of media the user finished, most recent first."""
+        index = self._watched.get(user_id)
+        return index.last(limit=limit) if index else []
+
+    def states_for(self, media_id: str) -> List[WatchState]:
+        """Get every user's state of one media."""
+        with self._lock:
+            states = [self._states.get((user_id, media_id)) for user_id in self._continue]
+        return [state for state in states if state is not None]
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Copies of every state, by media id."""
+        with self._lock:
+            states = [state.to_dict() for state in self._states.values()]
+        result: Dict[str, List[Dict[str, Any]]] = {}
+        for state in states:
+            result.setdefault(state["media_id"], []).append(state)
+        return result
+
+    def forget_media(self, media_id: str):
+        """Drop a media from the continue-watching and up-next rails; its history is kept."""
+        with self._lock:
+            for index in self._continue.values():
+                index.remove(media_id)
+            for index in self._watched.values():
+                index.remove(media_id)
+
+    # ==================== Persistence ====================
+
+    def flush(self) -> int:
+        """Write dirty states to the store."""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return 0
+            rows = [
+                (s.user_id, s.media_id, int(s.watched), s.watch_progress, s.last_watched)
+                for s in (self._states[key] for key in self._dirty)
+            ]
+            self._dirty.clear()
+        try:
+            return self._store.put_watch_states(rows)
+        except Exception as e:
+            logger.error(f"Error saving watch state: {e}")
+            with self._lock:
+                self._dirty.update((row[0], row[1]) for row in rows)
+            return 0
+
+    async def start(self, executor: Optional[Executor] = None):
+        """Flush periodically in the background, on executor if given."""
+        self._executor = executor
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.flush)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await loop.run_in_executor(self._executor, self.flush)
@@ -0,0 +1,128 @@
+"""ArtworkService object store, refs and regeneration, with ffmpeg replaced by canned images."""
+
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from wn_marmalade.artwork import THUMBNAIL
+from wn_marmalade.server import MarmaladeServer, MediaFile, MediaType
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    server.ffmpeg_runs = []
+    server.images = {}  # source path -> image bytes ffmpeg "extracts"
+
+    async def run_ffmpeg(args):
+        source = args[args.index('-i') + 1]
+        server.ffmpeg_runs.append(source)
+        output = args[-1]
+        if '%' in output:
+            for number in (1, 2):
+                Path(output % number).write_bytes(server.images[source] + bytes([number]))
+        else:
+            Path(output).write_bytes(server.images[source])
+
+    monkeypatch.setattr(server.artwork, "_run_ffmpeg", run_ffmpeg)
+    yield server
+    server.close()
+
+
+def add(server: MarmaladeServer, tmp_path, media_id: str, image: bytes) -> MediaFile:
+    path = tmp_path / f"{media_id}.mkv"
+    path.write_bytes(media_id.encode())
+    media = MediaFile(media_id, str(path), path.name, MediaType.MOVIE, media_id, 1,
+                      duration=60.0, width=1920, height=1080)
+    server._put_media_entry(media)
+    server.images[str(path)] = image
+    return media
+
+
+def run(server: MarmaladeServer, coro):
+    async def main():
+        await server.artwork.start()
+        try:
+            return await coro()
+        finally:
+            await server.artwork.stop()
+
+    return asyncio.run(main())
+
+
+def test_identical_images_are_stored_once(server, tmp_path):
+    add(server, tmp_path, "a", b"same")
+    add(server, tmp_path, "b", b"same")
+    artwork = server.artwork
+
+    async def thumbnails():
+        return await artwork.get_thumbnail("a"), await artwork.get_thumbnail("b")
+
+    first, second = run(server, thumbnails)
+    assert first.digest == second.digest
+    assert first.path.read_bytes() == b"same"
+    assert list(artwork._cache) == [first.digest]
+    assert server.ffmpeg_runs == [str(tmp_path / "a.mkv"), str(tmp_path / "b.mkv")]
+
+
+def test_trickplay_manifest_lists_its_sheets(server, tmp_path):
+    add(server, tmp_path, "a", b"sheet")
+    manifest = run(server, lambda: server.artwork.get_trickplay("a", wait=True))
+    assert len(manifest["sheets"]) == 2
+    assert manifest["frames"] == 6
+    digest = manifest["sheets"][0].rsplit("/", 1)[1][:-len(".jpg")]
+    assert server.artwork.get_object(digest).path.read_bytes() == b"sheet\x01"
+
+
+def test_evicted_object_makes_its_ref_stale(server, tmp_path):
+    add(server, tmp_path, "a", b"a" * 100)
+    add(server, tmp_path, "b", b"b" * 100)
+    artwork = server.artwork
+    artwork.cache_size = 150
+
+    async def thumbnails():
+        first = await artwork.get_thumbnail("a")
+        await artwork.get_thumbnail("b")  # evicts a's image
+        await asyncio.sleep(0.1)  # let the unlink run
+        assert not first.path.exists()
+        return first, await artwork.get_thumbnail("a")
+
+    first, again = run(server, thumbnails)
+    assert again.digest == first.digest and again.path.exists()
+    assert server.ffmpeg_runs.count(str(tmp_path / "a.mkv")) == 2
+
+
+def test_replaced_source_gets_new_artwork(server, tmp_path):
+    media = add(server, tmp_path, "a", b"old")
+    artwork = server.artwork
+
+    async def thumbnails():
+        old = await artwork.get_thumbnail("a")
+        Path(media.path).write_bytes(b"a longer replacement")
+        server.images[media.path] = b"new"
+        return old, await artwork.get_thumbnail("a")
+
+    old, new = run(server, thumbnails)
+    assert old.digest != new.digest
+    assert new.path.read_bytes() == b"new"
+
+
+@pytest.mark.parametrize("content", [None, "{not json", '{"width": 480}'])
+def test_missing_or_corrupt_ref_is_regenerated(server, tmp_path, content):
+    media = add(server, tmp_path, "a", b"image")
+    artwork = server.artwork
+    run(server, lambda: artwork.get_thumbnail("a"))
+
+    key = artwork._ref_key(media, THUMBNAIL)
+    ref_file = artwork._refs_dir / f"{key}.json"
+    artwork._refs.clear()
+    if content is None:
+        ref_file.unlink()
+    else:
+        ref_file.write_text(content)
+
+    thumbnail = run(server, lambda: artwork.get_thumbnail("a"))
+    assert thumbnail.path.read_bytes() == b"image"
+    assert len(server.ffmpeg_runs) == 2
+    assert artwork._read_ref(key) == {"width": artwork.thumbnail_width, "objects": [thumbnail.digest]}
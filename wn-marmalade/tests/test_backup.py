@@ -0,0 +1,123 @@
+"""Catalogue export and import, whole and per library."""
+
+import json
+import asyncio
+
+import pytest
+
+from wn_marmalade.aio import AsyncMarmaladeServer
+from wn_marmalade.server import MarmaladeServer, MediaFile, MediaType
+
+
+def populate(server: MarmaladeServer, root):
+    movies = server.add_library("Movies", str(root / "movies"), "movies")
+    shows = server.add_library("Shows", str(root / "tv"), "tv")
+    items = [
+        MediaFile("m1", str(root / "movies/Heat.mkv"), "Heat.mkv", MediaType.MOVIE, "Heat", 10,
+                  library_id=movies.id, year=1995),
+        MediaFile("m2", str(root / "movies/Alien.mkv"), "Alien.mkv", MediaType.MOVIE, "Alien", 20,
+                  library_id=movies.id),
+        MediaFile("e1", str(root / "tv/Office.S01E01.mkv"), "Office.S01E01.mkv", MediaType.EPISODE, "Pilot", 30,
+                  library_id=shows.id, series_name="The Office", season_number=1, episode_number=1),
+    ]
+    for item in items:
+        server._put_media_entry(item)
+    server._save_media(items)
+    server.watch_states.update("alice", "m1", progress=600)
+    server.watch_states.update("alice", "e1", watched=True)
+    return movies, shows
+
+
+@pytest.fixture
+def source(tmp_path):
+    server = MarmaladeServer(data_dir=str(tmp_path / "source"))
+    movies, shows = populate(server, tmp_path)
+    yield server, movies, shows
+    server.close()
+
+
+def records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("name", ["backup.ndjson", "backup.ndjson.gz"])
+def test_full_backup_round_trip(tmp_path, source, name):
+    server, movies, shows = source
+    assert server.export_catalogue(str(tmp_path / name)) == {"libraries": 2, "media": 3, "watch_states": 2}
+
+    restored = MarmaladeServer(data_dir=str(tmp_path / "restored"))
+    restored.media_files  # loaded, so the import updates it and the library counts
+    counts = restored.import_catalogue(str(tmp_path / name))
+    assert counts == {"libraries": 2, "media": 3, "watch_states": 2, "skipped": 0}
+    assert sorted(restored.libraries) == sorted([movies.id, shows.id])
+    assert restored.libraries[movies.id].item_count == 2
+    assert restored.get_media("m1").year == 1995
+    assert [m.title for m in restored.search_media("office")] == ["Pilot"]
+    assert restored.watch_states.get("alice", "m1").watch_progress == 600
+    assert restored.watch_states.continue_watching("alice") == ["m1"]
+    restored.close()
+
+    reopened = MarmaladeServer(data_dir=str(tmp_path / "restored"))
+    assert sorted(reopened.media_files) == ["e1", "m1", "m2"]
+    reopened.close()
+
+
+def test_library_export_holds_only_that_library(tmp_path, source):
+    server, movies, _ = source
+    path = tmp_path / "movies.ndjson"
+    assert server.export_catalogue(str(path), movies.id) == {"libraries": 1, "media": 2, "watch_states": 1}
+    lines = records(path)
+    assert lines[0]["library_id"] == movies.id
+    assert [r["data"]["id"] for r in lines if r["type"] == "media"] == ["m1", "m2"]
+    assert [r["data"]["media_id"] for r in lines if r["type"] == "watch_state"] == ["m1"]
+
+
+def test_library_restore_from_a_full_backup(tmp_path, source):
+    server, _, shows = source
+    path = tmp_path / "backup.ndjson"
+    server.export_catalogue(str(path))
+
+    restored = MarmaladeServer(data_dir=str(tmp_path / "restored"))
+    counts = restored.import_catalogue(str(path), shows.id)
+    assert counts == {"libraries": 1, "media": 1, "watch_states": 1, "skipped": 4}
+    assert list(restored.libraries) == [shows.id]
+    assert list(restored.media_files) == ["e1"]
+    assert restored.watch_states.get("alice", "m1") is None
+    assert restored.get_series()[0]["episodes"] == 1
+    restored.close()
+
+
+def test_import_replaces_entries_with_the_same_id(tmp_path, source):
+    server, movies, _ = source
+    path = tmp_path / "backup.ndjson"
+    server.export_catalogue(str(path), movies.id)
+    server.get_media("m1").title = "Changed"
+    server.import_catalogue(str(path), movies.id)
+    assert server.get_media("m1").title == "Heat"
+    assert [m.id for m in server.search_media("heat")] == ["m1"]
+
+
+def test_import_rejects_other_files(tmp_path, source):
+    server, _, _ = source
+    path = tmp_path / "other.ndjson"
+    path.write_text('{"type": "something-else"}\n')
+    with pytest.raises(ValueError):
+        server.import_catalogue(str(path))
+    path.write_text('{"type": "marmalade-catalogue", "version": 99}\n')
+    with pytest.raises(ValueError):
+        server.import_catalogue(str(path))
+
+
+def test_async_export_snapshots_on_the_loop(tmp_path, source):
+    server, movies, _ = source
+    path = tmp_path / "movies.ndjson"
+
+    async def export():
+        api = AsyncMarmaladeServer(server)
+        try:
+            return await api.export_catalogue(str(path), movies.id)
+        finally:
+            await api.close()
+
+    assert asyncio.run(export()) == {"libraries": 1, "media": 2, "watch_states": 1}
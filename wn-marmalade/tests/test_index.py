@@ -0,0 +1,157 @@
+"""Title search, ordered and series indexes, built one by one and in bulk."""
+
+import random
+
+import pytest
+
+from wn_marmalade.index import SeriesIndex, SortedIndex, TitleIndex
+
+TITLES = {
+    "a": "The Dark Knight",
+    "b": "Dark City",
+    "c": "Darkman",
+    "d": "City of God",
+    "e": "Blade Runner",
+}
+
+
+def title_index(bulk: bool) -> TitleIndex:
+    index = TitleIndex()
+    if bulk:
+        with index.bulk():
+            for media_id, title in TITLES.items():
+                index.add(media_id, title)
+    else:
+        for media_id, title in TITLES.items():
+            index.add(media_id, title)
+    return index
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_title_search_matches_prefixes_and_ranks_whole_words_first(bulk):
+    index = title_index(bulk)
+    assert index.search("dark") == ["b", "a", "c"]
+    assert index.search("dar cit") == ["b"]
+    assert index.search("city") == ["d", "b"]  # starts with the query
+    assert index.search("dark", limit=1) == ["b"]
+    assert index.search("zzz") == []
+    assert index.search("   ") == []
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_title_index_replaces_and_removes_entries(bulk):
+    index = title_index(bulk)
+    index.add("a", "Batman Begins")
+    index.remove("c")
+    assert index.search("dark") == ["b"]
+    assert index.search("bat") == ["a"]
+    assert index._vocab == sorted(index._postings)
+    assert len(index) == 4
+
+
+def test_title_index_matches_series_names():
+    index = TitleIndex()
+    index.add("e1", "Pilot", "The Office")
+    assert index.search("office pil") == ["e1"]
+
+
+def test_sorted_index_pages_partitions_in_key_order():
+    index = SortedIndex()
+    index.add("c", "charlie", ("all", "lib1"))
+    index.add("a", "alpha", ("all", "lib2"))
+    index.add("b", "bravo", ("all", "lib1"))
+    assert index.page("all") == ["a", "b", "c"]
+    assert index.page("all", offset=1, limit=1) == ["b"]
+    assert index.last("all", limit=2) == ["c", "b"]
+    assert index.count("lib1") == 2
+
+    index.add("c", "aardvark", ("all",))
+    assert index.page("all") == ["c", "a", "b"]
+    assert index.page("lib1") == ["b"]
+    index.remove("b")
+    assert index.count("lib1") == 0 and index.page("lib1") == []
+    assert index.last("all", limit=0) == []
+
+
+def test_sorted_index_bulk_build_matches_incremental():
+    rng = random.Random(7)
+    ops = []
+    for _ in range(2000):
+        media_id = f"m{rng.randrange(300)}"
+        if rng.random() < 0.2:
+            ops.append(("remove", media_id))
+        else:
+            ops.append(("add", media_id, rng.randrange(50), ("all", f"lib{rng.randrange(3)}")))
+
+    incremental, bulk = SortedIndex(), SortedIndex()
+    for op in ops:
+        getattr(incremental, op[0])(*op[1:])
+    with bulk.bulk():
+        for op in ops:
+            getattr(bulk, op[0])(*op[1:])
+    assert bulk._partitions == incremental._partitions
+    assert len(bulk) == len(incremental)
+
+
+def add_show(index: SeriesIndex):
+    index.add("s1e1", "tv", "The.Office", 1, 1)
+    index.add("s1e3", "tv", "The Office", 1, 3)
+    index.add("s1e2", "tv", "The Office", 1, 2)
+    index.add("s1e2b", "tv", "The Office", 1, 2, title="Diversity Day (720p)")
+    index.add("s2e1", "tv", "The Office", 2, 1, 2)  # two-part episode
+    index.add("s2e2", "tv", "The Office", 2, 2)
+    index.add("s2e3", "tv", "The Office", 2, 3)
+    index.add("s0e1", "tv", "The Office", 0, 1)
+    index.add("s0e2", "tv", "The Office", 0, 2)
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_series_index_orders_episodes_and_links_them(bulk):
+    index = SeriesIndex()
+    if bulk:
+        with index.bulk():
+            add_show(index)
+    else:
+        add_show(index)
+    series_id = SeriesIndex.series_id("tv", "The Office")
+
+    assert [s["episodes"] for s in index.series()] == [9]
+    assert index.seasons(series_id) == [(0, 2), (1, 4), (2, 3)]
+    assert index.episodes(series_id, 1) == ["s1e1", "s1e2", "s1e2b", "s1e3"]
+    assert index.episodes(series_id) == ["s1e1", "s1e2", "s1e2b", "s1e3", "s2e1", "s2e2", "s2e3"]
+
+    assert index.next("s1e1") == "s1e2"
+    assert index.next("s1e2") == index.next("s1e2b") == "s1e3"
+    assert index.previous("s1e3") == "s1e2"
+    assert index.next("s1e3") == "s2e1"
+    assert index.next("s2e1") == "s2e3"  # steps over the second part
+    assert index.next("s2e3") is None
+    assert index.next("s0e1") == "s0e2" and index.next("s0e2") is None
+
+
+def test_series_index_relinks_after_changes():
+    index = SeriesIndex()
+    add_show(index)
+    series_id = SeriesIndex.series_id("tv", "The Office")
+    assert index.next("s1e1") == "s1e2"
+
+    index.remove("s1e2")
+    index.remove("s1e2b")
+    assert index.next("s1e1") == "s1e3"
+    index.add("s1e2", "tv", "The Office", 1, 2)
+    assert index.next("s1e1") == "s1e2"
+
+    for media_id in list(index._entries):
+        index.remove(media_id)
+    assert index.series() == [] and index.seasons(series_id) == []
+
+
+def test_series_index_bulk_drops_emptied_series():
+    index = SeriesIndex()
+    add_show(index)
+    index.add("x1", "tv", "Other", 1, 1)
+    with index.bulk():
+        index.remove("x1")
+        index.add("s3e1", "tv", "The Office", 3, 1)
+    assert [s["name"] for s in index.series()] == ["The.Office"]
+    assert index.next("s2e3") == "s3e1"
@@ -0,0 +1,80 @@
+"""Chapter-title markers and finding a shared stretch in audio fingerprints."""
+
+import random
+from array import array
+
+import pytest
+
+from wn_marmalade.markers import (
+    FRAME, _FRAME_SAMPLES, chapter_markers, common_segment, find_recurring, fingerprint,
+)
+
+
+def frames(rng: random.Random, count: int) -> list:
+    """Per-frame (low, mid, high) loudness of a made-up sound."""
+    return [tuple(rng.randint(200, 8000) for _ in range(3)) for _ in range(count)]
+
+
+def pcm(loudness: list, seed: int) -> bytes:
+    """Three-band s16le audio with the given loudness per frame."""
+    rng = random.Random(seed)
+    samples = array('h')
+    for bands in loudness:
+        for _ in range(_FRAME_SAMPLES):
+            samples.extend(rng.randint(-amp, amp) for amp in bands)
+    return samples.tobytes()
+
+
+def near(frame: int, expected: int) -> bool:
+    """Within a second: the frames either side of a match may or may not agree."""
+    return abs(frame - expected) <= 1 / FRAME
+
+
+@pytest.fixture(scope="module")
+def theme():
+    return frames(random.Random(1), 160)
+
+
+def episode(theme: list, before: int, after: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    return fingerprint(pcm(frames(rng, before) + theme + frames(rng, after), seed))
+
+
+@pytest.mark.parametrize("chapters, expected", [
+    ([(0, 90, "Intro"), (90, 1300, "Part 1"), (1300, 1400, "End Credits")],
+     {"intro_start": 0, "intro_end": 90, "credits_start": 1300}),
+    ([(0, 60, "Cold open"), (60, 150, "OP"), (150, 1380, "Episode"), (1380, 1440, "ED")],
+     {"intro_start": 60, "intro_end": 150, "credits_start": 1380}),
+    ([(0, 30, "Opening"), (30, 60, "Intro")], {"intro_start": 0, "intro_end": 30}),
+    ([(0, 600, "Introduction"), (600, 1200, "Chapter 2")], {}),
+])
+def test_chapter_markers(chapters, expected):
+    assert chapter_markers(chapters) == expected
+
+
+def test_silence_has_no_matches():
+    codes = fingerprint(bytes(6 * _FRAME_SAMPLES * 40))
+    assert len(codes) == 40
+    assert common_segment(codes, codes, 5) is None
+
+
+def test_shared_stretch_is_found_at_its_offset(theme):
+    a = episode(theme, 40, 60, seed=2)
+    b = episode(theme, 100, 20, seed=3)
+    start, end, start_b = common_segment(a, b, min_frames=100)
+    assert near(start, 40) and near(end, 200)
+    assert start_b - start == 60
+    assert common_segment(a, episode([], 200, 0, seed=4), min_frames=100) is None
+
+
+def test_versions_of_one_episode_are_not_compared(theme):
+    first = episode(theme, 40, 60, seed=2)
+    found = find_recurring([
+        ("e1", 1, first),
+        ("e1-4k", 1, first),  # identical from start to end
+        ("e2", 2, episode(theme, 100, 20, seed=3)),
+    ], min_frames=100)
+    start, end = found["e1"]
+    assert near(start, 40) and near(end, 200)
+    assert found["e1-4k"] == found["e1"]
+    assert near(found["e2"][0], 100)
@@ -0,0 +1,143 @@
+"""MetadataEnricher against a local stand-in for the TMDB API."""
+
+import asyncio
+
+import pytest
+
+from wn_marmalade.server import MarmaladeServer, MediaFile, MediaType
+from wn_marmalade.index import VersionIndex
+
+MOVIES = {
+    "heat": [
+        {"id": 949, "title": "Heat", "release_date": "1995-12-15", "overview": "A heist.",
+         "poster_path": "/heat.jpg", "vote_average": 7.9, "genre_ids": [28, 80]},
+    ],
+    "alien": [
+        {"id": 2, "title": "Aliens", "release_date": "1986-07-18", "genre_ids": [28]},
+        {"id": 348, "title": "Alien Covenant", "release_date": "2017-05-09", "genre_ids": [28]},
+    ],
+}
+SHOWS = {
+    "the office": [{"id": 2316, "name": "The Office", "first_air_date": "2005-03-24", "genre_ids": [35]}],
+}
+SEASONS = {
+    (2316, 1): {"episodes": [{"episode_number": 1, "overview": "Pilot."}, {"episode_number": 2}]},
+    (2316, 2): {"episodes": [{"episode_number": 1, "overview": "Dundies."}]},
+}
+
+
+def _reply(path, params):
+    path = path[len("/3"):]
+    if path == "/genre/movie/list":
+        return {"genres": [{"id": 28, "name": "Action"}, {"id": 80, "name": "Crime"}]}
+    if path == "/genre/tv/list":
+        return {"genres": [{"id": 35, "name": "Comedy"}]}
+    if path == "/search/movie":
+        return {"results": MOVIES.get(params["query"], [])}
+    if path == "/search/tv":
+        return {"results": SHOWS.get(params["query"], [])}
+    if path.startswith("/tv/"):
+        _, _, show, _, season = path.split("/")
+        return SEASONS.get((int(show), int(season)))
+    return None
+
+
+@pytest.fixture
+def tmdb(stub_api):
+    stub_api.reply = _reply
+    return stub_api
+
+
+@pytest.fixture
+def server(tmp_path, tmdb):
+    server = MarmaladeServer(
+        data_dir=str(tmp_path),
+        tmdb_api_key="key",
+        tmdb_base_url=f"{tmdb.url}/3",
+    )
+    yield server
+    server.close()
+
+
+def movie(media_id: str, title: str, year=None) -> MediaFile:
+    return MediaFile(media_id, f"/m/{media_id}.mkv", f"{media_id}.mkv", MediaType.MOVIE, title, 1, year=year)
+
+
+def episode(media_id: str, season: int, number: int) -> MediaFile:
+    return MediaFile(
+        media_id, f"/tv/{media_id}.mkv", f"{media_id}.mkv", MediaType.EPISODE, f"Episode {number}", 1,
+        series_name="The.Office", season_number=season, episode_number=number,
+    )
+
+
+def enrich(server: MarmaladeServer, items):
+    for item in items:
+        server._put_media_entry(item)
+
+    async def run():
+        try:
+            return await server.metadata.enrich(items)
+        finally:
+            await server.metadata.stop()
+
+    return asyncio.run(run())
+
+
+def test_movie_match_fills_fields_and_reindexes_year(server):
+    item = movie("m1", "Heat")
+    assert enrich(server, [item]) == [item]
+    assert item.tmdb_id == 949
+    assert item.year == 1995
+    assert item.genres == ("Action", "Crime")
+    assert item.poster_url.endswith("/w500/heat.jpg")
+    assert server._versions.key_of("m1") == VersionIndex.movie_key("Heat", 1995)
+
+
+def test_movies_are_grouped_and_responses_cached(server, tmdb):
+    enrich(server, [movie("m1", "Heat"), movie("m2", "heat")])
+    assert tmdb.requests.count("/3/search/movie") == 1
+
+    enrich(server, [movie("m3", "Heat")])
+    assert tmdb.requests.count("/3/search/movie") == 1
+    assert server.get_media("m3").tmdb_id == 949
+
+
+def test_no_title_match_is_left_unmatched(server):
+    item = movie("m1", "Alien")
+    assert enrich(server, [item]) == []
+    assert item.tmdb_id is None
+    assert server.metadata.stats["unmatched"] == 1
+
+
+def test_no_title_match_falls_back_to_same_year(server):
+    item = movie("m1", "Alien", year=2017)
+    assert enrich(server, [item]) == [item]
+    assert item.tmdb_id == 348
+
+
+def test_episodes_cost_one_search_per_show_and_one_request_per_season(server, tmdb):
+    items = [episode("e1", 1, 1), episode("e2", 1, 2), episode("e3", 2, 1)]
+    assert len(enrich(server, items)) == 3
+    assert tmdb.requests.count("/3/search/tv") == 1
+    assert sorted(p for p in tmdb.requests if p.startswith("/3/tv/")) == [
+        "/3/tv/2316/season/1", "/3/tv/2316/season/2",
+    ]
+    assert [item.tmdb_id for item in items] == [2316] * 3
+    assert items[0].overview == "Pilot."
+    assert items[2].overview == "Dundies."
+    assert items[0].genres == ("Comedy",)
+
+
+def test_removed_items_are_not_restored(server):
+    item = movie("m1", "Heat")
+    server._put_media_entry(item)
+    server._drop_media_entry("m1")
+
+    async def run():
+        try:
+            return await server.metadata.enrich([item])
+        finally:
+            await server.metadata.stop()
+
+    assert asyncio.run(run()) == []
+    assert server.get_media("m1") is None
@@ -0,0 +1,114 @@
+"""ScanScheduler per-device limits and holding scans off during playback."""
+
+import asyncio
+
+import pytest
+
+from wn_marmalade.scheduler import ScanScheduler
+from wn_marmalade.server import MarmaladeServer
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    server.SCAN_PAUSE_POLL = 0.01
+    yield server
+    server.close()
+
+
+def test_one_scan_per_device_at_a_time(server, tmp_path, monkeypatch):
+    for name in ("movies", "tv"):
+        (tmp_path / name).mkdir()
+    movies = server.add_library("Movies", str(tmp_path / "movies"))
+    shows = server.add_library("Shows", str(tmp_path / "tv"), "tv")
+    scheduler = ScanScheduler(server, max_per_device=1, stagger=0)
+    started = []
+
+    async def main():
+        finish = {movies.id: asyncio.Event(), shows.id: asyncio.Event()}
+
+        async def scan_library(library_id, pause=None):
+            started.append(library_id)
+            await finish[library_id].wait()
+
+        monkeypatch.setattr(server, "scan_library", scan_library)
+        scheduler._queue_due()
+        assert list(scheduler._queue) == [movies.id, shows.id]
+        await scheduler._dispatch()
+        await asyncio.sleep(0)
+        assert started == [movies.id]
+        assert list(scheduler._queue) == [shows.id]
+
+        await scheduler._dispatch()
+        await asyncio.sleep(0)
+        assert started == [movies.id]  # same device, still busy
+
+        finish[movies.id].set()
+        await asyncio.sleep(0)
+        await scheduler._dispatch()
+        await asyncio.sleep(0)
+        assert started == [movies.id, shows.id]
+        finish[shows.id].set()
+        await scheduler.stop()
+
+    asyncio.run(main())
+
+
+def test_stagger_spaces_starts_on_a_device(server, tmp_path, monkeypatch):
+    for name in ("movies", "tv"):
+        (tmp_path / name).mkdir()
+        server.add_library(name, str(tmp_path / name))
+    scheduler = ScanScheduler(server, max_per_device=2, stagger=60)
+    started = []
+
+    async def main():
+        async def scan_library(library_id, pause=None):
+            started.append(library_id)
+
+        monkeypatch.setattr(server, "scan_library", scan_library)
+        scheduler._queue_due()
+        await scheduler._dispatch()
+        await asyncio.sleep(0)
+        assert len(started) == 1 and len(scheduler._queue) == 1
+        await scheduler.stop()
+
+    asyncio.run(main())
+
+
+def test_missing_library_path_is_dropped_from_the_queue(server, tmp_path):
+    library = server.add_library("Movies", str(tmp_path / "missing"))
+    scheduler = ScanScheduler(server)
+
+    async def main():
+        assert scheduler.scan_now(library.id)
+        await scheduler._dispatch()
+        assert scheduler._queue == {} and scheduler._running == {}
+
+    asyncio.run(main())
+
+
+def test_scheduled_scans_wait_while_playback_is_active(server, tmp_path, monkeypatch):
+    (tmp_path / "movies").mkdir()
+    library = server.add_library("Movies", str(tmp_path / "movies"))
+    scheduler = ScanScheduler(server)
+    streams = [1]
+    monkeypatch.setattr(server, "active_streams", lambda: streams[0])
+
+    async def main():
+        await scheduler.start()
+        try:
+            await asyncio.sleep(0.05)
+            assert scheduler._paused.is_set()
+
+            scan = asyncio.ensure_future(server.scan_library(library.id, pause=scheduler._paused.is_set))
+            await asyncio.sleep(0.1)
+            assert not scan.done()
+
+            streams[0] = 0
+            result = await asyncio.wait_for(scan, 5)
+            assert not scheduler._paused.is_set()
+            return result
+        finally:
+            await scheduler.stop()
+
+    assert asyncio.run(main())["new"] == 0
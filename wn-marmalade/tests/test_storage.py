@@ -0,0 +1,136 @@
+"""MarmaladeStore persistence, JSON migration and catalogue loading."""
+
+import json
+import asyncio
+
+from wn_marmalade.storage import MarmaladeStore
+from wn_marmalade.server import MarmaladeServer, MediaFile, MediaType
+
+
+def entry(media_id: str, library_id: str = "lib", **fields):
+    return {"id": media_id, "path": f"/media/{media_id}.mkv", "filename": f"{media_id}.mkv",
+            "media_type": "movie", "title": media_id.title(), "size": 1, "library_id": library_id, **fields}
+
+
+def test_media_round_trip_and_library_filter(tmp_path):
+    store = MarmaladeStore(tmp_path / "m.db")
+    assert store.put_media([entry("a"), entry("b", "other"), entry("c")]) == 3
+    assert store.count_media() == 3
+    assert [m["id"] for m in store.iter_media(batch_size=2)] == ["a", "b", "c"]
+    assert [mid for mid, _ in store.iter_media_json("lib", batch_size=1)] == ["a", "c"]
+
+    store.put_media([entry("a", title="Renamed")])
+    store.delete_media(["b"])
+    assert {m["id"]: m["title"] for m in store.iter_media()} == {"a": "Renamed", "c": "C"}
+    store.close()
+
+
+def test_legacy_json_files_are_migrated(tmp_path):
+    (tmp_path / "libraries.json").write_text(json.dumps([
+        {"id": "lib", "name": "Movies", "path": "/media", "media_type": "movies"},
+    ]))
+    (tmp_path / "media.json").write_text(json.dumps([entry("a"), entry("b")]))
+
+    server = MarmaladeServer(data_dir=str(tmp_path))
+    assert list(server.libraries) == ["lib"]
+    assert sorted(server.media_files) == ["a", "b"]
+    assert not (tmp_path / "media.json").exists()
+    assert (tmp_path / "media.json.migrated").exists()
+    server.close()
+
+
+def test_legacy_watch_state_moves_to_watch_state_store(tmp_path):
+    store = MarmaladeStore(tmp_path / "marmalade.db")
+    store.put_media([entry("a", watch_progress=42.0, last_watched="2024-01-01T00:00:00+00:00")])
+    store.close()
+
+    server = MarmaladeServer(data_dir=str(tmp_path))
+    server.media_files
+    state = server.watch_states.get("default", "a")
+    assert state is not None and state.watch_progress == 42.0
+    server.close()
+
+
+def test_catalogue_reload_rebuilds_indexes(tmp_path):
+    server = MarmaladeServer(data_dir=str(tmp_path))
+    items = [
+        MediaFile(f"m{i}", f"/media/{name}.mkv", f"{name}.mkv", MediaType.MOVIE, name, 1,
+                  added_date=f"2024-01-0{i + 1}", library_id="lib")
+        for i, name in enumerate(["Heat", "Alien", "Brazil"])
+    ]
+    for item in items:
+        server._put_media_entry(item)
+    server._save_media(items)
+    server.close()
+
+    server = MarmaladeServer(data_dir=str(tmp_path))
+    assert [m.title for m in server.get_all_media()] == ["Alien", "Brazil", "Heat"]
+    assert [m.title for m in server.search_media("bra")] == ["Brazil"]
+    assert [m.title for m in server.get_recent_media(limit=2)] == ["Brazil", "Alien"]
+    server.close()
+
+
+def test_library_ids_filled_on_load_are_stored(tmp_path):
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    library = server.add_library("Movies", str(tmp_path), "movies")
+    server._store.put_media([entry("a", library_id="") | {"path": str(tmp_path / "a.mkv")}])
+    server.close()
+
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    assert server.get_media("a").library_id == library.id
+    assert [mid for mid, _ in server._store.iter_media_json(library.id)] == ["a"]
+    server.close()
+
+
+def test_nested_libraries_keep_their_own_snapshots(tmp_path):
+    store = MarmaladeStore(tmp_path / "m.db")
+    store.save_dir_snapshots("outer", {"/media/tv": {"mtime": 1}}, [])
+    store.save_dir_snapshots("inner", {"/media/tv": {"mtime": 2}}, [])
+    assert store.load_dir_snapshots("outer") == {"/media/tv": {"mtime": 1}}
+    assert store.load_dir_snapshots("inner") == {"/media/tv": {"mtime": 2}}
+
+    store.save_dir_snapshots("inner", {}, ["/media/tv"])
+    assert store.load_dir_snapshots("outer") == {"/media/tv": {"mtime": 1}}
+    assert store.load_dir_snapshots("inner") == {}
+    store.close()
+
+
+def test_probe_cache_lives_in_the_data_dir(tmp_path):
+    server = MarmaladeServer(data_dir=str(tmp_path))
+    assert server.probe_cache.db_path == tmp_path / "probe_cache.db"
+    server.close()
+
+
+def test_library_removed_during_scan_is_not_persisted(tmp_path, monkeypatch):
+    root = tmp_path / "movies"
+    root.mkdir()
+    for name in ("Heat (1995).mkv", "Alien (1979).mkv"):
+        (root / name).write_bytes(b"x")
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    library = server.add_library("Movies", str(root), "movies")
+
+    async def main():
+        probing = asyncio.Event()
+        release = asyncio.Event()
+
+        async def media_info(path):
+            probing.set()
+            await release.wait()
+            return {}
+
+        monkeypatch.setattr(server, "_get_media_info", media_info)
+        scan = asyncio.ensure_future(server.scan_library(library.id))
+        await probing.wait()
+        assert server.remove_library(library.id)
+        release.set()
+        return await scan
+
+    assert asyncio.run(main()) == {"error": "Library removed during scan"}
+    assert server.media_files == {}
+    server.close()
+
+    store = MarmaladeStore(tmp_path / "data" / "marmalade.db")
+    assert store.load_libraries() == []
+    assert store.count_media() == 0
+    assert store.load_dir_snapshots(library.id) == {}
+    store.close()
@@ -0,0 +1,114 @@
+"""Range parsing, conditional responses and the streaming server."""
+
+import os
+import asyncio
+
+import httpx
+import pytest
+
+from wn_marmalade.server import MarmaladeServer, MediaFile, MediaType
+from wn_marmalade.streaming import (
+    RangeNotSatisfiable, StreamingServer, StreamMetrics, build_response, parse_range,
+)
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes = 10 - 19", (10, 19)),
+    ("bytes=-", None),
+    ("bytes=0-9,20-29", None),
+    ("items=0-9", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", 1000),
+    ("bytes=20-10", 1000),
+    ("bytes=-0", 1000),
+    ("bytes=0-", 0),
+    ("bytes=-10", 0),
+])
+def test_unsatisfiable_ranges(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, size)
+
+
+def test_build_response_ranges_and_validators(tmp_path):
+    path = tmp_path / "a.mkv"
+    path.write_bytes(bytes(range(100)))
+
+    full = build_response(str(path), "video/x-matroska")
+    assert (full.status, full.offset, full.length) == (200, 0, 100)
+    etag = full.headers["ETag"]
+
+    partial = build_response(str(path), "video/x-matroska", "bytes=10-19")
+    assert (partial.status, partial.offset, partial.length) == (206, 10, 10)
+    assert partial.headers["Content-Range"] == "bytes 10-19/100"
+
+    assert build_response(str(path), "video/x-matroska", "bytes=10-19", if_range=etag).status == 206
+    assert build_response(str(path), "video/x-matroska", "bytes=10-19", if_range='"stale"').status == 200
+    assert build_response(str(path), "video/x-matroska", if_none_match=f"W/{etag}").status == 304
+
+    unsatisfiable = build_response(str(path), "video/x-matroska", "bytes=100-")
+    assert unsatisfiable.status == 416
+    assert unsatisfiable.headers["Content-Range"] == "bytes */100"
+
+    assert build_response(str(tmp_path / "missing.mkv"), "video/x-matroska").status == 404
+
+
+def test_empty_file_has_no_satisfiable_range(tmp_path):
+    path = tmp_path / "empty.mkv"
+    path.write_bytes(b"")
+    assert build_response(str(path), "video/x-matroska").status == 200
+    response = build_response(str(path), "video/x-matroska", "bytes=-10")
+    assert response.status == 416
+    assert response.headers["Content-Range"] == "bytes */0"
+
+
+def test_metrics_keep_only_the_window(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("wn_marmalade.streaming.time.monotonic", lambda: now[0])
+    metrics = StreamMetrics(window=10.0)
+    for _ in range(1000):
+        metrics.sent(100)
+        now[0] += 1.0
+    assert len(metrics._samples) <= 11
+    assert metrics.bytes_sent == 100_000
+    assert metrics.throughput() == 100.0
+
+
+def test_streaming_server_serves_ranges(tmp_path):
+    data = os.urandom(64 * 1024)
+    (tmp_path / "a.mkv").write_bytes(data)
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    server._put_media_entry(MediaFile("a", str(tmp_path / "a.mkv"), "a.mkv", MediaType.MOVIE, "A", len(data)))
+    streaming = StreamingServer(server, "127.0.0.1", 0)
+
+    async def requests():
+        await streaming.start()
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{streaming.port}") as client:
+                full = await client.get("/stream/a")
+                tail = await client.get("/stream/a", headers={"Range": "bytes=-1000"})
+                head = await client.head("/stream/a", headers={"Range": "bytes=0-9"})
+                missing = await client.get("/stream/b")
+                return full, tail, head, missing
+        finally:
+            await streaming.stop()
+
+    full, tail, head, missing = asyncio.run(requests())
+    server.close()
+    assert full.status_code == 200 and full.content == data
+    assert tail.status_code == 206 and tail.content == data[-1000:]
+    assert tail.headers["content-range"] == f"bytes {len(data) - 1000}-{len(data) - 1}/{len(data)}"
+    assert head.status_code == 206 and head.headers["content-length"] == "10" and head.content == b""
+    assert missing.status_code == 404
+    assert streaming.metrics.bytes_sent == len(data) + 1000
@@ -0,0 +1,118 @@
+"""TranscodeManager session reuse, segment cache and the HLS routes."""
+
+import time
+import asyncio
+
+import httpx
+import pytest
+
+from wn_marmalade.server import MarmaladeServer, MediaFile, MediaType
+from wn_marmalade.streaming import StreamingServer
+from wn_marmalade.transcoder import TranscodeSession
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    server._put_media_entry(MediaFile(
+        "a", str(tmp_path / "a.mkv"), "a.mkv", MediaType.MOVIE, "A", 1000, duration=15.0,
+    ))
+    yield server
+    server.close()
+
+
+def session(transcoder, start: int, **clients) -> TranscodeSession:
+    s = TranscodeSession("a", "720p", transcoder.transcode_dir / "a", start_index=start, next_index=start)
+    s.clients.update(clients)
+    return s
+
+
+def test_movable_session_is_never_one_another_client_watches(server):
+    transcoder = server.transcoder
+    now = time.monotonic()
+    shared = session(transcoder, 0, alice=now, bob=now)
+    assert transcoder._movable_session([shared], "alice") is None
+
+    # bob has not requested anything for longer than client_timeout
+    shared.clients["bob"] = now - transcoder.client_timeout - 1
+    assert transcoder._movable_session([shared], "alice") is shared
+
+
+def test_movable_session_prefers_the_clients_own_then_the_least_recent(server):
+    transcoder = server.transcoder
+    old, recent, own = session(transcoder, 0), session(transcoder, 10), session(transcoder, 20, alice=time.monotonic())
+    old.last_access -= 60
+    assert transcoder._movable_session([old, recent, own], "alice") is own
+    assert transcoder._movable_session([old, recent], "alice") is old
+
+    old.starting = True
+    assert transcoder._movable_session([old, recent], "alice") is recent
+
+
+def test_segment_cache_evicts_least_recently_used(server):
+    transcoder = server.transcoder
+    transcoder.cache_size = 250
+    directory = transcoder.transcode_dir / "a"
+    directory.mkdir()
+    segments = []
+    for index in range(3):
+        path = directory / transcoder.SEGMENT_PATTERN.format(index)
+        path.write_bytes(b"x" * 100)
+        segments.append(path)
+
+    transcoder._add_to_cache(segments[0], 100)
+    transcoder._add_to_cache(segments[1], 100)
+    transcoder._touch(segments[0], 100)  # segment 1 is now the least recently used
+    transcoder._add_to_cache(segments[2], 100)
+
+    assert list(transcoder._cache) == [str(segments[0]), str(segments[2])]
+    assert transcoder._cache_bytes == 200 <= transcoder.cache_size
+    assert [p.exists() for p in segments] == [True, False, True]
+
+
+def test_cache_keeps_the_newest_segment_over_budget(server):
+    transcoder = server.transcoder
+    transcoder.cache_size = 50
+    directory = transcoder.transcode_dir / "a"
+    directory.mkdir()
+    first, second = directory / "seg_00000.ts", directory / "seg_00001.ts"
+    first.write_bytes(b"x" * 100)
+    second.write_bytes(b"x" * 100)
+
+    transcoder._add_to_cache(first, 100)
+    transcoder._add_to_cache(second, 100)
+    assert list(transcoder._cache) == [str(second)]
+    assert not first.exists() and second.exists()
+
+
+def test_routes_serve_the_playlist_and_cached_segments(server):
+    transcoder = server.transcoder
+    media = server.get_media("a")
+    directory = transcoder._session_dir(media, "720p")
+    directory.mkdir()
+    (directory / "seg_00001.ts").write_bytes(b"segment")
+    streaming = StreamingServer(server, "127.0.0.1", 0)
+
+    async def requests():
+        await streaming.start()
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{streaming.port}") as client:
+                return (
+                    await client.get("/transcode/a/720p/index.m3u8"),
+                    await client.get("/transcode/a/720p/seg_00001.ts"),
+                    await client.get("/transcode/a/4k/index.m3u8"),
+                    await client.get("/transcode/a/720p/seg_00003.ts"),
+                )
+        finally:
+            await streaming.stop()
+
+    playlist, segment, unknown_quality, past_end = asyncio.run(requests())
+    assert playlist.status_code == 200
+    assert playlist.headers["content-type"] == "application/vnd.apple.mpegurl"
+    lines = playlist.text.splitlines()
+    assert lines[0] == "#EXTM3U" and lines[-1] == "#EXT-X-ENDLIST"
+    assert [line for line in lines if line.startswith("seg_")] == ["seg_00000.ts", "seg_00001.ts", "seg_00002.ts"]
+    assert lines[lines.index("seg_00002.ts") - 1] == "#EXTINF:3.000,"
+    assert segment.status_code == 200 and segment.content == b"segment"
+    assert unknown_quality.status_code == 404
+    assert past_end.status_code == 404
@@ -0,0 +1,95 @@
+"""Version choice, grouping and duplicate detection."""
+
+from wn_marmalade.server import MarmaladeServer, MediaFile, MediaType
+from wn_marmalade.storage import MarmaladeStore
+from wn_marmalade.versions import (
+    find_duplicates, pick_source, pick_version, sample_hash, split_by_duration, version_label,
+)
+
+
+def version(media_id: str, width: int, height: int, codec: str = "h264", bitrate: int = 0, **fields) -> MediaFile:
+    return MediaFile(
+        media_id, f"/m/{media_id}.mkv", f"{media_id}.mkv", MediaType.MOVIE, "Heat", 1,
+        width=width, height=height, codec_video=codec, bitrate=bitrate, **fields,
+    )
+
+
+UHD = version("uhd", 3840, 2160, "hevc", 60_000_000)
+FHD = version("fhd", 1920, 800, "h264", 12_000_000)  # cropped 1080p
+HD = version("hd", 1280, 720, "h264", 5_000_000)
+
+
+def test_version_labels():
+    assert version_label(UHD) == "2160p HEVC"
+    assert version_label(FHD) == "1080p H264"
+    assert version_label(version("sd", 640, 480)) == "SD H264"
+    assert version_label(MediaFile("x", "/x.avi", "x.avi", MediaType.MOVIE, "X", 1, container="avi")) == "AVI"
+
+
+def test_pick_version_prefers_the_best_playable_version_within_limits():
+    versions = [HD, UHD, FHD]
+    assert pick_version(versions) is UHD
+    assert pick_version(versions, max_height=1080) is FHD
+    assert pick_version(versions, max_bitrate=8_000_000) is HD
+    assert pick_version(versions, video_codecs=["H264"]) is FHD
+    assert pick_version(versions, max_height=480) is HD  # smallest over the limit
+    assert pick_version([UHD, HD], video_codecs=["av1"], max_height=1080) is HD
+
+
+def test_pick_source_avoids_upscaling():
+    versions = [HD, UHD, FHD]
+    assert pick_source(versions, 1080) is FHD
+    assert pick_source(versions, 720) is HD
+    assert pick_source(versions, 4320) is UHD
+
+
+def test_split_by_duration():
+    films = [version(f"m{i}", 1920, 1080, duration=d) for i, d in enumerate([7200, 6000, 7300, 6050])]
+    assert [[m.id for m in c] for c in split_by_duration(films)] == [["m1", "m3"], ["m0", "m2"]]
+
+
+def test_server_groups_versions_by_title_and_year(tmp_path):
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    items = [
+        version("uhd", 3840, 2160, "hevc", 60_000_000, year=1995),
+        version("fhd", 1920, 1080, year=1995),
+        version("remake", 1920, 1080, year=2025),
+    ]
+    for item in items:
+        (tmp_path / f"{item.id}.mkv").write_bytes(b"\0")
+        item.path = str(tmp_path / f"{item.id}.mkv")
+        server._put_media_entry(item)
+
+    assert [m.id for m in server.get_versions("fhd")] == ["uhd", "fhd"]
+    assert [m.id for m in server.get_versions("remake")] == ["remake"]
+    assert server.pick_version("uhd", max_height=1080).id == "fhd"
+    groups = server.get_version_groups()
+    assert [[v["id"] for v in g["versions"]] for g in groups] == [["uhd", "fhd"]]
+    server.close()
+
+
+def test_duplicates_are_found_by_size_and_sampled_hash(tmp_path):
+    def write(name: str, data: bytes) -> MediaFile:
+        path = tmp_path / name
+        path.write_bytes(data)
+        return MediaFile(name, str(path), name, MediaType.MOVIE, name, len(data), modified_date="2024")
+
+    big = bytes(range(256)) * 4096
+    media = [
+        write("a.mkv", big),
+        write("b.mkv", big),
+        write("c.mkv", big[:-1] + b"x"),  # same size, different last chunk
+        write("d.mkv", b"short"),
+    ]
+    assert sample_hash(media[0].path, media[0].size, sample_size=1024, samples=4) != \
+        sample_hash(media[2].path, media[2].size, sample_size=1024, samples=4)
+
+    store = MarmaladeStore(tmp_path / "m.db")
+    groups = find_duplicates(media, store)
+    assert [[m.id for m in group] for group in groups] == [["a.mkv", "b.mkv"]]
+    assert store.get_sample_hash(media[0].path, media[0].size, "2024") is not None
+    assert store.get_sample_hash(media[3].path, media[3].size, "2024") is None  # unique size
+
+    (tmp_path / "a.mkv").unlink()  # cached hashes are used, the file is not read again
+    assert [[m.id for m in group] for group in find_duplicates(media, store)] == [["a.mkv", "b.mkv"]]
+    store.close()
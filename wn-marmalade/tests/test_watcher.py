@@ -0,0 +1,94 @@
+"""LibraryWatcher debouncing and keeping watches in line with the libraries."""
+
+import asyncio
+
+import pytest
+
+from wn_marmalade.server import MarmaladeServer
+from wn_marmalade.watcher import CHANGED, REMOVED, LibraryWatcher
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    server = MarmaladeServer(data_dir=str(tmp_path / "data"))
+    server.applied = []
+
+    async def apply_file_changes(library_id, changed, removed):
+        server.applied.append((library_id, sorted(changed), sorted(removed)))
+
+    monkeypatch.setattr(server, "apply_file_changes", apply_file_changes)
+    yield server
+    server.close()
+
+
+def run(watcher: LibraryWatcher, coro):
+    async def main():
+        await watcher.start()
+        try:
+            return await coro()
+        finally:
+            await watcher.stop()
+
+    return asyncio.run(main())
+
+
+def test_events_are_applied_once_quiet_for_the_debounce_period(server, tmp_path, monkeypatch):
+    root = tmp_path / "movies"
+    (root / "new").mkdir(parents=True)
+    (root / "new" / "b.mkv").write_bytes(b"")
+    library = server.add_library("Movies", str(root))
+    watcher = LibraryWatcher(server, debounce=0.3, force_polling=True)
+    monkeypatch.setattr(watcher, "_run", lambda: asyncio.sleep(3600))  # flush by hand
+
+    async def events():
+        a = str(root / "a.mkv")
+        watcher._record(library.id, a, CHANGED, False)
+        await asyncio.sleep(0.2)
+        watcher._record(library.id, a, CHANGED, False)  # still being written
+        watcher._record(library.id, str(root / "old.mkv"), REMOVED, False)
+        watcher._record(library.id, str(root / "new"), CHANGED, True)
+        watcher._record(library.id, str(root / ".hidden" / "c.mkv"), CHANGED, False)
+        await asyncio.sleep(0.2)
+        await watcher._flush()
+        assert server.applied == []
+        await asyncio.sleep(0.2)
+        await watcher._flush()
+
+    run(watcher, events)
+    assert server.applied == [
+        (library.id, [str(root / "a.mkv"), str(root / "new" / "b.mkv")], [str(root / "old.mkv")]),
+    ]
+
+
+def test_stop_applies_pending_events(server, tmp_path):
+    root = tmp_path / "movies"
+    root.mkdir()
+    library = server.add_library("Movies", str(root))
+    watcher = LibraryWatcher(server, debounce=60, force_polling=True)
+
+    async def events():
+        watcher._record(library.id, str(root / "a.mkv"), CHANGED, False)
+
+    run(watcher, events)
+    assert server.applied == [(library.id, [str(root / "a.mkv")], [])]
+
+
+def test_watches_follow_added_disabled_and_removed_libraries(server, tmp_path):
+    (tmp_path / "movies").mkdir()
+    (tmp_path / "tv").mkdir()
+    movies = server.add_library("Movies", str(tmp_path / "movies"))
+    server.add_library("Gone", str(tmp_path / "missing"))
+    watcher = LibraryWatcher(server, force_polling=True)
+
+    async def sync():
+        assert set(watcher._watches) == {movies.id}
+        shows = server.add_library("Shows", str(tmp_path / "tv"), "tv")
+        await watcher._sync_libraries()
+        assert set(watcher._watches) == {movies.id, shows.id}
+
+        movies.enabled = False
+        server.remove_library(shows.id)
+        await watcher._sync_libraries()
+        assert watcher._watches == {}
+
+    run(watcher, sync)
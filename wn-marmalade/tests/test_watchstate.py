@@ -0,0 +1,95 @@
+"""WatchStateStore rails and coalesced writes."""
+
+import time
+import asyncio
+
+from wn_marmalade.storage import MarmaladeStore
+from wn_marmalade.watchstate import WatchStateStore
+
+
+def saved(store: MarmaladeStore):
+    return {(row[0], row[1]): row[2:4] for row in store.load_watch_states()}
+
+
+def test_heartbeats_are_written_once_per_flush(tmp_path):
+    store = MarmaladeStore(tmp_path / "m.db")
+    states = WatchStateStore(store, flush_interval=3600)
+    for second in range(1, 6):
+        states.update("alice", "a", progress=second * 10)
+    states.update("bob", "a", watched=True)
+    assert saved(store) == {}
+
+    assert states.flush() == 2
+    assert saved(store) == {("alice", "a"): (0, 50), ("bob", "a"): (1, 0)}
+    assert states.flush() == 0
+
+    reloaded = WatchStateStore(store)
+    assert reloaded.get("alice", "a").watch_progress == 50
+    assert reloaded.continue_watching("alice") == ["a"]
+    assert reloaded.recently_watched("bob") == ["a"]
+    store.close()
+
+
+def test_callers_flush_when_no_background_task_runs(tmp_path):
+    store = MarmaladeStore(tmp_path / "m.db")
+    states = WatchStateStore(store, flush_interval=0.05)
+    states.update("alice", "a", progress=10)
+    time.sleep(0.06)
+    states.update("alice", "b", progress=20)
+    assert set(saved(store)) == {("alice", "a"), ("alice", "b")}
+    store.close()
+
+
+def test_failed_flush_keeps_states_dirty(tmp_path, monkeypatch):
+    store = MarmaladeStore(tmp_path / "m.db")
+    states = WatchStateStore(store, flush_interval=3600)
+    states.update("alice", "a", progress=10)
+
+    def fail(rows):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "put_watch_states", fail)
+    assert states.flush() == 0
+    monkeypatch.undo()
+    assert states.flush() == 1
+    assert saved(store) == {("alice", "a"): (0, 10)}
+    store.close()
+
+
+def test_background_flusher_writes_and_flushes_on_stop(tmp_path):
+    store = MarmaladeStore(tmp_path / "m.db")
+    states = WatchStateStore(store, flush_interval=0.05)
+
+    async def play():
+        await states.start()
+        states.update("alice", "a", progress=10)
+        await asyncio.sleep(0.2)
+        written = saved(store)
+        states.update("alice", "a", progress=20)
+        await states.stop()
+        return written
+
+    assert asyncio.run(play()) == {("alice", "a"): (0, 10)}
+    assert saved(store) == {("alice", "a"): (0, 20)}
+    store.close()
+
+
+def test_rails_follow_progress_and_watched_flags(tmp_path):
+    store = MarmaladeStore(tmp_path / "m.db")
+    states = WatchStateStore(store, flush_interval=3600)
+    for media_id in ("a", "b", "c"):
+        states.update("alice", media_id, progress=10)
+        time.sleep(0.001)  # distinct last_watched
+    assert states.continue_watching("alice") == ["c", "b", "a"]
+
+    states.update("alice", "b", watched=True)
+    assert states.continue_watching("alice") == ["c", "a"]
+    assert states.recently_watched("alice") == ["b"]
+    assert states.continue_watching("bob") == []
+
+    states.forget_media("c")
+    assert states.continue_watching("alice") == ["a"]
+    assert states.get("alice", "c").watch_progress == 10
+    assert [s.user_id for s in states.states_for("a")] == ["alice"]
+    assert sorted(states.snapshot()) == ["a", "b", "c"]
+    store.close()
@@ -15,6 +15,8 @@ from typing import Optional, Dict, List, Tuple
 from dataclasses import dataclass, asdict
 from enum import Enum
 
+from wn_core import ProbeCache, probe_file, get_probe_cache
+
 logger = logging.getLogger(__name__)
 
 class HealthStatus(Enum):
@@ -52,9 +54,16 @@ class SieveChecker:
     Uses FFprobe and FFmpeg to detect common issues that cause playback failures.
     """
     
-    def __init__(self, ffprobe_path: str = "ffprobe", ffmpeg_path: str = "ffmpeg"):
+    def __init__(
+        self,
+        ffprobe_path: str = "ffprobe",
+        ffmpeg_path: str = "ffmpeg",
+        probe_cache: Optional[ProbeCache] = None,
+    ):
         self.ffprobe_path = ffprobe_path
         self.ffmpeg_path = ffmpeg_path
+        # Defaults to the process-wide cache shared with Marmalade
+        self.probe_cache = probe_cache
         
     def check_file(self, file_path: str, compute_hash: bool = False) -> MediaHealthReport:
         """
@@ -268,40 +277,9 @@ class SieveChecker:
         return reports
     
     def _run_ffprobe(self, file_path: str) -> Optional[Dict]:
-        """Run FFprobe and return parsed JSON output."""
-        try:
-            cmd = [
-                self.ffprobe_path,
-                '-v', 'quiet',
-                '-print_format', 'json',
-                '-show_format',
-                '-show_streams',
-                '-show_error',
-                file_path
-            ]
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
-            
-            if result.returncode != 0:
-                logger.error(f"FFprobe error: {result.stderr}")
-                return None
-            
-            return json.loads(result.stdout)
-            
-        except subprocess.TimeoutExpired:
-            logger.error(f"FFprobe timeout for {file_path}")
-            return None
-        except json.JSONDecodeError as e:
-            logger.error(f"FFprobe JSON parse error: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"FFprobe error: {e}")
-            return None
+        """Run FFprobe and return parsed JSON output (cached per file identity)."""
+        cache = self.probe_cache if self.probe_cache is not None else get_probe_cache()
+        return probe_file(file_path, self.ffprobe_path, cache, timeout=60)
     
     def _check_container_integrity(self, format_info: Dict, issues: List, warnings: List, repairs: List):
         """Check container-level integrity."""